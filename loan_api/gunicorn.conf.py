@@ -0,0 +1,10 @@
+import os
+
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):
+    # Drops the in-flight gauge of the worker from the shared metric files,
+    # which only exist when PROMETHEUS_MULTIPROC_DIR is set
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(worker.pid)
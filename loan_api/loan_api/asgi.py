@@ -2,6 +2,8 @@
 ASGI config for loan_api project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Its requests are resolved with loan_api.asgi_urls, so the read endpoints
+are answered by their async views.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
@@ -9,8 +11,21 @@ https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from django.core.handlers.asgi import ASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'loan_api.settings')
 
-application = get_asgi_application()
+ASGI_URLCONF = "loan_api.asgi_urls"
+
+
+class AsyncReadsASGIHandler(ASGIHandler):
+    def create_request(self, scope, body_file):
+        request, error_response = super().create_request(scope, body_file)
+        if request is not None:
+            request.urlconf = ASGI_URLCONF
+        return request, error_response
+
+
+django.setup(set_prefix=False)
+application = AsyncReadsASGIHandler()
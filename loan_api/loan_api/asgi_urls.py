@@ -0,0 +1,16 @@
+"""
+URL configuration served by loan_api.asgi.
+
+The read endpoints resolve to their async views first, at the same URLs
+and under the same names, and every other URL to the views of
+loan_api.urls.
+"""
+
+from django.urls import path, include
+from loan_api import urls
+
+urlpatterns = [
+    path("api/loans/", include("loans.async_urls")),
+    path("api/payments/", include("payments.async_urls")),
+    *urls.urlpatterns,
+]
@@ -0,0 +1,98 @@
+"""
+Async read endpoints.
+
+REST framework views are synchronous, so under ASGI every request to them
+holds a thread for as long as it waits on the database. The read endpoints
+are also written as AsyncReadView subclasses: plain Django async views that
+authenticate, check permissions, paginate and query through the async ORM,
+then serialize with the same serializers and render the same JSON.
+
+loan_api.asgi serves them through loan_api.asgi_urls, at the URLs and
+under the names of the views they stand in for. Requests other than GET
+are handed to those sync views, so each URL keeps all of its methods.
+Like those views, they read from the replica unless the user is pinned to
+the primary.
+"""
+
+from functools import partial
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import AuthenticationFailed, NotAuthenticated
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.views import exception_handler
+from loan_api.replica import areplica_for, reading_from
+from loan_api.response_cache import ResponseCacheMixin
+from users.authentication import CachedTokenAuthentication
+
+
+class AsyncReadView(ResponseCacheMixin, View):
+    """
+    Answer GET with the async get() of the subclass, and hand every other
+    method to its sync_view.
+    """
+
+    authentication = CachedTokenAuthentication()
+    renderer = JSONRenderer()
+    # The sync view answering every method but GET
+    sync_view = None
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Token authentication needs no CSRF check, as on APIView
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        if request.method != "GET":
+            return await sync_to_async(self.sync_view)(request, *args, **kwargs)
+
+        request = self.initialize_request(request)
+        token = reading_from.set(None)
+        try:
+            await self.authenticate(request)
+            reading_from.set(await areplica_for(request.user))
+            response = await self.acached_response(
+                request, partial(self.get, request, *args, **kwargs)
+            )
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        finally:
+            reading_from.reset(token)
+        response["Vary"] = "Accept"
+        return response
+
+    def initialize_request(self, request):
+        request = Request(request)
+        request.accepted_renderer = self.renderer
+        request.accepted_media_type = self.renderer.media_type
+        return request
+
+    async def authenticate(self, request):
+        """Token authentication with the IsAuthenticated permission."""
+        authenticated = await self.authentication.aauthenticate(request)
+        if authenticated is None:
+            raise NotAuthenticated()
+        request.user, request.auth = authenticated
+
+    def render(self, data, status=200, headers=None):
+        return HttpResponse(
+            self.renderer.render(data, self.renderer.media_type),
+            status=status,
+            content_type=self.renderer.media_type,
+            headers=headers,
+        )
+
+    def handle_exception(self, exc):
+        if isinstance(exc, (NotAuthenticated, AuthenticationFailed)):
+            exc.auth_header = self.authentication.authenticate_header(None)
+        response = exception_handler(exc, {"view": self})
+        if response is None:
+            raise exc
+        headers = {
+            header: value
+            for header, value in response.items()
+            if header != "Content-Type"
+        }
+        return self.render(response.data, response.status_code, headers)
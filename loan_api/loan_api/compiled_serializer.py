@@ -0,0 +1,255 @@
+"""
+Compiled read path for model serializers.
+
+Every ModelSerializer instance builds its fields again, and
+DynamicFieldsModelSerializer builds all of them before dropping the ones
+not asked for. Each row then goes through get_attribute, the SkipField and
+PKOnlyObject handling and the to_representation of every field.
+
+compile_serializer does the field work once per serializer class and field
+set. It keeps a plan with, for each field, the attribute or key to read and
+the function turning it into its representation. The fields of the common
+types are represented by the same conversions REST framework applies,
+worked out ahead, and any other field by its own to_representation. Rows
+come out as the same dicts serializer.data holds, so they render to the
+same bytes.
+
+Plans are built without a request, for serializers whose representation
+does not depend on their context.
+
+Clients pick fields with the fields query parameter. The plan of a field set
+also lists the model columns it reads, so views load only those with
+only() or values(). Computed fields name their columns in the serializer's
+computed_sources.
+"""
+
+import decimal
+from functools import lru_cache
+from operator import attrgetter, itemgetter
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import fields as drf_fields
+from rest_framework.exceptions import ValidationError
+from rest_framework.relations import PrimaryKeyRelatedField
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+FIELDS_QUERY_PARAM = "fields"
+
+
+class ReadPlan:
+    def __init__(self, serializer):
+        readable = list(serializer._readable_fields)
+        self.fields = [
+            (field.field_name, self.getter(field), self.converter(field))
+            for field in readable
+        ]
+        self.names = frozenset(field.field_name for field in readable)
+        self.columns = self.columns_of(serializer, readable)
+        # Rows of values() only work out when every field reads a column
+        sources = [model_column(field) for field in readable]
+        self.value_fields = None
+        if None not in sources:
+            self.value_fields = tuple(sources)
+            self.value_getters = [
+                (name, itemgetter(source), convert)
+                for (name, _, convert), source in zip(self.fields, sources)
+            ]
+
+    @staticmethod
+    def columns_of(serializer, fields):
+        """The model columns fields read, or None when some are unknown."""
+        computed = getattr(serializer, "computed_sources", {})
+        columns = {}
+        for field in fields:
+            column = model_column(field)
+            sources = (column,) if column else computed.get(field.field_name)
+            if sources is None:
+                return None
+            columns.update(dict.fromkeys(sources))
+        return tuple(columns)
+
+    def represent(self, instance):
+        return self.build(self.fields, instance)
+
+    def represent_many(self, instances):
+        fields = self.fields
+        return [self.build(fields, instance) for instance in instances]
+
+    def represent_values(self, rows):
+        """Represent the dicts of a values(*value_fields) queryset."""
+        if self.value_fields is None:
+            raise TypeError("This serializer reads more than model fields")
+        fields = self.value_getters
+        return [self.build(fields, row) for row in rows]
+
+    @staticmethod
+    def build(fields, row):
+        representation = {}
+        for name, get, convert in fields:
+            value = get(row)
+            representation[name] = None if value is None else convert(value)
+        return representation
+
+    @staticmethod
+    def getter(field):
+        if field.source == "*":
+            return identity
+        if isinstance(field, PrimaryKeyRelatedField) and model_column(field):
+            # The column holding the key, without loading the related row
+            model = field.parent.Meta.model
+            return attrgetter(model._meta.get_field(field.source).attname)
+        if len(field.source_attrs) == 1:
+            return attrgetter(field.source)
+        return field.get_attribute
+
+    @staticmethod
+    def converter(field):
+        representation = type(field).to_representation
+        if isinstance(field, drf_fields.SerializerMethodField):
+            return getattr(field.parent, field.method_name)
+        if representation is drf_fields.IntegerField.to_representation:
+            return int
+        if representation is drf_fields.CharField.to_representation:
+            return str
+        if representation is PrimaryKeyRelatedField.to_representation:
+            if model_column(field):
+                return identity
+        if representation is drf_fields.DateField.to_representation:
+            output_format = getattr(field, "format", api_settings.DATE_FORMAT)
+            if (
+                output_format is not None
+                and output_format.lower() == drf_fields.ISO_8601
+            ):
+                return date_to_iso
+        if representation is drf_fields.DecimalField.to_representation:
+            return decimal_converter(field) or field.to_representation
+        return field.to_representation
+
+
+def model_column(field):
+    """The name of the model column field reads as it is, if there is one."""
+    if isinstance(field, drf_fields.SerializerMethodField):
+        return None
+    if isinstance(field, PrimaryKeyRelatedField) and field.pk_field is not None:
+        return None
+    if field.source == "*" or len(field.source_attrs) != 1:
+        return None
+    try:
+        model_field = field.parent.Meta.model._meta.get_field(field.source)
+    except (AttributeError, FieldDoesNotExist):
+        return None
+    if not model_field.concrete or model_field.many_to_many:
+        return None
+    return field.source
+
+
+def identity(value):
+    return value
+
+
+def date_to_iso(value):
+    # Strings and empty values are given back as they are, like DateField
+    if not value:
+        return None
+    if isinstance(value, str):
+        return value
+    return value.isoformat()
+
+
+def decimal_converter(field):
+    coerce_to_string = getattr(
+        field, "coerce_to_string", api_settings.COERCE_DECIMAL_TO_STRING
+    )
+    if (
+        not coerce_to_string
+        or field.localize
+        or field.normalize_output
+        or field.decimal_places is None
+    ):
+        return None
+
+    exponent = decimal.Decimal(".1") ** field.decimal_places
+    context = decimal.getcontext().copy()
+    if field.max_digits is not None:
+        context.prec = field.max_digits
+    rounding = field.rounding
+
+    def convert(value):
+        if not isinstance(value, decimal.Decimal):
+            value = decimal.Decimal(str(value).strip())
+        return "{:f}".format(
+            value.quantize(exponent, rounding=rounding, context=context)
+        )
+
+    return convert
+
+
+@lru_cache(maxsize=None)
+def compile_serializer(serializer_class, fields=None):
+    """
+    The ReadPlan of serializer_class, limited to fields when given, as for
+    DynamicFieldsModelSerializer. Fields are compared as a set.
+    """
+    if fields is None:
+        return ReadPlan(serializer_class())
+    return ReadPlan(serializer_class(fields=fields))
+
+
+def get_read_plan(serializer_class, fields=None):
+    if fields is not None:
+        fields = frozenset(fields)
+    return compile_serializer(serializer_class, fields)
+
+
+def requested_fields(request, serializer_class):
+    """The fields named in the fields query parameter, None for all of them."""
+    value = request.query_params.get(FIELDS_QUERY_PARAM, "")
+    fields = {name.strip() for name in value.split(",")} - {""}
+    if not fields:
+        return None
+    unknown = fields - get_read_plan(serializer_class).names
+    if unknown:
+        raise ValidationError(
+            {FIELDS_QUERY_PARAM: [f"Unknown fields: {', '.join(sorted(unknown))}"]}
+        )
+    return frozenset(fields)
+
+
+def get_request_plan(request, serializer_class):
+    return get_read_plan(serializer_class, requested_fields(request, serializer_class))
+
+
+def project(queryset, plan, *columns):
+    """Load only the columns plan reads, plus columns, when they are known."""
+    if plan.columns is None:
+        return queryset
+    return queryset.only(*dict.fromkeys((*plan.columns, *columns)))
+
+
+def project_values(queryset, plan, *columns):
+    """Rows of plan.value_fields, plus columns, as values() dicts."""
+    return queryset.values(*dict.fromkeys((*plan.value_fields, *columns)))
+
+
+class CompiledListMixin:
+    """
+    list() of a read-only model viewset through the compiled plan of its
+    serializer, for the fields the request asks for. Querysets are read with
+    values() when the plan allows it and with only() otherwise, keeping the
+    columns of keyset_ordering for the cursors.
+    """
+
+    def list(self, request, *args, **kwargs):
+        plan = self.read_plan = get_request_plan(request, self.get_serializer_class())
+        ordering = [field.lstrip("-") for field in getattr(self, "keyset_ordering", ())]
+        queryset = self.filter_queryset(self.get_queryset())
+        if plan.value_fields is not None:
+            queryset = project_values(queryset, plan, *ordering)
+            represent = plan.represent_values
+        else:
+            queryset = project(queryset, plan, *ordering)
+            represent = plan.represent_many
+        page = self.paginate_queryset(queryset)
+        if page is None:
+            return Response(represent(queryset))
+        return self.get_paginated_response(represent(page))
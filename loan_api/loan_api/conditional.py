@@ -0,0 +1,39 @@
+"""
+Conditional GETs.
+
+Views name the versions their response is built from, usually Loan.version,
+which every write to a loan or to its payments replaces. make_etag turns
+them into a strong ETag, and conditional_get answers 304 Not Modified when
+the client already holds it, before any of the response is built.
+"""
+
+import hashlib
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+
+
+def make_etag(request, *versions):
+    # The same versions give different bytes at another URL or media type
+    key = repr((request.build_absolute_uri(), request.accepted_media_type, versions))
+    return quote_etag(hashlib.md5(key.encode()).hexdigest())
+
+
+def conditional_get(request, etag, respond):
+    """Return 304 when the request matches etag, respond() otherwise."""
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = respond()
+    return with_etag(response, etag)
+
+
+async def aconditional_get(request, etag, respond):
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = await respond()
+    return with_etag(response, etag)
+
+
+def with_etag(response, etag):
+    if response.status_code in (200, 304):
+        response["ETag"] = etag
+    return response
@@ -0,0 +1,212 @@
+"""
+Prometheus metrics.
+
+Request metrics are recorded by MetricsMiddleware and labelled by the URL
+name each request resolved to. Domain counters are bumped by the views,
+and the token cache counters by users.authentication.TokenCache.
+
+With several worker processes, set PROMETHEUS_MULTIPROC_DIR to a directory
+shared by them before they start: every process then writes its samples
+to files there and MetricsView adds them up on each scrape. The gunicorn
+hook in gunicorn.conf.py drops the live gauges of workers that exit.
+
+The compound factor cache of loans.finance counts its own hits and misses.
+Each process adds what its cache counted since to the counters below after
+every request, and before answering a scrape, so they are summed across
+processes like the other metrics.
+"""
+
+import os
+import threading
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from rest_framework.exceptions import ErrorDetail
+from rest_framework.permissions import BasePermission
+from rest_framework.renderers import BaseRenderer
+from rest_framework.views import APIView
+from loans import finance
+
+UNMATCHED = "unmatched"
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time spent answering requests",
+    ["url_name", "method"],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "Requests being answered",
+    multiprocess_mode="livesum",
+)
+RESPONSES = Counter(
+    "http_responses",
+    "Responses sent",
+    ["url_name", "method", "status"],
+)
+REQUEST_DB_TIME = Histogram(
+    "http_request_db_duration_seconds",
+    "Time spent in database queries while answering requests",
+    ["url_name", "method"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+LOANS_CREATED = Counter("loans_created", "Loans created")
+PAYMENTS_POSTED = Counter("payments_posted", "Payments posted")
+PAYMENT_REJECTIONS = Counter(
+    "payment_rejections",
+    "Payments rejected by validation",
+    ["reason"],
+)
+RESPONSE_CACHE_REQUESTS = Counter(
+    "response_cache_requests",
+    "GET requests looked up in the response cache",
+    ["url_name", "result"],
+)
+TOKEN_CACHE_HITS = Counter(
+    "token_cache_hits",
+    "Token lookups found in the token cache, in process or shared",
+)
+TOKEN_CACHE_MISSES = Counter(
+    "token_cache_misses",
+    "Token lookups left to the database",
+)
+TOKEN_CACHE_EVICTIONS = Counter(
+    "token_cache_evictions",
+    "Tokens dropped from the in-process token cache to make room",
+)
+
+
+COMPOUND_FACTOR_CACHE_HITS = Counter(
+    "compound_factor_cache_hits",
+    "Compound factors found in the cache",
+)
+COMPOUND_FACTOR_CACHE_MISSES = Counter(
+    "compound_factor_cache_misses",
+    "Compound factors worked out and cached",
+)
+COMPOUND_FACTOR_CACHE_SIZE = Gauge(
+    "compound_factor_cache_size",
+    "Compound factors held in the cache",
+    multiprocess_mode="livesum",
+)
+
+# The cache counts of this process already added to the counters
+compound_factor_cache_counted = {"hits": 0, "misses": 0}
+compound_factor_cache_lock = threading.Lock()
+
+
+def record_compound_factor_cache():
+    """Add what the compound factor cache counted since the last call."""
+    with compound_factor_cache_lock:
+        info = finance.compound_factor.cache_info()
+        for counter, field in (
+            (COMPOUND_FACTOR_CACHE_HITS, "hits"),
+            (COMPOUND_FACTOR_CACHE_MISSES, "misses"),
+        ):
+            value = getattr(info, field)
+            # Counts start over when the cache is cleared
+            counter.inc(value - min(value, compound_factor_cache_counted[field]))
+            compound_factor_cache_counted[field] = value
+        COMPOUND_FACTOR_CACHE_SIZE.set(info.currsize)
+
+
+def record_payment_rejection(detail):
+    """Count a rejected payment once per reason found in its error detail."""
+    for reason in set(error_codes(detail)):
+        PAYMENT_REJECTIONS.labels(reason=reason).inc()
+
+
+def error_codes(detail):
+    if isinstance(detail, dict):
+        detail = list(detail.values())
+    if isinstance(detail, list):
+        for item in detail:
+            yield from error_codes(item)
+    elif isinstance(detail, ErrorDetail):
+        yield detail.code
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            response = self.get_response(request)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+        return self.record(request, response, started)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            response = await self.get_response(request)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+        return self.record(request, response, started)
+
+    def record(self, request, response, started):
+        elapsed = time.perf_counter() - started
+        match = request.resolver_match
+        url_name = match.url_name if match and match.url_name else UNMATCHED
+        REQUEST_LATENCY.labels(url_name, request.method).observe(elapsed)
+        RESPONSES.labels(url_name, request.method, response.status_code).inc()
+        # Set by QueryInstrumentationMiddleware when it is enabled
+        recorder = getattr(request, "sql_queries", None)
+        if recorder is not None:
+            REQUEST_DB_TIME.labels(url_name, request.method).observe(recorder.duration)
+        record_compound_factor_cache()
+        return response
+
+
+class IsStaffOrInternal(BasePermission):
+    def has_permission(self, request, view):
+        if request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS:
+            return True
+        return bool(request.user and request.user.is_staff)
+
+
+class MetricsRenderer(BaseRenderer):
+    media_type = "text/plain"
+    format = "txt"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # Metrics are written by MetricsView, only error details get here
+        return str(data.get("detail", data)).encode()
+
+
+class MetricsView(APIView):
+    permission_classes = [IsStaffOrInternal]
+    renderer_classes = [MetricsRenderer]
+
+    def get(self, request):
+        record_compound_factor_cache()
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
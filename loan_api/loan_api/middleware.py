@@ -0,0 +1,159 @@
+"""
+Per-request SQL instrumentation.
+
+QueryInstrumentationMiddleware wraps every database connection of the
+request thread with a QueryRecorder, which counts the queries, adds up
+their time, tells repeated statements apart by their SQL text (parameters
+are passed apart, so equal text means the same statement shape) and keeps
+the slowest one. The totals go out as Server-Timing and X-DB-* response
+headers and as one log line per request on the loan_api.sql logger, keyed
+by the URL name the request resolved to.
+
+Queries run while a streaming response is consumed happen after the
+middleware returns and are not recorded.
+
+Under ASGI the async ORM runs its queries on the thread sync_to_async keeps
+for the request, so the recorder is installed on the connections of that
+thread.
+"""
+
+import logging
+import time
+from collections import Counter
+from contextlib import ExitStack
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger("loan_api.sql")
+
+DEFAULT_SETTINGS = {
+    "ENABLED": True,
+    "HEADERS": True,
+    "WARN_DB_MS": 200,
+    "WARN_DUPLICATES": 5,
+}
+
+
+class QueryRecorder:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+        self.slowest_duration = 0.0
+        self.slowest_sql = None
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.count += 1
+            self.duration += duration
+            self.statements[sql] += 1
+            if duration > self.slowest_duration:
+                self.slowest_duration = duration
+                self.slowest_sql = sql
+
+    @property
+    def duplicates(self):
+        """Executions that repeated a statement already run in the request."""
+        return self.count - len(self.statements)
+
+    def duplicated_statements(self):
+        return [(sql, count) for sql, count in self.statements.items() if count > 1]
+
+
+class QueryInstrumentationMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.options = {
+            **DEFAULT_SETTINGS,
+            **getattr(settings, "SQL_INSTRUMENTATION", {}),
+        }
+        if not self.options["ENABLED"]:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        recorder = request.sql_queries = QueryRecorder()
+        started = time.perf_counter()
+        with self.record_queries(recorder):
+            response = self.get_response(request)
+        return self.report(request, response, recorder, started)
+
+    async def __acall__(self, request):
+        recorder = request.sql_queries = QueryRecorder()
+        started = time.perf_counter()
+        stack = await sync_to_async(self.record_queries)(recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+        return self.report(request, response, recorder, started)
+
+    def record_queries(self, recorder):
+        stack = ExitStack()
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(recorder))
+        return stack
+
+    def report(self, request, response, recorder, started):
+        elapsed = time.perf_counter() - started
+        if self.options["HEADERS"]:
+            self.add_headers(response, recorder, elapsed)
+        self.log(request, response, recorder, elapsed)
+        return response
+
+    def add_headers(self, response, recorder, elapsed):
+        timing = (
+            f'db;dur={recorder.duration * 1000:.1f};desc="{recorder.count} queries", '
+            f"total;dur={elapsed * 1000:.1f}"
+        )
+        if response.has_header("Server-Timing"):
+            timing = f"{response['Server-Timing']}, {timing}"
+        response["Server-Timing"] = timing
+        response["X-DB-Queries"] = recorder.count
+        response["X-DB-Time"] = f"{recorder.duration * 1000:.1f}"
+        response["X-DB-Duplicates"] = recorder.duplicates
+
+    def log(self, request, response, recorder, elapsed):
+        db_ms = recorder.duration * 1000
+        flagged = (
+            db_ms >= self.options["WARN_DB_MS"]
+            or recorder.duplicates >= self.options["WARN_DUPLICATES"]
+        )
+        level = logging.WARNING if flagged else logging.INFO
+        if not logger.isEnabledFor(level):
+            return
+
+        match = request.resolver_match
+        fields = {
+            "url_name": match.url_name if match else None,
+            "method": request.method,
+            "status": response.status_code,
+            "queries": recorder.count,
+            "db_ms": round(db_ms, 1),
+            "total_ms": round(elapsed * 1000, 1),
+            "duplicates": recorder.duplicates,
+            "duplicated_statements": recorder.duplicated_statements(),
+            "slowest_ms": round(recorder.slowest_duration * 1000, 1),
+            "slowest_sql": recorder.slowest_sql,
+        }
+        logger.log(
+            level,
+            "url_name=%(url_name)s method=%(method)s status=%(status)s "
+            "queries=%(queries)s db_ms=%(db_ms)s total_ms=%(total_ms)s "
+            "duplicates=%(duplicates)s slowest_ms=%(slowest_ms)s",
+            fields,
+            extra={"sql": fields},
+        )
@@ -0,0 +1,26 @@
+from django.db.models import F
+from django.shortcuts import aget_object_or_404, get_object_or_404
+from rest_framework.exceptions import PermissionDenied
+
+
+def get_owned_object_or_404(
+    queryset, user, owner="user", message="Permission Denied", **lookup
+):
+    """
+    Fetch the object matching lookup along with the id of its owner, reached
+    through the owner lookup path, in a single query. Raise Http404 when it
+    does not exist and PermissionDenied when it is not owned by user.
+    """
+    instance = get_object_or_404(queryset.annotate(owner_id=F(owner)), **lookup)
+    if instance.owner_id != user.pk:
+        raise PermissionDenied(message)
+    return instance
+
+
+async def aget_owned_object_or_404(
+    queryset, user, owner="user", message="Permission Denied", **lookup
+):
+    instance = await aget_object_or_404(queryset.annotate(owner_id=F(owner)), **lookup)
+    if instance.owner_id != user.pk:
+        raise PermissionDenied(message)
+    return instance
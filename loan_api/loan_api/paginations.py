@@ -1,5 +1,186 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import json
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def approximate_count(queryset):
+    """Row estimate from the query planner, exact count where there is none."""
+    if connections[queryset.db].vendor != "postgresql":
+        return queryset.count()
+    plan = json.loads(queryset.order_by().explain(format="json"))
+    return plan[0]["Plan"]["Plan Rows"]
+
+
+async def aapproximate_count(queryset):
+    if connections[queryset.db].vendor != "postgresql":
+        return await queryset.acount()
+    plan = json.loads(await queryset.order_by().aexplain(format="json"))
+    return plan[0]["Plan"]["Plan Rows"]
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination keyed on every field of the view's keyset_ordering, so
+    deep pages are reached with an index range scan instead of an OFFSET.
+    """
+
+    page_size = 10
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    cursor_query_param = "cursor"
+    count_query_param = "count"
+    invalid_cursor_message = "Invalid cursor"
+
+    def __init__(self, ordering):
+        self.ordering = tuple(ordering)
+        self.fields = [field.lstrip("-") for field in self.ordering]
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = self.get_count(queryset, request)
+        return self.take_page(list(self.page_queryset(queryset, request)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        self.count = await self.aget_count(queryset, request)
+        rows = [row async for row in self.page_queryset(queryset, request)]
+        return self.take_page(rows)
+
+    def page_queryset(self, queryset, request):
+        """The rows of the requested page, plus one telling if more follow."""
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.position, self.reverse = self.decode_cursor(request, queryset.model)
+
+        ordering = self.ordering
+        if self.reverse:
+            ordering = [self.flip(field) for field in ordering]
+        if self.position is not None:
+            queryset = queryset.filter(self.after(self.position, ordering))
+        return queryset.order_by(*ordering)[: self.page_size + 1]
+
+    def take_page(self, rows):
+        has_more = len(rows) > self.page_size
+        after_cursor = self.position is not None
+        self.page = rows[: self.page_size]
+        if self.reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = after_cursor, has_more
+        else:
+            self.has_next, self.has_previous = has_more, after_cursor
+        return self.page
+
+    def get_paginated_response(self, data):
+        response = {
+            "links": {
+                "next": self.get_next_link(),
+                "previous": self.get_previous_link(),
+            },
+        }
+        if self.count is not None:
+            response["count"] = self.count
+        response["results"] = data
+        return Response(response)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_count(self, queryset, request):
+        count = request.query_params.get(self.count_query_param)
+        if count == "exact":
+            return queryset.count()
+        if count == "approximate":
+            return approximate_count(queryset)
+        return None
+
+    async def aget_count(self, queryset, request):
+        count = request.query_params.get(self.count_query_param)
+        if count == "exact":
+            return await queryset.acount()
+        if count == "approximate":
+            return await aapproximate_count(queryset)
+        return None
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            url = self.request.build_absolute_uri()
+            return remove_query_param(url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def after(self, position, ordering):
+        """Rows strictly after position, for a lexicographic ordering."""
+        condition = Q()
+        for index, field in enumerate(ordering):
+            lookup = "lt" if field.startswith("-") else "gt"
+            step = Q(**{f"{self.fields[index]}__{lookup}": position[index]})
+            for previous in range(index):
+                step &= Q(**{self.fields[previous]: position[previous]})
+            condition |= step
+        return condition
+
+    def flip(self, field):
+        return field[1:] if field.startswith("-") else f"-{field}"
+
+    def encode_cursor(self, instance, reverse):
+        if isinstance(instance, dict):
+            position = [instance[field] for field in self.fields]
+        else:
+            position = [getattr(instance, field) for field in self.fields]
+        cursor = {
+            "p": position,
+            "r": int(reverse),
+        }
+        encoded = base64.urlsafe_b64encode(
+            json.dumps(cursor, cls=DjangoJSONEncoder).encode()
+        ).decode()
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def decode_cursor(self, request, model):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None, False
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            position, reverse = cursor["p"], bool(cursor["r"])
+            if not isinstance(position, list) or len(position) != len(self.fields):
+                raise ValueError("Cursor position does not match the ordering")
+            # Converted as the fields would load them, so a forged value
+            # fails here rather than in the query
+            position = [
+                self.to_python(model._meta.get_field(field), value)
+                for field, value in zip(self.fields, position)
+            ]
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+    def to_python(self, field, value):
+        value = field.to_python(value)
+        if value is None:
+            raise ValueError("Cursor positions are never null")
+        # Catches integers out of the range of the column
+        field.run_validators(value)
+        return value
 
 
 class CustomPagination(PageNumberPagination):
@@ -7,8 +188,53 @@ class CustomPagination(PageNumberPagination):
     page_query_param = "page"
     page_size_query_param = "page_size"
     max_page_size = 100
+    pagination_query_param = "pagination"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        ordering = getattr(view, "keyset_ordering", None)
+        if ordering is not None and self.wants_keyset(request):
+            self.keyset = KeysetPagination(ordering)
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """paginate_queryset() counting and reading through the async ORM."""
+        self.keyset = None
+        ordering = getattr(view, "keyset_ordering", None)
+        if ordering is not None and self.wants_keyset(request):
+            self.keyset = KeysetPagination(ordering)
+            return await self.keyset.apaginate_queryset(queryset, request, view)
+
+        self.request = request
+        paginator = self.django_paginator_class(queryset, self.get_page_size(request))
+        # Paginator counts and slices synchronously, so the count is filled
+        # in ahead and the page is read here
+        paginator.count = await queryset.acount()
+        page_number = self.get_page_number(request, paginator)
+        try:
+            number = paginator.validate_number(page_number)
+        except InvalidPage as exc:
+            raise NotFound(
+                self.invalid_page_message.format(
+                    page_number=page_number, message=str(exc)
+                )
+            )
+        bottom = (number - 1) * paginator.per_page
+        top = min(bottom + paginator.per_page, paginator.count)
+        rows = [row async for row in queryset[bottom:top]]
+        self.page = paginator._get_page(rows, number, paginator)
+        return rows
+
+    def wants_keyset(self, request):
+        return (
+            request.query_params.get(self.pagination_query_param) == "cursor"
+            or KeysetPagination.cursor_query_param in request.query_params
+        )
 
     def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
         return Response(
             {
                 "links": {
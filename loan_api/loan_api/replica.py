@@ -0,0 +1,163 @@
+"""
+Read replica routing with read-your-writes stickiness.
+
+When DATABASES has the READ_REPLICA["ALIAS"] database, the GET requests of
+the views using ReplicaReadMixin, or those of its replica_methods, and of
+the async read views, query it instead of the primary. Every other request,
+and every write, keeps to the primary.
+
+A user who writes through one of those views is pinned to the primary for
+the next STICKY_SECONDS, so they read their own writes however far behind
+the replica is. Pins are kept in BACKEND, one of CACHES: with several
+processes it must be a cache they share, or a user whose write another
+process handled would read from the replica. The check_pin_backend system
+check refuses the caches that never leave their process. STICKY_SECONDS
+should cover the replication lag the replica is allowed.
+
+migrate leaves the replica alone, which gets the schema of the primary
+through replication, unless MIGRATE is set, for test replicas that nothing
+replicates to.
+
+Queries only go to the replica while the request that chose it runs, so
+streamed responses, whose rows are read after the view returns, are bound
+to it with read_database().
+"""
+
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import InvalidCacheBackendError, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.checks import Error, Tags, register
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.permissions import SAFE_METHODS
+
+DEFAULT_SETTINGS = {
+    "ALIAS": "replica",
+    "STICKY_SECONDS": 5,
+    "BACKEND": "default",
+    "MIGRATE": False,
+}
+KEY_PREFIX = "replica-pin:"
+# Caches whose entries no other process sees
+PROCESS_CACHES = (LocMemCache, DummyCache)
+
+# The database the reads of the current request go to, None for the primary
+reading_from = ContextVar("reading_from", default=None)
+
+
+def get_options():
+    return {**DEFAULT_SETTINGS, **getattr(settings, "READ_REPLICA", {})}
+
+
+def replica_alias():
+    """The alias of the replica, None when there is none."""
+    alias = get_options()["ALIAS"]
+    return alias if alias in settings.DATABASES else None
+
+
+def pin_key(user_id):
+    return f"{KEY_PREFIX}{user_id}"
+
+
+def pin_to_primary(user):
+    """Send the reads of user to the primary for the next STICKY_SECONDS."""
+    options = get_options()
+    if replica_alias() is None or user is None or not user.is_authenticated:
+        return
+    caches[options["BACKEND"]].set(
+        pin_key(user.pk), True, timeout=options["STICKY_SECONDS"]
+    )
+
+
+def replica_for(user):
+    """The database user reads from: the replica unless pinned to the primary."""
+    alias = replica_alias()
+    if alias is None:
+        return None
+    backend = caches[get_options()["BACKEND"]]
+    return None if backend.get(pin_key(user.pk)) else alias
+
+
+async def areplica_for(user):
+    alias = replica_alias()
+    if alias is None:
+        return None
+    backend = caches[get_options()["BACKEND"]]
+    return None if await backend.aget(pin_key(user.pk)) else alias
+
+
+def read_database():
+    """The alias the reads of the current request go to."""
+    return reading_from.get() or DEFAULT_DB_ALIAS
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return reading_from.get()
+
+    def db_for_write(self, model, **hints):
+        # Instances read from the replica are saved to the primary too
+        return DEFAULT_DB_ALIAS
+
+    def allow_migrate(self, db, app_label, **hints):
+        if db == replica_alias() and not get_options()["MIGRATE"]:
+            return False
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, replica_alias()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ReplicaReadMixin:
+    """
+    Read from the replica on replica_methods, once the user is authenticated,
+    and pin the user to the primary after any other method.
+    """
+
+    # Methods whose requests only read, the safe ones unless a view reads
+    # on others too
+    replica_methods = SAFE_METHODS
+
+    def dispatch(self, request, *args, **kwargs):
+        token = reading_from.set(None)
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            reading_from.reset(token)
+            if request.method not in self.replica_methods:
+                # The user REST framework authenticated, if it got that far
+                pin_to_primary(getattr(request, "user", None))
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in self.replica_methods:
+            reading_from.set(replica_for(request.user))
+
+
+@register(Tags.caches)
+def check_pin_backend(app_configs, **kwargs):
+    """The pins to the primary must be seen by every process."""
+    if replica_alias() is None:
+        return []
+    backend = get_options()["BACKEND"]
+    try:
+        shared = not isinstance(caches[backend], PROCESS_CACHES)
+    except InvalidCacheBackendError:
+        shared = False
+    if shared:
+        return []
+    return [
+        Error(
+            f'READ_REPLICA["BACKEND"] {backend!r} is not a cache the processes '
+            "share, so a user whose write one process handled could read stale "
+            "data from the replica in another.",
+            hint="Name one of CACHES kept outside the process, like a file, "
+            "database, Memcached or Redis cache.",
+            obj="READ_REPLICA",
+            id="loan_api.E001",
+        )
+    ]
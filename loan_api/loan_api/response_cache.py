@@ -0,0 +1,244 @@
+"""
+Per-user cache of rendered GET responses.
+
+Responses are stored in one of CACHES under the user, the URL with its
+query string, the negotiated media type and two generation counters: one
+per user and one for everybody. Every write to a user's loans or payments
+bumps the user's generation, so their earlier responses are never read
+again and just expire; writes spanning many users, like the maintenance
+commands, bump the global one.
+
+Generations are bumped by the Loan and Payment signals and by the views
+that write without them. A bump inside a transaction is repeated once it
+commits, as a request reading the new generation in the meantime may
+still have cached what the database held before.
+
+With several processes, BACKEND must name a cache they all share, or a
+process would keep serving responses another one invalidated.
+"""
+
+import hashlib
+import secrets
+from functools import lru_cache, partial
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from loan_api.metrics import RESPONSE_CACHE_REQUESTS
+from loans.models import Loan
+from payments.models import Payment
+
+DEFAULT_SETTINGS = {
+    "ENABLED": False,
+    "BACKEND": "default",
+    "TIMEOUT": 300,
+    "DISABLED_VIEWS": (),
+}
+KEY_PREFIX = "response:"
+GLOBAL = "all"
+
+
+class ResponseCache:
+    def __init__(self, backend, timeout):
+        self.backend = caches[backend]
+        self.timeout = timeout
+
+    def generations(self, user_id):
+        keys = self.generation_keys(user_id)
+        generations = self.backend.get_many(keys)
+        for key in keys:
+            if key not in generations:
+                # Counters start anywhere, so one that was evicted does not
+                # come back to a value whose responses may still be stored
+                self.backend.add(key, secrets.randbits(62), timeout=None)
+                generations[key] = self.backend.get(key)
+        return [generations[key] for key in keys]
+
+    async def agenerations(self, user_id):
+        keys = self.generation_keys(user_id)
+        generations = await self.backend.aget_many(keys)
+        for key in keys:
+            if key not in generations:
+                await self.backend.aadd(key, secrets.randbits(62), timeout=None)
+                generations[key] = await self.backend.aget(key)
+        return [generations[key] for key in keys]
+
+    def bump(self, scope):
+        key = self.generation_key(scope)
+        try:
+            self.backend.incr(key)
+        except ValueError:
+            self.backend.add(key, secrets.randbits(62), timeout=None)
+
+    def key(self, request):
+        return self.make_key(request, self.generations(request.user.pk))
+
+    async def akey(self, request):
+        return self.make_key(request, await self.agenerations(request.user.pk))
+
+    def make_key(self, request, generations):
+        url = f"{request.build_absolute_uri()} {request.accepted_media_type}"
+        digest = hashlib.md5(url.encode()).hexdigest()
+        generations = ":".join(map(str, generations))
+        return f"{KEY_PREFIX}{request.user.pk}:{generations}:{digest}"
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    async def aget(self, key):
+        return await self.backend.aget(key)
+
+    def set(self, key, response):
+        self.backend.set(key, self.entry(response), timeout=self.timeout)
+
+    async def aset(self, key, response):
+        await self.backend.aset(key, self.entry(response), timeout=self.timeout)
+
+    @staticmethod
+    def entry(response):
+        return (response.content, response["Content-Type"], response.get("ETag"))
+
+    def generation_keys(self, user_id):
+        return [self.generation_key(GLOBAL), self.generation_key(user_id)]
+
+    @staticmethod
+    def generation_key(scope):
+        return f"{KEY_PREFIX}generation:{scope}"
+
+
+@lru_cache(maxsize=None)
+def get_response_cache():
+    options = {**DEFAULT_SETTINGS, **getattr(settings, "RESPONSE_CACHE", {})}
+    if not options["ENABLED"]:
+        return None
+    return ResponseCache(backend=options["BACKEND"], timeout=options["TIMEOUT"])
+
+
+@lru_cache(maxsize=None)
+def disabled_views():
+    options = {**DEFAULT_SETTINGS, **getattr(settings, "RESPONSE_CACHE", {})}
+    return frozenset(options["DISABLED_VIEWS"])
+
+
+@receiver(setting_changed)
+def reset_response_cache(setting, **kwargs):
+    if setting in ("RESPONSE_CACHE", "CACHES"):
+        get_response_cache.cache_clear()
+        disabled_views.cache_clear()
+
+
+def invalidate(scope):
+    """Drop the cached responses of a user, by id, or of everybody with GLOBAL."""
+    cache = get_response_cache()
+    if cache is None:
+        return
+    cache.bump(scope)
+    if connection.in_atomic_block:
+        transaction.on_commit(partial(cache.bump, scope))
+
+
+class ResponseCacheMixin:
+    """
+    Serve the GET responses built by respond() from the response cache.
+    Set cache_responses to False on a view, or list its URL name in
+    RESPONSE_CACHE["DISABLED_VIEWS"], to turn it off there.
+    """
+
+    cache_responses = True
+
+    def cached_response(self, request, respond):
+        cache = self.get_response_cache(request)
+        if cache is None:
+            return respond()
+
+        key = cache.key(request)
+        cached = cache.get(key)
+        if cached is not None:
+            return self.cache_hit(request, cached)
+        self.count_lookup(request, "miss")
+        response = respond()
+        if response.status_code == 200:
+            response.add_post_render_callback(partial(cache.set, key))
+        return response
+
+    async def acached_response(self, request, respond):
+        """cached_response() for async views, whose responses come rendered."""
+        cache = self.get_response_cache(request)
+        if cache is None:
+            return await respond()
+
+        key = await cache.akey(request)
+        cached = await cache.aget(key)
+        if cached is not None:
+            return self.cache_hit(request, cached)
+        self.count_lookup(request, "miss")
+        response = await respond()
+        if response.status_code == 200:
+            await cache.aset(key, response)
+        return response
+
+    def get_response_cache(self, request):
+        cache = get_response_cache()
+        if (
+            cache is None
+            or not self.cache_responses
+            or request.resolver_match.url_name in disabled_views()
+            or request.method != "GET"
+        ):
+            return None
+        return cache
+
+    def cache_hit(self, request, cached):
+        self.count_lookup(request, "hit")
+        content, content_type, etag = cached
+        response = None
+        if etag is not None:
+            response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = HttpResponse(content, content_type=content_type)
+        if etag is not None:
+            response["ETag"] = etag
+        return response
+
+    def count_lookup(self, request, result):
+        RESPONSE_CACHE_REQUESTS.labels(request.resolver_match.url_name, result).inc()
+
+
+@receiver(post_save, sender=Loan)
+@receiver(post_delete, sender=Loan)
+def invalidate_loan_owner(sender, instance=None, **kwargs):
+    invalidate(instance.user_id)
+
+
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+def invalidate_payment_owner(sender, instance=None, origin=None, **kwargs):
+    # Payments deleted along with their loan, or with the user owning it, are
+    # covered by the loan's signal. Saves send no origin
+    if origin is not None and getattr(origin, "model", type(origin)) is not Payment:
+        return
+    invalidate(payment_owner(instance))
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_new_user(sender, instance=None, created=False, **kwargs):
+    # The id of a deleted user may be handed out again
+    if created:
+        invalidate(instance.pk)
+
+
+def payment_owner(payment):
+    if Payment.loan.is_cached(payment):
+        return payment.loan.user_id
+    # Set on rows read through get_owned_object_or_404
+    if hasattr(payment, "owner_id"):
+        return payment.owner_id
+    return (
+        Loan.objects.filter(pk=payment.loan_id)
+        .values_list("user_id", flat=True)
+        .first()
+    )
@@ -46,6 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "loan_api.metrics.MetricsMiddleware",
+    "loan_api.middleware.QueryInstrumentationMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -90,6 +92,17 @@ DATABASES = {
     }
 }
 
+# A read replica of the default database, on REPLICA_HOST_ENV or, for SQLite,
+# in the REPLICA_DB_ENV file. See READ_REPLICA
+if os.environ.get("REPLICA_HOST_ENV") or os.environ.get("REPLICA_DB_ENV"):
+    DATABASES["replica"] = {
+        **DATABASES["default"],
+        "NAME": os.environ.get("REPLICA_DB_ENV", DATABASES["default"]["NAME"]),
+        "HOST": os.environ.get("REPLICA_HOST_ENV", DATABASES["default"]["HOST"]),
+    }
+
+DATABASE_ROUTERS = ["loan_api.replica.ReplicaRouter"]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -111,11 +124,94 @@ AUTH_PASSWORD_VALIDATORS = [
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        "rest_framework.authentication.TokenAuthentication",
+        "users.authentication.CachedTokenAuthentication",
     ],
     "TEST_REQUEST_DEFAULT_FORMAT": "json",
 }
 
+# The default cache is kept in each process. With SHARED_CACHE_DIR_ENV set,
+# the "shared" cache keeps its entries in that directory, for the processes
+# of one host to share, and may be named by the BACKEND settings below
+CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+if os.environ.get("SHARED_CACHE_DIR_ENV"):
+    CACHES["shared"] = {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.environ["SHARED_CACHE_DIR_ENV"],
+    }
+
+# Resolved tokens are cached per process for TTL seconds. BACKEND may name
+# one of CACHES to also share them between processes
+TOKEN_CACHE = {
+    "MAX_SIZE": int(os.environ.get("TOKEN_CACHE_MAX_SIZE_ENV", 10000)),
+    "TTL": int(os.environ.get("TOKEN_CACHE_TTL_ENV", 60)),
+    "BACKEND": os.environ.get("TOKEN_CACHE_BACKEND_ENV") or None,
+}
+
+# Rendered GET responses of the loan and payment read endpoints, cached per
+# user in BACKEND, one of CACHES. With several processes it must be a cache
+# they share. Views named in DISABLED_VIEWS are never cached
+RESPONSE_CACHE = {
+    "ENABLED": os.environ.get("RESPONSE_CACHE_ENV", "off") == "on",
+    "BACKEND": os.environ.get("RESPONSE_CACHE_BACKEND_ENV", "default"),
+    "TIMEOUT": int(os.environ.get("RESPONSE_CACHE_TIMEOUT_ENV", 300)),
+    "DISABLED_VIEWS": [
+        name
+        for name in os.environ.get("RESPONSE_CACHE_DISABLED_VIEWS_ENV", "").split(",")
+        if name
+    ],
+}
+
+# Query count and database time of each request, sent as Server-Timing and
+# X-DB-* headers and logged on loan_api.sql. Requests over WARN_DB_MS or with
+# WARN_DUPLICATES repeated queries are logged as warnings, the others as info
+SQL_INSTRUMENTATION = {
+    "ENABLED": os.environ.get("SQL_INSTRUMENTATION_ENV", "on") == "on",
+    "HEADERS": True,
+    "WARN_DB_MS": 200,
+    "WARN_DUPLICATES": 5,
+}
+
+# Addresses allowed to scrape /metrics without a staff token
+METRICS_ALLOWED_IPS = os.environ.get("METRICS_ALLOWED_IPS_ENV", "127.0.0.1").split(",")
+
+# Worker processes and loans read per chunk by the stress test endpoint,
+# which only takes portfolios of up to MAX_REVALUATIONS loans times
+# scenarios. Larger ones are left to the stress_test command
+STRESS_TEST = {
+    "WORKERS": int(os.environ.get("STRESS_TEST_WORKERS_ENV", 2)),
+    "CHUNK_SIZE": int(os.environ.get("STRESS_TEST_CHUNK_SIZE_ENV", 10000)),
+    "MAX_REVALUATIONS": int(
+        os.environ.get("STRESS_TEST_MAX_REVALUATIONS_ENV", 1000000)
+    ),
+}
+
+# GET requests of the loan and payment read endpoints query the ALIAS
+# database when it is configured. A user who writes through them reads from
+# the primary for the next STICKY_SECONDS, kept in BACKEND, one of CACHES,
+# which must be a cache the processes share. MIGRATE lets migrate create the
+# schema of test replicas, which nothing replicates to
+READ_REPLICA = {
+    "ALIAS": "replica",
+    "STICKY_SECONDS": int(os.environ.get("READ_REPLICA_STICKY_SECONDS_ENV", 5)),
+    "BACKEND": os.environ.get("READ_REPLICA_BACKEND_ENV", "default"),
+    "MIGRATE": os.environ.get("READ_REPLICA_MIGRATE_ENV", "off") == "on",
+}
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {"class": "logging.StreamHandler"},
+    },
+    "loggers": {
+        "loan_api.sql": {
+            "handlers": ["console"],
+            "level": os.environ.get("SQL_LOG_LEVEL_ENV", "WARNING"),
+            "propagate": False,
+        },
+    },
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/5.0/topics/i18n/
 
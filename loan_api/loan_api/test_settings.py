@@ -0,0 +1,34 @@
+"""
+Settings to run the tests against a primary and a read replica kept in two
+SQLite files, so that the replica tests run without a database server:
+
+    ./manage.py test --settings=loan_api.test_settings
+"""
+
+import os
+import tempfile
+from loan_api.settings import *  # noqa: F401, F403
+from loan_api.settings import BASE_DIR, READ_REPLICA
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / "primary.sqlite3",
+    },
+    "replica": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / "replica.sqlite3",
+    },
+}
+
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "shared": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.path.join(tempfile.gettempdir(), "loan_api_test_cache"),
+    },
+}
+
+# The replica files get their schema from migrate, as nothing replicates to
+# them, and the pins go to a cache the test processes could share
+READ_REPLICA = {**READ_REPLICA, "BACKEND": "shared", "MIGRATE": True}
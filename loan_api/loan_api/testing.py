@@ -0,0 +1,160 @@
+import base64
+import json
+import re
+import threading
+import time
+from django.core.cache import caches
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+from loan_api.replica import get_options, reading_from
+
+# Plan lines that mean a table was read in full or rows were sorted, per vendor
+FULL_SCAN_PATTERNS = {
+    "sqlite": re.compile(r"^SCAN (?P<table>\w+)"),
+    "postgresql": re.compile(r"Seq Scan on (?P<table>\w+)"),
+}
+SORT_PATTERNS = {
+    "sqlite": re.compile(r"USE TEMP B-TREE FOR (ORDER|GROUP) BY"),
+    "postgresql": re.compile(r"^\s*(->\s*)?(Incremental )?Sort\b"),
+}
+
+
+def forget_replica_reads():
+    """Drop the pins to the primary and the replica chosen in this context."""
+    caches[get_options()["BACKEND"]].clear()
+    reading_from.set(None)
+
+
+class ReadsFromPrimary:
+    """
+    For test cases whose rows are only written to the primary. With a
+    replica configured their views would read it and miss those rows, so
+    they read from the primary, whatever pins earlier tests left behind.
+    The replica stays out of their databases, for any query that still
+    reaches it to fail.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.enterClassContext(override_settings(READ_REPLICA={"ALIAS": None}))
+        super().setUpClass()
+
+
+class QueryPlanAssertions:
+    """Assertions on the EXPLAIN output of the queries an endpoint runs."""
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                # Seeded tables are tiny, so make index scans in index order
+                # the planner's only choice whenever an index can serve them
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                cursor.execute("SET LOCAL enable_sort = off")
+                cursor.execute(f"EXPLAIN {sql}")
+                return [row[0] for row in cursor.fetchall()]
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertQueryPlansUseIndexes(self, url, tables, allow_sort=False):
+        if connection.vendor not in FULL_SCAN_PATTERNS:
+            self.skipTest(f"No plan patterns for {connection.vendor}")
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        for query in context.captured_queries:
+            plan = self.explain(query["sql"])
+            for line in plan:
+                match = FULL_SCAN_PATTERNS[connection.vendor].search(line)
+                if match and match.group("table") in tables:
+                    self.fail(f"Full scan of {match.group('table')}:\n{query['sql']}")
+                if not allow_sort and SORT_PATTERNS[connection.vendor].search(line):
+                    self.fail(f"Sort instead of index order:\n{query['sql']}")
+        return response
+
+
+# Positions for a (date, id) keyset ordering that no cursor encodes
+MALFORMED_POSITIONS = [
+    ["not-a-date", 1],
+    ["2024-02-30", 1],
+    [None, 1],
+    [{"date": "2024-01-01"}, 1],
+    ["2024-01-01", "not-an-id"],
+    ["2024-01-01", None],
+    ["2024-01-01", [1]],
+    ["2024-01-01", 10**30],
+    ["2024-01-01"],
+]
+
+
+class CursorAssertions:
+    """Assertions on the keyset cursors an endpoint accepts."""
+
+    def assertMalformedCursorsNotFound(self, url):
+        for position in MALFORMED_POSITIONS:
+            cursor = base64.urlsafe_b64encode(
+                json.dumps({"p": position, "r": 0}).encode()
+            ).decode()
+            with self.subTest(position=position):
+                response = self.client.get(url, {"cursor": cursor})
+                self.assertEqual(response.status_code, 404)
+                self.assertEqual(str(response.data["detail"]), "Invalid cursor")
+
+
+class QueryBudgetAssertions:
+    """Assertions on the number of queries an endpoint runs."""
+
+    def assertQueryBudget(
+        self, budget, method, url, data=None, status_code=200, headers=None
+    ):
+        request = getattr(self.client, method)
+        with CaptureQueriesContext(connection) as context:
+            if data is None:
+                response = request(url, headers=headers)
+            else:
+                response = request(url, data, format="json", headers=headers)
+            if response.streaming:
+                b"".join(response.streaming_content)
+        self.assertEqual(response.status_code, status_code)
+        queries = context.captured_queries
+        self.assertLessEqual(
+            len(queries),
+            budget,
+            f"{method.upper()} {url} ran {len(queries)} queries, "
+            f"over its budget of {budget}:\n"
+            + "\n".join(query["sql"] for query in queries),
+        )
+        return response
+
+
+def post_concurrently(user, url, bodies, threads):
+    """
+    POST every body to url from threads clients started at once, each with
+    its own database connection. Returns the status codes in the order of
+    the bodies and the seconds taken.
+    """
+    codes = [None] * len(bodies)
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(offset):
+        client = APIClient()
+        client.force_authenticate(user)
+        barrier.wait()
+        try:
+            for index in range(offset, len(bodies), threads):
+                codes[index] = client.post(
+                    url, bodies[index], format="json"
+                ).status_code
+        finally:
+            connections.close_all()
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    return codes, time.perf_counter() - started
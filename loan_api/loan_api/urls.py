@@ -17,9 +17,11 @@ Including another URLconf
 
 from django.contrib import admin
 from django.urls import path, include
+from loan_api.metrics import MetricsView
 
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics", MetricsView.as_view(), name="metrics"),
     path("api/users/", include("users.urls")),
     path("api/loans/", include("loans.urls")),
     path("api/payments/", include("payments.urls")),
@@ -13,6 +13,9 @@ class LoanAdmin(admin.ModelAdmin):
         "interest_rate",
         "request_date",
         "maturity_date",
+        "total_debt",
+        "total_paid",
+        "outstanding_balance",
     )
 
 
@@ -1,7 +1,38 @@
 import datetime
+import decimal
 from rest_framework import serializers
 from loan_api.dynamic_serializer import DynamicFieldsModelSerializer
-from loans.models import Loan
+from loans.engine import prime_financials
+from loans.models import (
+    AMOUNT_DIGITS,
+    MAX_AMOUNT,
+    TOTAL_DIGITS,
+    Loan,
+    LoanFinancials,
+    LoanRollup,
+)
+from loans.stress import scenarios_of
+
+
+class LoanListSerializer(serializers.ListSerializer):
+    batch_size = 1000
+
+    def create(self, validated_data):
+        request = self.context["request"]
+        user = request.user
+        ip_address = request.META.get("REMOTE_ADDR")
+        request_date = datetime.date.today()
+        loans = prime_financials(
+            Loan(user=user, ip_address=ip_address, request_date=request_date, **data)
+            for data in validated_data
+        )
+        # bulk_create skips Loan.save, so the stored balances are filled here
+        for loan in loans:
+            loan.total_debt = loan.financials.debt
+            loan.outstanding_balance = loan.total_debt - loan.total_paid
+        loans = Loan.objects.bulk_create(loans, batch_size=self.batch_size)
+        LoanRollup.objects.add_loans(loans)
+        return loans
 
 
 class LoanSerializer(DynamicFieldsModelSerializer):
@@ -11,6 +42,15 @@ class LoanSerializer(DynamicFieldsModelSerializer):
     outstanding_balance = serializers.SerializerMethodField("get_balance")
     total_debt = serializers.SerializerMethodField("get_total_debt")
 
+    # Columns read by the computed fields, for sparse fieldsets
+    computed_sources = {
+        "total_installments": ("request_date", "maturity_date"),
+        "total_interest": LoanFinancials.INPUT_FIELDS,
+        "total_debt": LoanFinancials.INPUT_FIELDS,
+        "total_paid": ("total_paid",),
+        "outstanding_balance": (*LoanFinancials.INPUT_FIELDS, "total_paid"),
+    }
+
     class Meta:
         model = Loan
         fields = (
@@ -29,6 +69,7 @@ class LoanSerializer(DynamicFieldsModelSerializer):
             "outstanding_balance",
         )
         read_only_fields = ("id", "user", "ip_address", "request_date")
+        list_serializer_class = LoanListSerializer
 
     def create(self, validated_data):
         if self.is_valid():
@@ -70,6 +111,27 @@ class LoanSerializer(DynamicFieldsModelSerializer):
             )
         return interest_rate
 
+    def validate(self, data):
+        # The debt has to fit the stored amounts, and to be computable at all
+        inputs = {"request_date": datetime.date.today()}
+        if self.instance is not None:
+            inputs.update(
+                (name, getattr(self.instance, name))
+                for name in LoanFinancials.INPUT_FIELDS
+            )
+        inputs.update(
+            (name, data[name]) for name in LoanFinancials.INPUT_FIELDS if name in data
+        )
+        try:
+            debt = Loan(**inputs).financials.debt
+        except decimal.DecimalException:
+            debt = None
+        if debt is None or debt >= MAX_AMOUNT:
+            raise serializers.ValidationError(
+                {"detail": "Loan total debt is too large"}
+            )
+        return data
+
     def get_total_installments(self, obj):
         return obj.get_total_installments
 
@@ -84,3 +146,108 @@ class LoanSerializer(DynamicFieldsModelSerializer):
 
     def get_total_debt(self, obj):
         return obj.get_total_debt
+
+
+class BankSummarySerializer(serializers.Serializer):
+    bank = serializers.CharField()
+    loans = serializers.IntegerField()
+    nominal_value = serializers.DecimalField(max_digits=TOTAL_DIGITS, decimal_places=2)
+    total_debt = serializers.DecimalField(max_digits=TOTAL_DIGITS, decimal_places=2)
+    total_paid = serializers.DecimalField(max_digits=TOTAL_DIGITS, decimal_places=2)
+    outstanding_balance = serializers.DecimalField(
+        max_digits=TOTAL_DIGITS, decimal_places=2
+    )
+
+
+class LoanSummarySerializer(serializers.Serializer):
+    loans = serializers.IntegerField()
+    nominal_value = serializers.DecimalField(max_digits=TOTAL_DIGITS, decimal_places=2)
+    total_debt = serializers.DecimalField(max_digits=TOTAL_DIGITS, decimal_places=2)
+    total_paid = serializers.DecimalField(max_digits=TOTAL_DIGITS, decimal_places=2)
+    outstanding_balance = serializers.DecimalField(
+        max_digits=TOTAL_DIGITS, decimal_places=2
+    )
+    banks = BankSummarySerializer(many=True)
+
+
+class MonthSummarySerializer(serializers.Serializer):
+    month = serializers.DateField()
+    loans = serializers.IntegerField()
+    nominal_value = serializers.DecimalField(max_digits=TOTAL_DIGITS, decimal_places=2)
+    total_debt = serializers.DecimalField(max_digits=TOTAL_DIGITS, decimal_places=2)
+    total_paid = serializers.DecimalField(max_digits=TOTAL_DIGITS, decimal_places=2)
+    outstanding_balance = serializers.DecimalField(
+        max_digits=TOTAL_DIGITS, decimal_places=2
+    )
+
+
+class RollupSummarySerializer(LoanSummarySerializer):
+    months = MonthSummarySerializer(many=True)
+
+
+class InstallmentSerializer(serializers.Serializer):
+    number = serializers.IntegerField()
+    due_date = serializers.DateField()
+    principal = serializers.DecimalField(max_digits=AMOUNT_DIGITS, decimal_places=2)
+    interest = serializers.DecimalField(max_digits=AMOUNT_DIGITS, decimal_places=2)
+    iof = serializers.DecimalField(max_digits=AMOUNT_DIGITS, decimal_places=2)
+    amount = serializers.DecimalField(max_digits=AMOUNT_DIGITS, decimal_places=2)
+    remaining_balance = serializers.DecimalField(
+        max_digits=AMOUNT_DIGITS, decimal_places=2
+    )
+    paid = serializers.DecimalField(max_digits=AMOUNT_DIGITS, decimal_places=2)
+    status = serializers.CharField()
+
+
+class StressTestSerializer(serializers.Serializer):
+    MAX_SCENARIOS = 100
+
+    rate_shocks = serializers.ListField(
+        child=serializers.IntegerField(min_value=-10000, max_value=10000),
+        default=list,
+    )
+    term_adjustments = serializers.ListField(
+        child=serializers.IntegerField(min_value=-600, max_value=600),
+        default=list,
+    )
+
+    def validate(self, data):
+        scenarios = scenarios_of(data["rate_shocks"], data["term_adjustments"])
+        if len(scenarios) > self.MAX_SCENARIOS:
+            raise serializers.ValidationError(
+                {"detail": f"At most {self.MAX_SCENARIOS} scenarios are allowed"}
+            )
+        data["scenarios"] = scenarios
+        return data
+
+
+class ExposureSerializer(serializers.Serializer):
+    loans = serializers.IntegerField()
+    nominal_value = serializers.DecimalField(max_digits=TOTAL_DIGITS, decimal_places=2)
+    total_interest = serializers.DecimalField(max_digits=TOTAL_DIGITS, decimal_places=2)
+    total_debt = serializers.DecimalField(max_digits=TOTAL_DIGITS, decimal_places=2)
+    outstanding_balance = serializers.DecimalField(
+        max_digits=TOTAL_DIGITS, decimal_places=2
+    )
+
+
+class BankExposureSerializer(ExposureSerializer):
+    bank = serializers.CharField()
+
+
+class MaturityExposureSerializer(ExposureSerializer):
+    maturity = serializers.CharField()
+
+
+class ScenarioExposureSerializer(ExposureSerializer):
+    name = serializers.CharField()
+    rate_shock = serializers.IntegerField()
+    term_adjustment = serializers.IntegerField()
+    banks = BankExposureSerializer(many=True)
+    maturities = MaturityExposureSerializer(many=True)
+
+
+class StressTestReportSerializer(serializers.Serializer):
+    as_of = serializers.DateField()
+    loans = serializers.IntegerField()
+    scenarios = ScenarioExposureSerializer(many=True)
@@ -1,14 +1,42 @@
+from functools import partial
 from rest_framework.viewsets import ReadOnlyModelViewSet
 from rest_framework.permissions import IsAuthenticated
+from loans.engine import prime_financials
 from loans.models import Loan
 from loans.api.serializers import LoanSerializer
+from loan_api.compiled_serializer import CompiledListMixin
 from loan_api.paginations import CustomPagination
+from loan_api.replica import ReplicaReadMixin
+from loan_api.response_cache import ResponseCacheMixin
 
 
-class LoanViewSet(ReadOnlyModelViewSet):
+class LoanViewSet(
+    ReplicaReadMixin, ResponseCacheMixin, CompiledListMixin, ReadOnlyModelViewSet
+):
     permission_classes = [IsAuthenticated]
     pagination_class = CustomPagination
     serializer_class = LoanSerializer
+    keyset_ordering = ("-request_date", "id")
+    # Figures prime_financials works out for a whole page at once
+    primed_fields = {
+        "total_debt",
+        "total_installments",
+        "total_interest",
+        "outstanding_balance",
+    }
 
     def get_queryset(self):
-        return Loan.objects.filter(user=self.request.user).order_by("-request_date")
+        return Loan.objects.filter(user=self.request.user).order_by(
+            *self.keyset_ordering
+        )
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(
+            request, partial(super().list, request, *args, **kwargs)
+        )
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None and self.primed_fields & self.read_plan.names:
+            return prime_financials(page)
+        return page
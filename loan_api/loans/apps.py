@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class LoansConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'loans'
+
+    def ready(self):
+        # Connects the signals that invalidate the cached responses
+        from loan_api import response_cache  # noqa: F401
+
+        # Registers the system check of the replica pins
+        from loan_api import replica  # noqa: F401
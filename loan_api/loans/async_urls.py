@@ -0,0 +1,16 @@
+from django.urls import path
+from loans import async_views
+
+urlpatterns = [
+    path("list/", async_views.AsyncLoanList.as_view(), name="loan_list-list"),
+    path(
+        "<int:id>/",
+        async_views.AsyncLoanView.as_view(),
+        name="loan_get_patch_delete",
+    ),
+    path(
+        "<int:id>/outstanding_balance/",
+        async_views.AsyncOutstandingBalance.as_view(),
+        name="loan_get_outstanding_balance",
+    ),
+]
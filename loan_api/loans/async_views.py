@@ -0,0 +1,56 @@
+from loan_api.async_views import AsyncReadView
+from loan_api.compiled_serializer import get_read_plan, get_request_plan, project
+from loan_api.conditional import aconditional_get, make_etag
+from loan_api.ownership import aget_owned_object_or_404
+from loan_api.paginations import CustomPagination
+from loans.api.serializers import LoanSerializer
+from loans.api.viewsets import LoanViewSet
+from loans.engine import prime_financials
+from loans.models import Loan
+from loans.views import GetOutstandingBalance, LoanView
+
+
+class AsyncLoanView(AsyncReadView):
+    sync_view = staticmethod(LoanView.as_view())
+
+    def get_plan(self, request):
+        return get_request_plan(request, LoanSerializer)
+
+    async def get(self, request, id):
+        plan = self.get_plan(request)
+        loan = await aget_owned_object_or_404(
+            project(Loan.objects, plan, "version"), request.user, pk=id
+        )
+        return await aconditional_get(
+            request,
+            make_etag(request, loan.pk, loan.version),
+            lambda: self.respond(plan, loan),
+        )
+
+    async def respond(self, plan, loan):
+        return self.render(plan.represent(loan))
+
+
+class AsyncOutstandingBalance(AsyncLoanView):
+    sync_view = staticmethod(GetOutstandingBalance.as_view())
+
+    def get_plan(self, request):
+        return get_read_plan(LoanSerializer, GetOutstandingBalance.FIELDS)
+
+
+class AsyncLoanList(AsyncReadView):
+    sync_view = staticmethod(LoanViewSet.as_view({"get": "list"}))
+    keyset_ordering = LoanViewSet.keyset_ordering
+
+    async def get(self, request):
+        plan = get_request_plan(request, LoanSerializer)
+        ordering = [field.lstrip("-") for field in self.keyset_ordering]
+        loans = project(Loan.objects.filter(user=request.user), plan, *ordering)
+        paginator = CustomPagination()
+        page = await paginator.apaginate_queryset(
+            loans.order_by(*self.keyset_ordering), request, view=self
+        )
+        if LoanViewSet.primed_fields & plan.names:
+            page = prime_financials(page)
+        data = plan.represent_many(page)
+        return self.render(paginator.get_paginated_response(data).data)
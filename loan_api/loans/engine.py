@@ -0,0 +1,190 @@
+"""
+Vectorized evaluation of loan figures for whole batches of loans.
+
+Every figure is computed with NumPy over columnar arrays and rounded to
+integer cents. A row whose unrounded value lands too close to a half cent
+for float64 to settle the rounding is evaluated again with the exact
+Decimal formulas of LoanFinancials, so the results always match the
+per-instance ones to the cent. That is the case of every amount past what
+float64 holds to the cent, so when one of those does not fit in int64
+either, the batch holds Python ints instead.
+"""
+
+from decimal import Decimal
+from types import SimpleNamespace
+import numpy as np
+from loans import finance
+from loans.models import LoanFinancials
+
+IOF_TAX = float(finance.IOF_RATE)
+DAILY_AMORTIZATION = float(finance.IOF_DAILY_RATE)
+PORTFOLIO_FIELDS = (
+    "id",
+    "nominal_value",
+    "interest_rate",
+    "request_date",
+    "maturity_date",
+    "total_paid",
+)
+
+# Bound on the relative error of each float64 operation, with some headroom
+# for the conversions of the inputs
+EPSILON = 4 * np.finfo(np.float64).eps
+# Cents up to this bound leave room in int64 for the sum of two of them
+INT64_CENTS = 2**62
+
+
+class LoanBatch:
+    MONEY_FIELDS = ("iof", "total_interest", "total_debt", "outstanding_balance")
+
+    def __init__(self, installments, iof, total_interest, total_debt, total_paid):
+        self.installments = installments
+        self.iof = iof
+        self.total_interest = total_interest
+        self.total_debt = total_debt
+        self.total_paid = total_paid
+        self.outstanding_balance = total_debt - total_paid
+
+    def __len__(self):
+        return len(self.installments)
+
+    def as_decimals(self, field):
+        return [Decimal(int(cents)).scaleb(-2) for cents in getattr(self, field)]
+
+
+def to_cents(values):
+    cents = np.rint(np.fromiter(map(float, values), np.float64, len(values)) * 100)
+    if np.abs(cents).max(initial=0) < 2**52:
+        return cents.astype(np.int64)
+    # Past 2**52 cents a float64 no longer holds every cent
+    return cents_array(
+        [int(Decimal(value).scaleb(2).to_integral_value()) for value in values]
+    )
+
+
+def cents_array(cents):
+    """An int64 array of cents, or one of Python ints if int64 cannot hold them."""
+    if all(-INT64_CENTS < value < INT64_CENTS for value in cents):
+        return np.array(cents, dtype=np.int64)
+    return np.array(cents, dtype=object)
+
+
+def to_days_and_months(dates):
+    days = np.fromiter((date.toordinal() for date in dates), np.int64, len(dates))
+    months = np.fromiter(
+        (date.year * 12 + date.month for date in dates), np.int64, len(dates)
+    )
+    return days, months
+
+
+def round_cents(values, error):
+    """Round float cents half to even and flag the rows too close to call."""
+    rounded = np.rint(values)
+    ambiguous = np.abs(np.abs(values - np.trunc(values)) - 0.5) <= error
+    return rounded, ambiguous | ~np.isfinite(values)
+
+
+def evaluate(
+    nominal_values, interest_rates, request_dates, maturity_dates, total_paid=None
+):
+    nominal_cents = to_cents(nominal_values)
+    paid_cents = (
+        to_cents(total_paid)
+        if total_paid is not None
+        else np.zeros(len(nominal_cents), dtype=np.int64)
+    )
+    nominal = nominal_cents.astype(np.float64) / 100
+    rate = np.fromiter(map(float, interest_rates), dtype=np.float64) / 100
+    requested_days, requested_months = to_days_and_months(request_dates)
+    maturity_days, maturity_months = to_days_and_months(maturity_dates)
+    installments = maturity_months - requested_months
+    total_days = maturity_days - requested_days
+
+    tax = nominal * IOF_TAX
+    amortization = nominal * total_days * DAILY_AMORTIZATION
+    iof_cents = (tax + amortization) * 100
+    iof, iof_ambiguous = round_cents(iof_cents, iof_cents * EPSILON + 1e-9)
+
+    with np.errstate(over="ignore", invalid="ignore"):
+        compound = nominal * (1 + rate) ** installments
+        interest, interest_ambiguous = round_cents(
+            (compound - nominal) * 100 + iof,
+            (compound * 100 + iof) * EPSILON * (np.abs(installments) + 4) + 1e-9,
+        )
+
+    iof = np.where(iof_ambiguous, 0, iof).astype(np.int64)
+    interest = np.where(interest_ambiguous, 0, interest).astype(np.int64)
+    exact = {}
+    for row in np.flatnonzero(iof_ambiguous | interest_ambiguous):
+        financials = LoanFinancials(
+            SimpleNamespace(
+                nominal_value=Decimal(nominal_values[row]),
+                interest_rate=Decimal(interest_rates[row]),
+                request_date=request_dates[row],
+                maturity_date=maturity_dates[row],
+                total_paid=0,
+            )
+        )
+        exact[row] = (
+            int(financials.iof.scaleb(2)),
+            int(financials.interest.scaleb(2)),
+        )
+    wide = nominal_cents.dtype == object or paid_cents.dtype == object
+    if wide or any(
+        abs(cents) >= INT64_CENTS for figures in exact.values() for cents in figures
+    ):
+        nominal_cents, paid_cents, iof, interest = (
+            array.astype(object) for array in (nominal_cents, paid_cents, iof, interest)
+        )
+    for row, (iof_cents, interest_cents) in exact.items():
+        iof[row] = iof_cents
+        interest[row] = interest_cents
+
+    return LoanBatch(
+        installments=installments,
+        iof=iof,
+        total_interest=interest,
+        total_debt=nominal_cents + interest,
+        total_paid=paid_cents,
+    )
+
+
+def evaluate_rows(rows):
+    """Evaluate rows laid out as PORTFOLIO_FIELDS, as read by iter_portfolio."""
+    _, nominal_values, interest_rates, request_dates, maturity_dates, paid = zip(*rows)
+    return evaluate(nominal_values, interest_rates, request_dates, maturity_dates, paid)
+
+
+def iter_portfolio(queryset, chunk_size=10000):
+    """Yield (ids, LoanBatch) pairs for a queryset, chunk_size loans at a time."""
+    last_id = 0
+    queryset = queryset.order_by("pk").values_list(*PORTFOLIO_FIELDS)
+    while True:
+        rows = list(queryset.filter(pk__gt=last_id)[:chunk_size])
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield [row[0] for row in rows], evaluate_rows(rows)
+
+
+def prime_financials(loans):
+    """Fill the financial snapshot of loaded loans with one vectorized pass."""
+    loans = list(loans)
+    if not loans:
+        return loans
+    batch = evaluate(
+        [loan.nominal_value for loan in loans],
+        [loan.interest_rate for loan in loans],
+        [loan.request_date for loan in loans],
+        [loan.maturity_date for loan in loans],
+    )
+    iof = batch.as_decimals("iof")
+    interest = batch.as_decimals("total_interest")
+    for index, loan in enumerate(loans):
+        financials = loan.financials
+        financials.__dict__.update(
+            installments=int(batch.installments[index]),
+            iof=iof[index],
+            interest=interest[index],
+        )
+    return loans
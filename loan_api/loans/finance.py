@@ -0,0 +1,55 @@
+"""
+Money formulas of a loan, shared by LoanFinancials, the payment checks and
+the vectorized engine.
+
+Rates are percentages, as stored on Loan. The IOF rates are exact Decimal
+constants, so the tax is worked out without the error of a float rate and
+amounts landing on a half cent round half to even like any other.
+
+The compound factor (1 + rate / 100) ** installments is kept in a bounded
+LRU cache keyed by (rate, installments). Loans are taken at a few dozen
+rates and terms, so most of them find their factor there already.
+compound_factor.cache_info() counts the hits and misses, and they are
+published on /metrics. Factors are cached as worked out under the decimal
+context in force, the default 28 digit one.
+"""
+
+from decimal import Decimal
+from functools import lru_cache
+
+IOF_RATE = Decimal("0.0038")
+IOF_DAILY_RATE = Decimal("0.000082")
+HUNDRED = Decimal(100)
+COMPOUND_FACTOR_CACHE_SIZE = 1024
+
+
+def installments(request_date, maturity_date):
+    return (maturity_date.month - request_date.month) + (
+        (maturity_date.year - request_date.year) * 12
+    )
+
+
+def iof(nominal_value, request_date, maturity_date):
+    total_days = (maturity_date - request_date).days
+    tax = nominal_value * IOF_RATE
+    amortization = nominal_value * total_days * IOF_DAILY_RATE
+    return round(tax + amortization, 2)
+
+
+@lru_cache(maxsize=COMPOUND_FACTOR_CACHE_SIZE)
+def compound_factor(interest_rate, installments):
+    return (1 + interest_rate / HUNDRED) ** installments
+
+
+def interest(nominal_value, interest_rate, installments, iof):
+    """Interest compounded monthly over the installments, plus the IOF."""
+    compounded = nominal_value * compound_factor(interest_rate, installments)
+    return round(compounded - nominal_value + iof, 2)
+
+
+def debt(nominal_value, interest):
+    return nominal_value + interest
+
+
+def balance(debt, paid):
+    return debt - paid
@@ -0,0 +1,234 @@
+import datetime
+import http.client
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from rest_framework.authtoken.models import Token
+from loans.models import Loan
+from payments.models import Payment
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve a throwaway test database with gunicorn (WSGI) and with uvicorn "
+        "(ASGI), send the same concurrent reads to both and report the "
+        "throughput and latency of each"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=32,
+            help="Number of clients reading at the same time",
+        )
+        parser.add_argument(
+            "--requests",
+            type=int,
+            default=2000,
+            help="Number of requests sent to each server",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of worker processes of each server",
+        )
+        parser.add_argument(
+            "--loans",
+            type=int,
+            default=20,
+            help="Number of loans of the user reading",
+        )
+        parser.add_argument(
+            "--host",
+            default="0.0.0.0",
+            help="Address the servers listen on, one of ALLOWED_HOSTS",
+        )
+
+    def handle(self, *args, **options):
+        if options["concurrency"] < 1 or options["requests"] < 1:
+            raise CommandError("--concurrency and --requests must be positive")
+
+        database_name = connection.settings_dict["NAME"]
+        with tempfile.TemporaryDirectory() as directory:
+            if connection.vendor == "sqlite":
+                # The servers run in their own processes, so the test
+                # database cannot live in memory
+                test_settings = connection.settings_dict["TEST"]
+                test_settings["NAME"] = os.path.join(directory, "benchmark.db")
+            connection.creation.create_test_db(
+                verbosity=0, autoclobber=True, serialize=False
+            )
+            try:
+                token, urls = self.create_data(options["loans"])
+                wsgi_rate, asgi_rate = [
+                    self.run_server(label, command, token, urls, options)
+                    for label, command in self.servers(options)
+                ]
+            finally:
+                connection.creation.destroy_test_db(database_name, verbosity=0)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"uvicorn/gunicorn throughput: {asgi_rate / wsgi_rate:.2f}x"
+            )
+        )
+
+    def servers(self, options):
+        workers = str(options["workers"])
+        return [
+            (
+                "gunicorn (WSGI)",
+                lambda host, port: [
+                    "gunicorn",
+                    f"--bind={host}:{port}",
+                    f"--workers={workers}",
+                    "loan_api.wsgi",
+                ],
+            ),
+            (
+                "uvicorn (ASGI)",
+                lambda host, port: [
+                    "uvicorn",
+                    f"--host={host}",
+                    f"--port={port}",
+                    f"--workers={workers}",
+                    "--no-access-log",
+                    "loan_api.asgi:application",
+                ],
+            ),
+        ]
+
+    def create_data(self, quantity):
+        user = User.objects.create(
+            username="benchmark",
+            email="benchmark@test.com",
+            password="benchmark",
+        )
+        today = datetime.date.today()
+        loans = [
+            Loan.objects.create(
+                user=user,
+                nominal_value=Decimal(10000),
+                ip_address="0.0.0.0",
+                interest_rate=Decimal(2),
+                bank="Bank Benchmark",
+                maturity_date=datetime.date(today.year + 1, today.month, 1),
+            )
+            for _ in range(quantity)
+        ]
+        for loan in loans:
+            for _ in range(5):
+                Payment.objects.create(loan=loan, date=today, value=Decimal(100))
+
+        loan = loans[0].pk
+        urls = [
+            f"/api/loans/{loan}/",
+            f"/api/loans/{loan}/outstanding_balance/",
+            "/api/loans/list/",
+            "/api/payments/list_all/",
+            f"/api/payments/list/{loan}/",
+        ]
+        return Token.objects.get(user=user).key, urls
+
+    def run_server(self, label, command, token, urls, options):
+        port = free_port(options["host"])
+        environment = {
+            **os.environ,
+            "DB_ENV": connection.settings_dict["NAME"],
+            # Every request would be logged at the rates benchmarked
+            "SQL_INSTRUMENTATION_ENV": "off",
+        }
+        server = subprocess.Popen(
+            [sys.executable, "-m", *command(options["host"], port)],
+            cwd=settings.BASE_DIR,
+            env=environment,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_until_serving(options["host"], port, server)
+            codes, latencies, elapsed = read_concurrently(
+                options["host"], port, token, urls, options
+            )
+        finally:
+            server.terminate()
+            server.wait()
+
+        failed = len(codes) - codes.count(200)
+        rate = len(codes) / elapsed
+        quantiles = statistics.quantiles(latencies, n=100)
+        self.stdout.write(
+            f"{label}: {len(codes)} requests in {elapsed:.2f}s ({rate:.1f}/s), "
+            f"p50 {quantiles[49] * 1000:.1f}ms, p99 {quantiles[98] * 1000:.1f}ms"
+        )
+        if failed:
+            raise CommandError(f"{label}: {failed} requests failed: {set(codes)}")
+        return rate
+
+
+def free_port(host):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_serving(host, port, server, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise CommandError(f"{server.args[2]} exited with {server.returncode}")
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise CommandError(f"{server.args[2]} did not start in {timeout}s")
+
+
+def read_concurrently(host, port, token, urls, options):
+    """
+    GET urls in turn from concurrency clients started at once, over kept
+    alive connections, until requests have been sent. Returns the status
+    codes, the seconds each request took and the seconds taken overall.
+    """
+    requests = options["requests"]
+    concurrency = options["concurrency"]
+    codes = [None] * requests
+    latencies = [None] * requests
+    barrier = threading.Barrier(concurrency + 1)
+    headers = {"Authorization": f"Token {token}"}
+
+    def worker(offset):
+        client = http.client.HTTPConnection(host, port, timeout=60)
+        barrier.wait()
+        try:
+            for index in range(offset, requests, concurrency):
+                started = time.perf_counter()
+                client.request("GET", urls[index % len(urls)], headers=headers)
+                response = client.getresponse()
+                response.read()
+                latencies[index] = time.perf_counter() - started
+                codes[index] = response.status
+        finally:
+            client.close()
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    return codes, latencies, time.perf_counter() - started
@@ -0,0 +1,122 @@
+import datetime
+import time
+from decimal import Decimal
+from random import Random
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (
+    override_settings,
+    setup_test_environment,
+    teardown_test_environment,
+)
+from rest_framework.test import APIClient
+from loans.models import Loan
+from users.models import User
+
+PROJECTIONS = [
+    ("all fields", None),
+    ("raw columns", "id,bank,maturity_date"),
+    ("total paid", "id,total_paid"),
+    ("outstanding balance", "id,outstanding_balance"),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Read the loan list and loan detail with sparse fieldsets in a "
+        "throwaway test database, and report the time and size of each "
+        "response against the full one"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--loans",
+            type=int,
+            default=1000,
+            help="Number of loans of the user reading",
+        )
+        parser.add_argument(
+            "--page-size",
+            type=int,
+            default=100,
+            help="Number of loans in each page of the list",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=50,
+            help="Number of times each request is sent",
+        )
+
+    def handle(self, *args, **options):
+        if min(options["loans"], options["page_size"], options["repeat"]) < 1:
+            raise CommandError("--loans, --page-size and --repeat must be positive")
+
+        database_name = connection.settings_dict["NAME"]
+        setup_test_environment()
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        try:
+            # Every repeated request would be answered from the cache
+            with override_settings(RESPONSE_CACHE={"ENABLED": False}):
+                client = APIClient()
+                client.force_authenticate(self.create_loans(options["loans"]))
+                loan = Loan.objects.order_by("pk").first()
+                self.compare(
+                    "list",
+                    client,
+                    f"/api/loans/list/?page_size={options['page_size']}",
+                    options["repeat"],
+                )
+                self.compare(
+                    "detail", client, f"/api/loans/{loan.pk}/", options["repeat"]
+                )
+        finally:
+            connection.creation.destroy_test_db(database_name, verbosity=0)
+            teardown_test_environment()
+
+    def compare(self, label, client, url, repeat):
+        baseline = None
+        for projection, fields in PROJECTIONS:
+            if fields is not None:
+                separator = "&" if "?" in url else "?"
+                url_with_fields = f"{url}{separator}fields={fields}"
+            else:
+                url_with_fields = url
+            response = client.get(url_with_fields)
+            if response.status_code != 200:
+                raise CommandError(f"{label} {projection}: {response.status_code}")
+
+            started = time.perf_counter()
+            for _ in range(repeat):
+                client.get(url_with_fields)
+            elapsed = (time.perf_counter() - started) / repeat
+            baseline = baseline or elapsed
+            self.stdout.write(
+                f"{label}, {projection}: {elapsed * 1000:.2f}ms, "
+                f"{len(response.content)} bytes ({baseline / elapsed:.1f}x)"
+            )
+
+    def create_loans(self, quantity):
+        user = User.objects.create(
+            username="benchmark",
+            email="benchmark@test.com",
+            password="benchmark",
+        )
+        random = Random(0)
+        today = datetime.date.today()
+        Loan.objects.bulk_create(
+            Loan(
+                user=user,
+                nominal_value=Decimal(random.randint(1, 10**8)).scaleb(-2),
+                ip_address="0.0.0.0",
+                interest_rate=Decimal(random.randint(1, 500)).scaleb(-2),
+                bank="Bank Benchmark",
+                request_date=today,
+                maturity_date=today + datetime.timedelta(random.randint(30, 3650)),
+                total_paid=Decimal(random.randint(0, 10**5)).scaleb(-2),
+            )
+            for _ in range(quantity)
+        )
+        return user
@@ -0,0 +1,109 @@
+import datetime
+import time
+from decimal import Decimal
+from random import Random
+from django.core.management.base import BaseCommand, CommandError
+from loans import finance
+
+
+def float_rate_figures(nominal_value, interest_rate, request_date, maturity_date):
+    """IOF and interest as LoanFinancials worked them out before loans.finance."""
+    total_days = (maturity_date - request_date).days
+    iof = round(
+        nominal_value * Decimal(0.38 / 100)
+        + nominal_value * total_days * Decimal(0.0082 / 100),
+        2,
+    )
+    installments = finance.installments(request_date, maturity_date)
+    total_debt = nominal_value * ((1 + interest_rate / 100) ** installments)
+    return iof, round(total_debt - nominal_value + iof, 2)
+
+
+def kernel_figures(nominal_value, interest_rate, request_date, maturity_date):
+    iof = finance.iof(nominal_value, request_date, maturity_date)
+    installments = finance.installments(request_date, maturity_date)
+    return iof, finance.interest(nominal_value, interest_rate, installments, iof)
+
+
+class Command(BaseCommand):
+    help = (
+        "Work out the IOF and interest of a portfolio of loans with the float "
+        "rate formulas and with the loans.finance kernel, and report the time "
+        "each takes per loan and the hits of the compound factor cache"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--loans",
+            type=int,
+            default=20000,
+            help="Number of loans in the portfolio",
+        )
+        parser.add_argument(
+            "--pairs",
+            type=int,
+            default=40,
+            help="Number of distinct (rate, term) pairs the loans are taken at",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="Number of times the portfolio is worked out",
+        )
+
+    def handle(self, *args, **options):
+        if min(options["loans"], options["pairs"], options["repeat"]) < 1:
+            raise CommandError("--loans, --pairs and --repeat must be positive")
+
+        loans = self.portfolio(Random(0), options["loans"], options["pairs"])
+        differing = sum(
+            float_rate_figures(*loan) != kernel_figures(*loan) for loan in loans
+        )
+
+        repeat = options["repeat"]
+        float_rate_time = timed(float_rate_figures, loans, repeat)
+        finance.compound_factor.cache_clear()
+        kernel_time = timed(kernel_figures, loans, repeat)
+        info = finance.compound_factor.cache_info()
+        self.stdout.write(
+            f"float rates, uncached factor: {float_rate_time * 1e6:.2f}us per loan"
+        )
+        self.stdout.write(
+            f"kernel: {kernel_time * 1e6:.2f}us per loan "
+            f"({float_rate_time / kernel_time:.1f}x), "
+            f"{info.hits} cache hits, {info.misses} misses"
+        )
+        self.stdout.write(
+            f"{differing} of {len(loans)} loans differ, on IOF amounts of an "
+            "exact half cent"
+        )
+
+    def portfolio(self, random, quantity, pairs):
+        today = datetime.date.today()
+        terms = [
+            (Decimal(random.randint(50, 500)).scaleb(-2), random.randint(1, 120) * 30)
+            for _ in range(pairs)
+        ]
+        loans = []
+        for _ in range(quantity):
+            interest_rate, days = random.choice(terms)
+            request_date = today - datetime.timedelta(random.randint(0, 365))
+            loans.append(
+                (
+                    Decimal(random.randint(1, 10**8)).scaleb(-2),
+                    interest_rate,
+                    request_date,
+                    request_date + datetime.timedelta(days),
+                )
+            )
+        return loans
+
+
+def timed(function, loans, repeat):
+    """Seconds function takes per loan, on average over repeat passes."""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for loan in loans:
+            function(*loan)
+    return (time.perf_counter() - started) / (repeat * len(loans))
@@ -0,0 +1,128 @@
+import datetime
+import time
+from decimal import Decimal
+from random import Random
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from loan_api.compiled_serializer import get_read_plan
+from loans.api.serializers import LoanSerializer
+from loans.engine import prime_financials
+from loans.models import Loan
+from payments.api.serializers import PaymentSerializer
+from payments.models import Payment
+
+
+class Command(BaseCommand):
+    help = (
+        "Serialize pages of loans and payments with the REST framework "
+        "serializers and with their compiled read plans, check that both "
+        "render the same bytes and report the time each takes per page"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows",
+            type=int,
+            default=100,
+            help="Number of rows in each page",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=200,
+            help="Number of times each page is serialized",
+        )
+
+    def handle(self, *args, **options):
+        if options["rows"] < 1 or options["repeat"] < 1:
+            raise CommandError("--rows and --repeat must be positive")
+
+        random = Random(0)
+        loans = prime_financials(self.loans(random, options["rows"]))
+        payments = self.payments(random, options["rows"])
+        rows = self.values(payments)
+        balance_fields = {"id", "user", "outstanding_balance"}
+        scenarios = [
+            (
+                "loans",
+                lambda: LoanSerializer(loans, many=True).data,
+                lambda: get_read_plan(LoanSerializer).represent_many(loans),
+            ),
+            (
+                "loan balances",
+                lambda: LoanSerializer(loans, many=True, fields=balance_fields).data,
+                lambda: get_read_plan(LoanSerializer, balance_fields).represent_many(
+                    loans
+                ),
+            ),
+            (
+                "payments",
+                lambda: PaymentSerializer(payments, many=True).data,
+                lambda: get_read_plan(PaymentSerializer).represent_many(payments),
+            ),
+            (
+                "payment values",
+                lambda: PaymentSerializer(payments, many=True).data,
+                lambda: get_read_plan(PaymentSerializer).represent_values(rows),
+            ),
+        ]
+        for label, serialize, compiled in scenarios:
+            self.compare(label, serialize, compiled, options["repeat"])
+
+    def compare(self, label, serialize, compiled, repeat):
+        renderer = JSONRenderer()
+        if renderer.render(compiled()) != renderer.render(serialize()):
+            raise CommandError(f"{label}: compiled output differs")
+
+        serializer_time = timed(serialize, repeat)
+        compiled_time = timed(compiled, repeat)
+        self.stdout.write(
+            f"{label}: serializer {serializer_time * 1000:.2f}ms, "
+            f"compiled {compiled_time * 1000:.2f}ms per page "
+            f"({serializer_time / compiled_time:.1f}x), same output"
+        )
+
+    def loans(self, random, quantity):
+        today = datetime.date.today()
+        return [
+            Loan(
+                id=number,
+                user_id=1,
+                bank="Bank Benchmark",
+                ip_address="0.0.0.0",
+                nominal_value=Decimal(random.randint(1, 10**8)).scaleb(-2),
+                interest_rate=Decimal(random.randint(1, 500)).scaleb(-2),
+                request_date=today,
+                maturity_date=today + datetime.timedelta(random.randint(30, 3650)),
+                total_paid=Decimal(random.randint(0, 10**5)).scaleb(-2),
+            )
+            for number in range(1, quantity + 1)
+        ]
+
+    def payments(self, random, quantity):
+        today = datetime.date.today()
+        return [
+            Payment(
+                id=number,
+                loan_id=random.randint(1, 100),
+                date=today - datetime.timedelta(random.randint(0, 365)),
+                value=Decimal(random.randint(1, 10**6)).scaleb(-2),
+            )
+            for number in range(1, quantity + 1)
+        ]
+
+    def values(self, payments):
+        """The payments as the dicts a values() queryset of them yields."""
+        fields = get_read_plan(PaymentSerializer).value_fields
+        return [
+            {field: payment.serializable_value(field) for field in fields}
+            for payment in payments
+        ]
+
+
+def timed(function, repeat):
+    """Seconds function takes per call, on average over repeat calls."""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - started) / repeat
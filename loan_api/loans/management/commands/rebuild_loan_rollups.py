@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from loans.models import LoanRollup
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the loan rollups per bank and month with a recomputation "
+        "from the loans table, and rebuild them from it"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Only report the drift, without rebuilding the rollups",
+        )
+
+    def handle(self, *args, **options):
+        drift = LoanRollup.objects.drift()
+        for bank, month, field, stored, expected in drift:
+            self.stdout.write(
+                f"{bank} {month:%Y-%m}: {field} stored as {stored}, "
+                f"expected {expected}"
+            )
+        message = f"{len(drift)} rollup totals with drift"
+        if drift:
+            self.stdout.write(self.style.WARNING(message))
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
+
+        if not options["check"]:
+            LoanRollup.objects.rebuild()
+            self.stdout.write(self.style.SUCCESS("Rollups rebuilt"))
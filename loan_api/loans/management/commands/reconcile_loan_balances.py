@@ -0,0 +1,81 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from loan_api.response_cache import GLOBAL, invalidate
+from loans.models import Loan, LoanRollup, new_version
+
+STORED_FIELDS = ("total_debt", "total_paid", "outstanding_balance", "version")
+
+
+class Command(BaseCommand):
+    help = "Recalculate the stored loan balances from the payments table"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of loans read and updated per transaction",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report the drift, without fixing the stored values",
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        checked = drifted = 0
+        last_id = 0
+
+        while True:
+            with transaction.atomic():
+                # Locked before the payments are summed, so that payments
+                # posted meanwhile wait for the fix and add to it
+                ids = list(
+                    Loan.objects.select_for_update()
+                    .filter(pk__gt=last_id)
+                    .order_by("pk")
+                    .values_list("pk", flat=True)[:chunk_size]
+                )
+                loans = list(
+                    Loan.objects.with_financials().filter(pk__in=ids).order_by("pk")
+                )
+                if not loans:
+                    break
+
+                stale_loans = [loan for loan in loans if self.reconcile(loan)]
+                if stale_loans and not options["dry_run"]:
+                    Loan.objects.bulk_update(stale_loans, STORED_FIELDS)
+
+            checked += len(loans)
+            drifted += len(stale_loans)
+            last_id = loans[-1].pk
+
+        if drifted and not options["dry_run"]:
+            LoanRollup.objects.rebuild()
+            invalidate(GLOBAL)
+        message = f"{checked} loans checked, {drifted} with drift"
+        if drifted:
+            self.stdout.write(self.style.WARNING(message))
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
+
+    def reconcile(self, loan):
+        expected = {
+            "total_debt": loan.financials.debt,
+            "total_paid": loan.financials.paid,
+            "outstanding_balance": loan.financials.balance,
+        }
+        drift = {
+            field: (getattr(loan, field), value)
+            for field, value in expected.items()
+            if getattr(loan, field) != value
+        }
+        for field, (stored, value) in drift.items():
+            self.stdout.write(
+                f"Loan {loan.pk}: {field} stored as {stored}, expected {value}"
+            )
+            setattr(loan, field, value)
+        if drift:
+            loan.version = new_version()
+        return bool(drift)
@@ -0,0 +1,71 @@
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Value
+from loan_api.response_cache import GLOBAL, invalidate
+from loans.engine import PORTFOLIO_FIELDS, evaluate_rows, iter_portfolio
+from loans.models import Loan, LoanRollup, new_version
+
+
+class Command(BaseCommand):
+    help = "Revalue the whole loan portfolio and report its totals"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=10000,
+            help="Number of loans read and evaluated per batch",
+        )
+        parser.add_argument(
+            "--save",
+            action="store_true",
+            help="Store the revalued total debt and outstanding balance",
+        )
+
+    def handle(self, *args, **options):
+        loans = 0
+        totals = dict.fromkeys(
+            ("total_debt", "total_interest", "total_paid", "outstanding_balance"), 0
+        )
+
+        for ids, batch in iter_portfolio(Loan.objects, options["chunk_size"]):
+            loans += len(batch)
+            for field in totals:
+                # As Python ints, which never overflow
+                totals[field] += sum(getattr(batch, field).tolist())
+            if options["save"]:
+                self.save(ids)
+
+        if options["save"]:
+            LoanRollup.objects.rebuild()
+            invalidate(GLOBAL)
+        self.stdout.write(f"{loans} loans revalued")
+        for field, cents in totals.items():
+            self.stdout.write(f"{field}: {Decimal(cents).scaleb(-2)}")
+
+    def save(self, ids):
+        with transaction.atomic():
+            # Read again under lock, so that loans whose terms changed since
+            # the batch was read are stored with their current debt
+            rows = list(
+                Loan.objects.select_for_update()
+                .filter(pk__in=ids)
+                .order_by("pk")
+                .values_list(*PORTFOLIO_FIELDS)
+            )
+            if not rows:
+                return
+            total_debt = evaluate_rows(rows).as_decimals("total_debt")
+            Loan.objects.bulk_update(
+                [
+                    Loan(
+                        pk=row[0],
+                        total_debt=total_debt[index],
+                        outstanding_balance=Value(total_debt[index]) - F("total_paid"),
+                        version=new_version(),
+                    )
+                    for index, row in enumerate(rows)
+                ],
+                ("total_debt", "outstanding_balance", "version"),
+            )
@@ -0,0 +1,73 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from loans.models import Loan
+from loans.stress import EXPOSURE_FIELDS, StressTest, scenarios_of
+
+
+class Command(BaseCommand):
+    help = (
+        "Revalue the whole loan portfolio under every combination of the rate "
+        "shocks and term adjustments given, in a pool of worker processes, and "
+        "report the exposure of each scenario per bank and per maturity"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rate-shock",
+            type=int,
+            action="append",
+            default=[],
+            help="Basis points added to every interest rate, may be repeated",
+        )
+        parser.add_argument(
+            "--term-adjustment",
+            type=int,
+            action="append",
+            default=[],
+            help="Months added to every maturity date, may be repeated",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=settings.STRESS_TEST["CHUNK_SIZE"],
+            help="Number of loans read and sent to a worker at a time",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Number of worker processes, one per CPU by default",
+        )
+
+    def handle(self, *args, **options):
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive")
+        if options["workers"] is not None and options["workers"] < 1:
+            raise CommandError("--workers must be positive")
+
+        scenarios = scenarios_of(options["rate_shock"], options["term_adjustment"])
+        started = time.perf_counter()
+        report = (
+            StressTest(scenarios)
+            .run(Loan.objects, options["chunk_size"], options["workers"])
+            .report()
+        )
+        elapsed = time.perf_counter() - started
+
+        for scenario in report["scenarios"]:
+            self.stdout.write(self.style.MIGRATE_HEADING(scenario["name"]))
+            self.write_exposure("total", scenario)
+            for bank in scenario["banks"]:
+                self.write_exposure(f"bank {bank['bank']}", bank)
+            for maturity in scenario["maturities"]:
+                self.write_exposure(f"maturity {maturity['maturity']}", maturity)
+        self.stdout.write(
+            f"{report['loans']} loans under {len(scenarios)} scenarios in "
+            f"{elapsed:.2f}s ({report['loans'] * len(scenarios) / elapsed:.0f} "
+            "revaluations/s)"
+        )
+
+    def write_exposure(self, label, exposure):
+        figures = ", ".join(f"{field} {exposure[field]}" for field in EXPOSURE_FIELDS)
+        self.stdout.write(f"  {label}: {figures}")
@@ -0,0 +1,59 @@
+# Generated by Django 5.0.3 on 2026-10-18 13:11
+
+from decimal import Decimal, DecimalException
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def populate_stored_balances(apps, schema_editor):
+    Loan = apps.get_model("loans", "Loan")
+    loans = Loan.objects.annotate(paid=Sum("payment__value"))
+    for loan in loans.iterator(chunk_size=1000):
+        total_days = (loan.maturity_date - loan.request_date).days
+        iof = round(
+            loan.nominal_value * Decimal(0.38 / 100)
+            + loan.nominal_value * total_days * Decimal(0.0082 / 100),
+            2,
+        )
+        period = (loan.maturity_date.month - loan.request_date.month) + (
+            (loan.maturity_date.year - loan.request_date.year) * 12
+        )
+        compound = loan.nominal_value * ((1 + loan.interest_rate / 100) ** period)
+        try:
+            loan.total_debt = loan.nominal_value + round(
+                compound - loan.nominal_value + iof, 2
+            )
+        except DecimalException:
+            # Debts past the Decimal context were never computable, those
+            # loans keep the zero defaults
+            continue
+        loan.total_paid = loan.paid or Decimal(0)
+        loan.outstanding_balance = loan.total_debt - loan.total_paid
+        loan.save(update_fields=["total_debt", "total_paid", "outstanding_balance"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loans', '0003_alter_loan_maturity_date'),
+        ('payments', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loan',
+            name='outstanding_balance',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=28, verbose_name='Outstanding balance'),
+        ),
+        migrations.AddField(
+            model_name='loan',
+            name='total_debt',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=28, verbose_name='Total debt'),
+        ),
+        migrations.AddField(
+            model_name='loan',
+            name='total_paid',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=28, verbose_name='Total paid'),
+        ),
+        migrations.RunPython(populate_stored_balances, migrations.RunPython.noop),
+    ]
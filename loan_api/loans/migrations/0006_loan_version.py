@@ -0,0 +1,21 @@
+# Generated by Django 5.0.3 on 2026-10-18 13:39
+
+import loans.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("loans", "0005_loan_user_request_date_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="loan",
+            name="version",
+            field=models.BigIntegerField(
+                default=loans.models.new_version, editable=False
+            ),
+        ),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 5.0.3 on 2026-10-18 14:16
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import Mod, TruncMonth
+
+ROLLUP_SHARDS = 16
+ROLLUP_FIELDS = ("nominal_value", "total_debt", "total_paid", "outstanding_balance")
+
+
+def populate_loan_rollups(apps, schema_editor):
+    Loan = apps.get_model("loans", "Loan")
+    LoanRollup = apps.get_model("loans", "LoanRollup")
+    rows = (
+        Loan.objects.annotate(
+            month=TruncMonth("request_date"),
+            shard=Mod("id", ROLLUP_SHARDS, output_field=models.IntegerField()),
+        )
+        .order_by()
+        .values("bank", "month", "shard")
+        .annotate(
+            loans=Count("id"),
+            **{
+                field: Sum(
+                    field,
+                    output_field=models.DecimalField(decimal_places=2, max_digits=38),
+                )
+                for field in ROLLUP_FIELDS
+            },
+        )
+    )
+    LoanRollup.objects.bulk_create(
+        (LoanRollup(**{**row, "shard": int(row["shard"])}) for row in rows),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("loans", "0006_loan_version"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LoanRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("bank", models.CharField(max_length=100)),
+                ("month", models.DateField()),
+                ("shard", models.PositiveSmallIntegerField()),
+                ("loans", models.IntegerField(default=0)),
+                (
+                    "nominal_value",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=38),
+                ),
+                (
+                    "total_debt",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=38),
+                ),
+                (
+                    "total_paid",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=38),
+                ),
+                (
+                    "outstanding_balance",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=38),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="loanrollup",
+            constraint=models.UniqueConstraint(
+                fields=("bank", "month", "shard"), name="loan_rollup_key"
+            ),
+        ),
+        migrations.RunPython(populate_loan_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,76 @@
+from collections import defaultdict
+from decimal import Decimal, DecimalException
+from django.db import migrations
+from django.db.models import F
+from loans import finance
+from loans.models import new_version
+
+ROLLUP_SHARDS = 16
+MAX_AMOUNT = Decimal(10) ** 26
+
+
+def recompute_stored_balances(apps, schema_editor):
+    """
+    Store again the total debt and outstanding balance of every loan, as
+    loans.finance works them out. 0004 stored them with the float IOF rates,
+    which leaves a cent of difference on loans whose IOF lands on a half
+    cent. The rollups are moved by the same amounts.
+    """
+    Loan = apps.get_model("loans", "Loan")
+    LoanRollup = apps.get_model("loans", "LoanRollup")
+    changes = defaultdict(Decimal)
+    fixed = []
+    loans = Loan.objects.order_by("pk").only(
+        "bank",
+        "request_date",
+        "maturity_date",
+        "nominal_value",
+        "interest_rate",
+        "total_debt",
+        "total_paid",
+        "outstanding_balance",
+    )
+    for loan in loans.iterator(chunk_size=1000):
+        try:
+            iof = finance.iof(loan.nominal_value, loan.request_date, loan.maturity_date)
+            interest = finance.interest(
+                loan.nominal_value,
+                loan.interest_rate,
+                finance.installments(loan.request_date, loan.maturity_date),
+                iof,
+            )
+            total_debt = finance.debt(loan.nominal_value, interest)
+        except DecimalException:
+            continue
+        if total_debt == loan.total_debt or total_debt >= MAX_AMOUNT:
+            continue
+        delta = total_debt - loan.total_debt
+        loan.total_debt = total_debt
+        loan.outstanding_balance += delta
+        loan.version = new_version()
+        fixed.append(loan)
+        key = (loan.bank, loan.request_date.replace(day=1), loan.pk % ROLLUP_SHARDS)
+        changes[key] += delta
+        if len(fixed) >= 1000:
+            Loan.objects.bulk_update(
+                fixed, ["total_debt", "outstanding_balance", "version"]
+            )
+            fixed = []
+    Loan.objects.bulk_update(fixed, ["total_debt", "outstanding_balance", "version"])
+
+    for (bank, month, shard), delta in sorted(changes.items()):
+        LoanRollup.objects.filter(bank=bank, month=month, shard=shard).update(
+            total_debt=F("total_debt") + delta,
+            outstanding_balance=F("outstanding_balance") + delta,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("loans", "0007_loan_rollup"),
+    ]
+
+    operations = [
+        migrations.RunPython(recompute_stored_balances, migrations.RunPython.noop),
+    ]
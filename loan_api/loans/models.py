@@ -1,8 +1,85 @@
+import datetime
+import secrets
 from decimal import Decimal
-from django.db import models
-from django.db.models import Sum
+from django.db import connections, models, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Mod, TruncMonth
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.functional import cached_property
+from loans import finance
 from payments.models import Payment
 
+# Digits of the stored amounts of a loan: as many as the formulas of
+# loans.finance work out under the default Decimal context
+AMOUNT_DIGITS = 28
+MAX_AMOUNT = Decimal(10) ** (AMOUNT_DIGITS - 2)
+# Digits of the totals over many loans, wider than the amounts of any one
+TOTAL_DIGITS = 38
+
+
+def total_of(field):
+    return Sum(
+        field,
+        output_field=models.DecimalField(decimal_places=2, max_digits=TOTAL_DIGITS),
+    )
+
+
+def new_version():
+    """
+    A fresh change marker for a loan. It is drawn at random rather than
+    counted up, so writes that never read the current one, like the
+    QuerySet.update below, can still replace it with an unused value.
+    """
+    return secrets.randbits(62)
+
+
+def payments_total():
+    payments_sum = (
+        Payment.objects.filter(loan=OuterRef("pk"))
+        .order_by()
+        .values("loan")
+        .annotate(total=Sum("value"))
+        .values("total")
+    )
+    return Coalesce(
+        Subquery(payments_sum),
+        Value(Decimal(0)),
+        output_field=models.DecimalField(decimal_places=2, max_digits=AMOUNT_DIGITS),
+    )
+
+
+class LoanQuerySet(models.QuerySet):
+    def with_financials(self):
+        return self.annotate(paid_amount=payments_total())
+
+    def summary_by_bank(self):
+        return (
+            self.order_by("bank")
+            .values("bank")
+            .annotate(
+                loans=Count("id"),
+                nominal_value=total_of("nominal_value"),
+                total_debt=total_of("total_debt"),
+                total_paid=total_of("total_paid"),
+                outstanding_balance=total_of("outstanding_balance"),
+            )
+        )
+
+    def add_payment_value(self, value, version=None):
+        return self.update(
+            total_paid=F("total_paid") + value,
+            outstanding_balance=F("outstanding_balance") - value,
+            version=version or new_version(),
+        )
+
+    def recalculate_total_paid(self):
+        return self.update(
+            total_paid=payments_total(),
+            outstanding_balance=F("total_debt") - payments_total(),
+            version=new_version(),
+        )
+
 
 class Loan(models.Model):
     nominal_value = models.DecimalField(
@@ -15,47 +92,401 @@ class Loan(models.Model):
     request_date = models.DateField(auto_now_add=True)
     maturity_date = models.DateField(blank=False)
     bank = models.CharField(max_length=100)
-    user = models.ForeignKey("users.User", on_delete=models.CASCADE)
+    # loan_user_request_date_idx leads with the user, and serves its lookups
+    user = models.ForeignKey("users.User", on_delete=models.CASCADE, db_index=False)
+    total_debt = models.DecimalField(
+        verbose_name="Total debt",
+        decimal_places=2,
+        max_digits=AMOUNT_DIGITS,
+        default=0,
+    )
+    total_paid = models.DecimalField(
+        verbose_name="Total paid",
+        decimal_places=2,
+        max_digits=AMOUNT_DIGITS,
+        default=0,
+    )
+    outstanding_balance = models.DecimalField(
+        verbose_name="Outstanding balance",
+        decimal_places=2,
+        max_digits=AMOUNT_DIGITS,
+        default=0,
+    )
+    # Replaced on every write to the loan or to its payments
+    version = models.BigIntegerField(default=new_version, editable=False)
+
+    objects = LoanQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["user", "-request_date", "id"],
+                name="loan_user_request_date_idx",
+            ),
+        ]
+
+    _financials = None
+
+    def save(self, *args, **kwargs):
+        if self.request_date is None:
+            self.request_date = datetime.date.today()
+        if self._financials is not None and (
+            self._financials.inputs != LoanFinancials.inputs_of(self)
+        ):
+            self.invalidate_financials()
+
+        self.total_debt = self.financials.debt
+        self.version = new_version()
+        if kwargs.get("update_fields") is not None:
+            kwargs["update_fields"] = {
+                *kwargs["update_fields"],
+                "total_debt",
+                "outstanding_balance",
+                "version",
+            }
+        with transaction.atomic(savepoint=False):
+            previous = None
+            if not self._state.adding:
+                previous = (
+                    Loan.objects.select_for_update()
+                    .only(*ROLLUP_COLUMNS)
+                    .filter(pk=self.pk)
+                    .first()
+                )
+            if previous is not None and previous.total_paid != self.total_paid:
+                # Payments move the stored total with F() updates, the one
+                # loaded with this instance may be behind it
+                self.total_paid = previous.total_paid
+                self.invalidate_financials(payments_changed=True)
+            self.outstanding_balance = self.total_debt - self.total_paid
+            super().save(*args, **kwargs)
+            LoanRollup.objects.add_loan_change(previous, self)
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self.invalidate_financials(payments_changed=True)
 
     @property
-    def get_total_installments(self):
-        request_date = self.request_date
-        maturity_date = self.maturity_date
-        total_installments = (maturity_date.month - request_date.month) + (
-            ((maturity_date.year - request_date.year) * 12)
-        )
-        return total_installments
+    def financials(self):
+        if self._financials is None:
+            self._financials = LoanFinancials(self)
+        return self._financials
+
+    def invalidate_financials(self, payments_changed=False):
+        self._financials = None
+        if payments_changed:
+            self.__dict__.pop("paid_amount", None)
 
     def calculate_iof(self):
-        iof_tax = Decimal(0.38 / 100)
-        daily_amortization = Decimal(0.0082 / 100)
-        total_days = (self.maturity_date - self.request_date).days
-        tax = self.nominal_value * iof_tax
-        amortization = self.nominal_value * total_days * daily_amortization
-        return round(tax + amortization, 2)
+        return self.financials.iof
+
+    @property
+    def get_total_installments(self):
+        return self.financials.installments
 
     @property
     def get_total_interest(self):
-        iof_tax = self.calculate_iof()
-        initial_value = self.nominal_value
-        interest_rate = self.interest_rate / 100
-        period = self.get_total_installments
-        total_debt = initial_value * ((1 + interest_rate) ** period)
-        total_interest = total_debt - initial_value
-        return round(total_interest + iof_tax, 2)
+        return self.financials.interest
 
     @property
     def get_total_paid(self):
-        total_paid = Payment.objects.filter(loan=self.id).aggregate(Sum("value"))
-        if total_paid["value__sum"]:
-            return total_paid["value__sum"]
-        return 0
+        return self.financials.paid
 
     @property
     def get_balance(self):
-        total_debt = self.nominal_value + self.get_total_interest
-        return total_debt - self.get_total_paid
+        return self.financials.balance
 
     @property
     def get_total_debt(self):
-        return self.nominal_value + self.get_total_interest
+        return self.financials.debt
+
+
+class LoanFinancials:
+    """Derived figures of a loan, each computed once on first access."""
+
+    INPUT_FIELDS = ("nominal_value", "interest_rate", "request_date", "maturity_date")
+
+    def __init__(self, loan):
+        self.loan = loan
+        self.inputs = self.inputs_of(loan)
+
+    @classmethod
+    def inputs_of(cls, loan):
+        # Columns deferred by only() are left out rather than loaded, a
+        # figure that needs them loads them when it is worked out
+        return tuple(loan.__dict__.get(field) for field in cls.INPUT_FIELDS)
+
+    @cached_property
+    def installments(self):
+        return finance.installments(self.loan.request_date, self.loan.maturity_date)
+
+    @cached_property
+    def iof(self):
+        return finance.iof(
+            self.loan.nominal_value, self.loan.request_date, self.loan.maturity_date
+        )
+
+    @cached_property
+    def interest(self):
+        return finance.interest(
+            self.loan.nominal_value,
+            self.loan.interest_rate,
+            self.installments,
+            self.iof,
+        )
+
+    @cached_property
+    def debt(self):
+        return finance.debt(self.loan.nominal_value, self.interest)
+
+    @cached_property
+    def paid(self):
+        # Rows loaded through with_financials() carry the sum straight from
+        # the payments table, the others rely on the stored column
+        if "paid_amount" in self.loan.__dict__:
+            total_paid = self.loan.paid_amount
+        else:
+            total_paid = self.loan.total_paid
+        if total_paid:
+            return total_paid
+        return 0
+
+    @cached_property
+    def balance(self):
+        return finance.balance(self.debt, self.paid)
+
+
+ROLLUP_SHARDS = 16
+ROLLUP_FIELDS = ("nominal_value", "total_debt", "total_paid", "outstanding_balance")
+ROLLUP_COLUMNS = ("bank", "request_date", *ROLLUP_FIELDS)
+
+
+def rollup_key(loan):
+    """The LoanRollup row of a loan: its bank, request month and shard."""
+    return loan.bank, loan.request_date.replace(day=1), loan.pk % ROLLUP_SHARDS
+
+
+def add_change(changes, key, deltas):
+    totals = changes.setdefault(key, dict.fromkeys(("loans", *ROLLUP_FIELDS), 0))
+    for field, delta in deltas.items():
+        totals[field] += delta
+
+
+def loan_changes(changes, loans, sign):
+    for loan in loans:
+        add_change(
+            changes,
+            rollup_key(loan),
+            {
+                "loans": sign,
+                **{field: sign * getattr(loan, field) for field in ROLLUP_FIELDS},
+            },
+        )
+    return changes
+
+
+class LoanRollupQuerySet(models.QuerySet):
+    def add(self, changes):
+        """
+        Add to each rollup row the deltas of its fields, given by changes as
+        {rollup key: {field: delta}}, creating the rows missing. It is a
+        single upsert, which locks the rows in key order so that writers
+        never wait on each other in a cycle.
+        """
+        columns = ("loans", *ROLLUP_FIELDS)
+        rows = [
+            (*key, *(deltas[field] for field in columns))
+            for key, deltas in sorted(changes.items())
+            if any(deltas.values())
+        ]
+        if not rows:
+            return
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        table = quote(self.model._meta.db_table)
+        key = ", ".join(map(quote, ("bank", "month", "shard")))
+        row = "({})".format(", ".join(["%s"] * len(rows[0])))
+        totals = ", ".join(
+            f"{column} = {table}.{column} + EXCLUDED.{column}"
+            for column in map(quote, columns)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} ({key}, {', '.join(map(quote, columns))}) "
+                f"VALUES {', '.join([row] * len(rows))} "
+                f"ON CONFLICT ({key}) DO UPDATE SET {totals}",
+                [value for row in rows for value in row],
+            )
+
+    def add_loans(self, loans, sign=1):
+        self.add(loan_changes({}, loans, sign))
+
+    def add_loan_change(self, previous, loan):
+        """Move the rollups from the stored values of a loan to its new ones."""
+        changes = loan_changes({}, [previous] if previous else [], -1)
+        self.add(loan_changes(changes, [loan], 1))
+
+    def add_payments(self, payments):
+        """Add payments given as (loan, value) pairs to the rollups."""
+        changes = {}
+        for loan, value in payments:
+            add_change(
+                changes,
+                rollup_key(loan),
+                {"total_paid": value, "outstanding_balance": -value},
+            )
+        self.add(changes)
+
+    def summary(self, *fields):
+        """Totals per fields, of the groups holding any loan."""
+        return (
+            self.order_by(*fields)
+            .values(*fields)
+            .annotate(
+                loans=Sum("loans"),
+                **{field: total_of(field) for field in ROLLUP_FIELDS},
+            )
+            .filter(loans__gt=0)
+        )
+
+    def recompute(self):
+        """Totals of the loans table per rollup key, worked out from scratch."""
+        rows = (
+            Loan.objects.annotate(
+                month=TruncMonth("request_date"),
+                shard=Mod("id", ROLLUP_SHARDS, output_field=models.IntegerField()),
+            )
+            .order_by()
+            .values("bank", "month", "shard")
+            .annotate(
+                loans=Count("id"),
+                **{field: total_of(field) for field in ROLLUP_FIELDS},
+            )
+        )
+        return {
+            (row.pop("bank"), row.pop("month"), int(row.pop("shard"))): row
+            for row in rows
+        }
+
+    def rebuild(self):
+        """Replace every rollup row with a recomputation from the loans."""
+        with transaction.atomic():
+            # Deleted first, so that writers holding rows are waited for and
+            # their loans are in the recomputation
+            self.all().delete()
+            self.bulk_create(
+                LoanRollup(bank=bank, month=month, shard=shard, **totals)
+                for (bank, month, shard), totals in self.recompute().items()
+            )
+
+    def drift(self):
+        """
+        (bank, month, field, stored, expected) for every total of a bank and
+        month that differs from a recomputation from the loans.
+        """
+        stored = {}
+        for row in self.values("bank", "month", "loans", *ROLLUP_FIELDS):
+            add_change(stored, (row.pop("bank"), row.pop("month")), row)
+        expected = {}
+        for (bank, month, _), totals in self.recompute().items():
+            add_change(expected, (bank, month), totals)
+        drift = []
+        for key in sorted(stored.keys() | expected.keys()):
+            zero = dict.fromkeys(("loans", *ROLLUP_FIELDS), 0)
+            for field in zero:
+                stored_value = stored.get(key, zero)[field]
+                expected_value = expected.get(key, zero)[field]
+                if stored_value != expected_value:
+                    drift.append((*key, field, stored_value, expected_value))
+        return drift
+
+
+class LoanRollup(models.Model):
+    """
+    Totals of the loans taken at a bank in a month, split in ROLLUP_SHARDS
+    rows by loan id. Every write to a loan or to its payments adds what it
+    changes to the row of the loan, in its own transaction. Shards keep
+    payments to different loans of a bank and month from queueing on one
+    row, and readers add them up.
+    """
+
+    bank = models.CharField(max_length=100)
+    month = models.DateField()
+    shard = models.PositiveSmallIntegerField()
+    loans = models.IntegerField(default=0)
+    nominal_value = models.DecimalField(
+        decimal_places=2, max_digits=TOTAL_DIGITS, default=0
+    )
+    total_debt = models.DecimalField(
+        decimal_places=2, max_digits=TOTAL_DIGITS, default=0
+    )
+    total_paid = models.DecimalField(
+        decimal_places=2, max_digits=TOTAL_DIGITS, default=0
+    )
+    outstanding_balance = models.DecimalField(
+        decimal_places=2, max_digits=TOTAL_DIGITS, default=0
+    )
+
+    objects = LoanRollupQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["bank", "month", "shard"], name="loan_rollup_key"
+            ),
+        ]
+
+
+@receiver(post_save, sender=Payment)
+def add_payment_to_loan(sender, instance=None, created=False, **kwargs):
+    loans = Loan.objects.filter(pk=instance.loan_id)
+    if created:
+        version = new_version()
+        loans.add_payment_value(instance.value, version)
+        refresh_cached_loan(instance, value=instance.value, version=version)
+        LoanRollup.objects.add_payments([(payment_loan(instance), instance.value)])
+    else:
+        with transaction.atomic(savepoint=False):
+            previous = loans.select_for_update().only(*ROLLUP_COLUMNS).get()
+            loans.recalculate_total_paid()
+            LoanRollup.objects.add_loan_change(
+                previous, loans.only(*ROLLUP_COLUMNS).get()
+            )
+        refresh_cached_loan(instance)
+
+
+@receiver(post_delete, sender=Payment)
+def remove_payment_from_loan(sender, instance=None, origin=None, **kwargs):
+    # Payments deleted along with their loans, or with the user owning them,
+    # leave no balance to update
+    if getattr(origin, "model", type(origin)) is not Payment:
+        return
+    version = new_version()
+    Loan.objects.filter(pk=instance.loan_id).add_payment_value(-instance.value, version)
+    refresh_cached_loan(instance, value=-instance.value, version=version)
+    LoanRollup.objects.add_payments([(payment_loan(instance), -instance.value)])
+
+
+@receiver(post_delete, sender=Loan)
+def remove_loan_from_rollups(sender, instance=None, **kwargs):
+    LoanRollup.objects.add_loans([instance], sign=-1)
+
+
+def payment_loan(payment):
+    """The loan of payment, loaded with its rollup key if it is not yet."""
+    if Payment.loan.is_cached(payment):
+        return payment.loan
+    return Loan.objects.only("bank", "request_date").get(pk=payment.loan_id)
+
+
+def refresh_cached_loan(payment, value=None, version=None):
+    if not Payment.loan.is_cached(payment):
+        return
+    loan = payment.loan
+    if value is None:
+        loan.refresh_from_db(fields=["total_paid", "outstanding_balance", "version"])
+    else:
+        loan.total_paid += value
+        loan.outstanding_balance -= value
+        loan.version = version
+    loan.invalidate_financials(payments_changed=True)
@@ -0,0 +1,138 @@
+"""
+Installment schedule of a loan.
+
+The debt follows LoanFinancials: the nominal value compounds monthly at the
+interest rate over the installments, and the IOF is charged on top. Each
+installment repays an equal share of the nominal value plus the interest
+compounded during its month, and the first one also carries the IOF.
+Amounts are rounded on their running totals and the last installment takes
+the stored figures as they are, so the schedule adds up to the loan's total
+interest and total debt to the cent.
+
+The total paid is applied to the installments in order, oldest first.
+"""
+
+import calendar
+import datetime
+from decimal import Decimal
+from itertools import islice
+from typing import NamedTuple
+
+CENTS = Decimal("0.01")
+ZERO = Decimal("0.00")
+
+PAID = "paid"
+PARTIALLY_PAID = "partially_paid"
+UNPAID = "unpaid"
+
+
+class Installment(NamedTuple):
+    number: int
+    due_date: datetime.date
+    principal: Decimal
+    interest: Decimal
+    iof: Decimal
+    amount: Decimal
+    remaining_balance: Decimal
+    paid: Decimal
+    status: str
+
+
+def add_months(date, months):
+    month = date.month - 1 + months
+    year = date.year + month // 12
+    month = month % 12 + 1
+    day = min(date.day, calendar.monthrange(year, month)[1])
+    return datetime.date(year, month, day)
+
+
+def installment_count(loan):
+    # A loan maturing in the month it was requested is paid in one go
+    return max(loan.financials.installments, 1)
+
+
+def iter_schedule(loan, start=0):
+    """
+    Yield the installments of loan from the one at index start on. The ones
+    before it are still worked out, as each amount depends on the running
+    totals, but only a few figures are kept while doing so.
+    """
+    financials = loan.financials
+    count = installment_count(loan)
+    nominal_value = loan.nominal_value
+    growth = 1 + loan.interest_rate / 100
+    total_interest = financials.interest - financials.iof
+    total_paid = Decimal(financials.paid)
+
+    factor = Decimal(1)
+    principal_so_far = interest_so_far = due_so_far = ZERO
+    for number in range(1, count + 1):
+        factor *= growth
+        if number == count:
+            principal_to_date = nominal_value
+            interest_to_date = total_interest
+        else:
+            principal_to_date = (nominal_value * number / count).quantize(CENTS)
+            interest_to_date = (nominal_value * (factor - 1)).quantize(CENTS)
+        principal = principal_to_date - principal_so_far
+        interest = interest_to_date - interest_so_far
+        iof = financials.iof if number == 1 else ZERO
+        amount = principal + interest + iof
+        paid = min(max(total_paid - due_so_far, ZERO), amount)
+
+        principal_so_far = principal_to_date
+        interest_so_far = interest_to_date
+        due_so_far += amount
+        if number <= start:
+            continue
+
+        if paid == amount:
+            state = PAID
+        elif paid:
+            state = PARTIALLY_PAID
+        else:
+            state = UNPAID
+        yield Installment(
+            number=number,
+            due_date=(
+                loan.maturity_date
+                if number == count
+                else add_months(loan.request_date, number)
+            ),
+            principal=principal,
+            interest=interest,
+            iof=iof,
+            amount=amount,
+            remaining_balance=financials.debt - due_so_far,
+            paid=paid,
+            status=state,
+        )
+
+
+class Schedule:
+    """
+    The installments of a loan as a read-only sequence, for the paginator.
+    Slicing builds only the installments taken.
+    """
+
+    def __init__(self, loan):
+        self.loan = loan
+
+    def __len__(self):
+        return installment_count(self.loan)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            taken = islice(
+                iter_schedule(self.loan, start), 0, max(stop - start, 0), step
+            )
+            return list(taken)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("installment index out of range")
+        return next(iter_schedule(self.loan, index))
+
+    def __iter__(self):
+        return iter_schedule(self.loan)
@@ -0,0 +1,234 @@
+"""
+Rate shock stress test of the whole portfolio.
+
+A scenario moves the interest rate of every loan by a number of basis
+points and its maturity date by a number of months. Rates are floored at
+zero and maturities at the request date.
+
+The loans are streamed from the database in chunks. Each chunk is revalued
+under every scenario by a worker process, with the vectorized engine. The
+workers send back only their totals per scenario, bank and maturity bucket.
+No more than two chunks per worker are read ahead, which keeps the memory
+bound by the chunk size whatever the size of the portfolio.
+
+The parent only reads the chunks, hands them over and merges the totals,
+so the revaluation scales with the workers. Columns are read as text for
+that: strings are pickled for the workers many times faster than Decimals
+and dates, and the workers parse them.
+"""
+
+import datetime
+import os
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from decimal import Decimal
+from typing import NamedTuple
+import django
+import numpy as np
+from django.db.models import TextField
+from django.db.models.functions import Cast
+from loan_api.exports import iter_chunks
+from loans import engine
+from loans.schedule import add_months
+
+DECIMAL_FIELDS = ("nominal_value", "interest_rate", "total_paid")
+DATE_FIELDS = ("request_date", "maturity_date")
+EXPOSURE_FIELDS = (
+    "loans",
+    "nominal_value",
+    "total_interest",
+    "total_debt",
+    "outstanding_balance",
+)
+MATURED = "matured"
+# Months left to maturity, from the date of the test, up to each bound
+MATURITY_BUCKETS = (
+    (12, "up to 12 months"),
+    (36, "13 to 36 months"),
+    (60, "37 to 60 months"),
+    (None, "over 60 months"),
+)
+BUCKETS = (MATURED, *(label for _, label in MATURITY_BUCKETS))
+BUCKET_BOUNDS = np.array([bound for bound, _ in MATURITY_BUCKETS[:-1]])
+ZERO = Decimal(0)
+
+
+class Scenario(NamedTuple):
+    rate_shock: int = 0
+    term_adjustment: int = 0
+
+    @property
+    def name(self):
+        return f"{self.rate_shock:+d}bps {self.term_adjustment:+d}m"
+
+    def shock_rates(self, interest_rates):
+        if not self.rate_shock:
+            return interest_rates
+        shock = Decimal(self.rate_shock).scaleb(-2)
+        return [max(rate + shock, ZERO) for rate in interest_rates]
+
+    def adjust_maturities(self, request_dates, maturity_dates):
+        if not self.term_adjustment:
+            return maturity_dates
+        return [
+            max(add_months(maturity_date, self.term_adjustment), request_date)
+            for request_date, maturity_date in zip(request_dates, maturity_dates)
+        ]
+
+
+def scenarios_of(rate_shocks, term_adjustments):
+    """Every combination of the rate shocks and term adjustments."""
+    return [
+        Scenario(rate_shock, term_adjustment)
+        for rate_shock in dict.fromkeys(rate_shocks or [0])
+        for term_adjustment in dict.fromkeys(term_adjustments or [0])
+    ]
+
+
+def maturity_buckets(maturity_dates, as_of):
+    """Index in BUCKETS of each maturity date, seen from as_of."""
+    days, months = engine.to_days_and_months(maturity_dates)
+    months_left = months - (as_of.year * 12 + as_of.month)
+    buckets = np.searchsorted(BUCKET_BOUNDS, months_left) + 1
+    return np.where(days <= as_of.toordinal(), 0, buckets)
+
+
+def stress_rows(queryset):
+    """The bank of each loan and its DECIMAL_FIELDS and DATE_FIELDS as text."""
+    fields = {
+        f"{field}_text": Cast(field, output_field=TextField())
+        for field in (*DECIMAL_FIELDS, *DATE_FIELDS)
+    }
+    return queryset.order_by("pk").annotate(**fields).values_list("bank", *fields)
+
+
+def parse_rows(rows):
+    banks, *columns = zip(*rows)
+    decimals = columns[: len(DECIMAL_FIELDS)]
+    dates = columns[len(DECIMAL_FIELDS) :]
+    return (
+        banks,
+        *(list(map(Decimal, column)) for column in decimals),
+        *(list(map(datetime.date.fromisoformat, column)) for column in dates),
+    )
+
+
+def revalue_chunk(rows, scenarios, as_of):
+    """
+    Totals of rows of stress_rows under each scenario, keyed by (scenario
+    index, bank, bucket index) and laid out as EXPOSURE_FIELDS, in cents but
+    for the number of loans.
+    """
+    banks, nominal_values, interest_rates, paid, request_dates, maturity_dates = (
+        parse_rows(rows)
+    )
+    bank_names, bank_index = np.unique(banks, return_inverse=True)
+    nominal_cents = engine.to_cents(nominal_values)
+    totals = {}
+    for number, scenario in enumerate(scenarios):
+        maturities = scenario.adjust_maturities(request_dates, maturity_dates)
+        batch = engine.evaluate(
+            nominal_values,
+            scenario.shock_rates(interest_rates),
+            request_dates,
+            maturities,
+            paid,
+        )
+        groups = bank_index * len(BUCKETS) + maturity_buckets(maturities, as_of)
+        columns = np.stack(
+            [
+                np.ones_like(nominal_cents),
+                nominal_cents,
+                batch.total_interest,
+                batch.total_debt,
+                batch.outstanding_balance,
+            ],
+            axis=1,
+        )
+        # Totals that could run past int64 are added up as Python ints
+        wide = np.abs(columns.astype(np.float64)).sum() >= engine.INT64_CENTS
+        sums = np.zeros(
+            (len(bank_names) * len(BUCKETS), len(EXPOSURE_FIELDS)),
+            object if wide else np.int64,
+        )
+        np.add.at(sums, groups, columns)
+        for group in np.flatnonzero(sums[:, 0]):
+            bank, bucket = divmod(int(group), len(BUCKETS))
+            totals[number, str(bank_names[bank]), bucket] = sums[group].tolist()
+    return totals
+
+
+class StressTest:
+    def __init__(self, scenarios, as_of=None):
+        self.scenarios = list(scenarios)
+        self.as_of = as_of or datetime.date.today()
+        self.loans = 0
+        self.totals = defaultdict(lambda: [0] * len(EXPOSURE_FIELDS))
+
+    def run(self, queryset, chunk_size=10000, workers=None):
+        """Revalue the loans of queryset, chunk_size at a time, in workers."""
+        rows = stress_rows(queryset)
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(workers, initializer=django.setup) as executor:
+            pending = set()
+            for chunk in iter_chunks(rows, chunk_size):
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    self.merge(done)
+                pending.add(
+                    executor.submit(revalue_chunk, chunk, self.scenarios, self.as_of)
+                )
+            self.merge(pending)
+        return self
+
+    def merge(self, futures):
+        for future in futures:
+            for key, values in future.result().items():
+                total = self.totals[key]
+                for index, value in enumerate(values):
+                    total[index] += value
+                if key[0] == 0:
+                    self.loans += values[0]
+
+    def report(self):
+        """The exposure of each scenario, in total, per bank and per bucket."""
+        scenarios = []
+        for number, scenario in enumerate(self.scenarios):
+            banks = defaultdict(lambda: [0] * len(EXPOSURE_FIELDS))
+            buckets = defaultdict(lambda: [0] * len(EXPOSURE_FIELDS))
+            for (key_number, bank, bucket), values in sorted(self.totals.items()):
+                if key_number != number:
+                    continue
+                for totals in (banks[bank], buckets[BUCKETS[bucket]]):
+                    for index, value in enumerate(values):
+                        totals[index] += value
+            scenarios.append(
+                {
+                    "name": scenario.name,
+                    "rate_shock": scenario.rate_shock,
+                    "term_adjustment": scenario.term_adjustment,
+                    **exposure([sum(column) for column in zip(*banks.values())]),
+                    "banks": [
+                        {"bank": bank, **exposure(values)}
+                        for bank, values in banks.items()
+                    ],
+                    "maturities": [
+                        {"maturity": bucket, **exposure(buckets[bucket])}
+                        for bucket in BUCKETS
+                        if bucket in buckets
+                    ],
+                }
+            )
+        return {"as_of": self.as_of, "loans": self.loans, "scenarios": scenarios}
+
+
+def exposure(values):
+    values = list(values) or [0] * len(EXPOSURE_FIELDS)
+    loans, *cents = values
+    return {
+        "loans": loans,
+        **{
+            field: Decimal(total).scaleb(-2)
+            for field, total in zip(EXPOSURE_FIELDS[1:], cents)
+        },
+    }
@@ -1,14 +1,65 @@
+import copy
+import csv
 import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from importlib import import_module
 from decimal import Decimal
-from django.urls import reverse
+from io import StringIO
+from random import Random
+from unittest import mock, skipUnless
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.db.models import F, Sum
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
 from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APITestCase
 from users.models import User
-from loans.models import Loan
-from loans.api.serializers import LoanSerializer
+from loans import engine, finance
+from loans.models import (
+    ROLLUP_FIELDS,
+    Loan,
+    LoanFinancials,
+    LoanRollup,
+    rollup_key,
+)
+from loans.schedule import add_months
+from loans.api.serializers import LoanSerializer, MonthSummarySerializer
+from loan_api.compiled_serializer import ReadPlan, get_read_plan
+from loan_api.exports import iter_chunks
+from loan_api.middleware import QueryInstrumentationMiddleware
+from loan_api.replica import (
+    ReplicaRouter,
+    check_pin_backend,
+    read_database,
+    reading_from,
+    replica_for,
+)
+from prometheus_client import REGISTRY, CollectorRegistry, multiprocess
+from loan_api.testing import (
+    CursorAssertions,
+    QueryBudgetAssertions,
+    QueryPlanAssertions,
+    ReadsFromPrimary,
+    forget_replica_reads,
+)
+from payments.models import Payment
 
 
-class LoanTests(APITestCase):
+class LoanTests(ReadsFromPrimary, CursorAssertions, APITestCase):
     TODAY = datetime.date.today()
     MATURITY_DATE = datetime.date(TODAY.year + 1, TODAY.month, TODAY.day)
     LOAN_PATCH_REQ_BODY = {"interest_rate": 2.50, "nominal_value": 12000.00}
@@ -90,6 +141,41 @@ class LoanTests(APITestCase):
             self.PERMISSION_DENIED_ERROR_MSG,
         )
 
+    def test_get_loan_not_modified(self):
+        for name in ("loan_get_patch_delete", "loan_get_outstanding_balance"):
+            url = reverse(name, args=[self.test_loan.pk])
+            etag = self.client.get(url)["ETag"]
+            with mock.patch.object(ReadPlan, "represent", side_effect=AssertionError):
+                response = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(response["ETag"], etag)
+            self.assertEqual(response.content, b"")
+
+    def test_loan_etag_changes_with_the_loan_and_its_payments(self):
+        url = reverse("loan_get_outstanding_balance", args=[self.test_loan.pk])
+        etags = [self.client.get(url)["ETag"]]
+        self.client.patch(
+            reverse("loan_get_patch_delete", args=[self.test_loan.pk]),
+            self.LOAN_PATCH_REQ_BODY,
+        )
+        etags.append(self.client.get(url)["ETag"])
+        payment = Payment.objects.create(
+            loan=self.test_loan, date=self.TODAY, value=Decimal(10.00)
+        )
+        etags.append(self.client.get(url)["ETag"])
+        payment.delete()
+        etags.append(self.client.get(url)["ETag"])
+        Payment.objects.create(
+            loan=self.test_loan2, date=self.TODAY, value=Decimal(10.00)
+        )
+        etags.append(self.client.get(url)["ETag"])
+        self.assertEqual(len(set(etags[:4])), 4)
+        self.assertEqual(etags[3], etags[4])
+
+        response = self.client.get(url, headers={"If-None-Match": etags[0]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["ETag"], etags[3])
+
     # Tests for patch loans
     def test_patch_valid_loan(self):
         response = self.client.patch(
@@ -247,6 +333,62 @@ class LoanTests(APITestCase):
         )
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
 
+    def post_bulk_loans(self, loans):
+        return self.client.post(reverse("create_new_loans_bulk"), loans, format="json")
+
+    def test_post_bulk_loans(self):
+        loans = [
+            dict(self.LOAN_POST_REQ_BODY, nominal_value=1000.00 * (index + 1))
+            for index in range(3)
+        ]
+        response = self.post_bulk_loans(loans)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data), 3)
+        for result, body in zip(response.data, loans):
+            loan = Loan.objects.get(pk=result["id"])
+            self.assertEqual(loan.user, self.test_user)
+            self.assertEqual(loan.ip_address, "127.0.0.1")
+            self.assertEqual(loan.request_date, self.TODAY)
+            self.assertEqual(loan.nominal_value, Decimal(body["nominal_value"]))
+            self.assertEqual(
+                result,
+                LoanSerializer(
+                    loan, fields={"id", "total_debt", "total_installments"}
+                ).data,
+            )
+            self.assertEqual(loan.total_debt, result["total_debt"])
+            self.assertEqual(loan.outstanding_balance, result["total_debt"])
+
+    def test_post_bulk_loans_with_an_invalid_loan(self):
+        invalid_loan = dict(self.LOAN_POST_REQ_BODY, interest_rate=-2.5)
+        response = self.post_bulk_loans([self.LOAN_POST_REQ_BODY, invalid_loan])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data[0], {})
+        self.assertEqual(
+            str(response.data[1]["interest_rate"]["detail"]),
+            self.INVALID_INTEREST_RATE_ERROR_MSG,
+        )
+        self.assertEqual(Loan.objects.count(), 2)
+
+    def test_post_bulk_loans_that_is_not_a_list(self):
+        response = self.post_bulk_loans(self.LOAN_POST_REQ_BODY)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Loan.objects.count(), 2)
+
+    def test_post_bulk_loans_with_query_count_independent_of_loans(self):
+        queries = []
+        for quantity in (5, 50):
+            with CaptureQueriesContext(connection) as context:
+                response = self.post_bulk_loans([self.LOAN_POST_REQ_BODY] * quantity)
+            self.assertEqual(len(response.data), quantity)
+            queries.append(len(context.captured_queries))
+        self.assertEqual(queries[0], queries[1])
+
+    def test_post_bulk_loans_without_a_token(self):
+        self.client.logout()
+        response = self.post_bulk_loans([self.LOAN_POST_REQ_BODY])
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
     # Tests for get loan outstanding balance
     def test_get_loan_outstanding_balance(self):
         serialized_test_loan = LoanSerializer(self.test_loan).data
@@ -300,6 +442,80 @@ class LoanTests(APITestCase):
         self.assertGreater(response.data["count"], 0)
         self.assertTrue("links" in response.data.keys())
 
+    def loan_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        queries = [
+            query["sql"]
+            for query in context.captured_queries
+            if query["sql"].startswith("SELECT") and '"loans_loan"' in query["sql"]
+        ]
+        return response, queries
+
+    def test_sparse_fieldsets_match_the_full_responses(self):
+        detail_url = reverse("loan_get_patch_delete", args=[self.test_loan.pk])
+        full_detail = self.client.get(detail_url).data
+        full_list = self.client.get("/api/loans/list/").data["results"]
+        for field in LoanSerializer.Meta.fields:
+            response = self.client.get(detail_url, {"fields": field})
+            self.assertEqual(response.data, {field: full_detail[field]})
+            response = self.client.get("/api/loans/list/", {"fields": f"{field},id"})
+            self.assertEqual(
+                response.data["results"],
+                [{"id": loan["id"], field: loan[field]} for loan in full_list],
+            )
+
+    def test_sparse_fieldsets_load_only_the_columns_they_read(self):
+        detail_url = reverse("loan_get_patch_delete", args=[self.test_loan.pk])
+        for url in [f"{detail_url}?fields=id,bank", "/api/loans/list/?fields=bank"]:
+            response, queries = self.loan_queries(url)
+            self.assertIn('"bank"', queries[-1])
+            self.assertNotIn('"nominal_value"', queries[-1])
+            self.assertNotIn('"total_paid"', queries[-1])
+
+        response, queries = self.loan_queries("/api/loans/list/?fields=total_paid")
+        self.assertIn('"total_paid"', queries[-1])
+        self.assertNotIn('"interest_rate"', queries[-1])
+
+    def test_sparse_fieldsets_skip_the_interest_computation(self):
+        interest = mock.PropertyMock(side_effect=AssertionError)
+        with mock.patch(
+            "loans.api.viewsets.prime_financials", side_effect=AssertionError
+        ), mock.patch.object(LoanFinancials, "interest", interest):
+            for url in [
+                "/api/loans/list/?fields=id,bank,maturity_date",
+                "/api/loans/list/?fields=total_paid",
+                f"/api/loans/{self.test_loan.pk}/?fields=total_paid",
+            ]:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with mock.patch(
+            "loans.api.viewsets.prime_financials", wraps=engine.prime_financials
+        ) as prime_financials:
+            self.client.get("/api/loans/list/?fields=total_debt")
+        prime_financials.assert_called_once()
+
+    def test_sparse_fieldsets_with_cursor_pagination(self):
+        url = "/api/loans/list/?pagination=cursor&page_size=1&fields=bank"
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.data["results"], [{"bank": "Bank Test"}])
+        next_page = self.client.get(response.data["links"]["next"])
+        self.assertEqual(next_page.data["results"], [{"bank": "Bank Test"}])
+        self.assertIsNone(next_page.data["links"]["next"])
+
+    def test_sparse_fieldsets_with_unknown_fields(self):
+        for url in [
+            "/api/loans/list/?fields=id,secret,version",
+            f"/api/loans/{self.test_loan.pk}/?fields=id,secret,version",
+        ]:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(
+                response.data["fields"], ["Unknown fields: secret, version"]
+            )
+
     def test_get_loan_list_without_a_token(self):
         self.client.logout()
         response = self.client.get("/api/loans/list/")
@@ -313,3 +529,2009 @@ class LoanTests(APITestCase):
         self.assertEqual(len(response.data["results"]), 0)
         self.assertEqual(response.data["count"], 0)
         self.assertTrue("links" in response.data.keys())
+
+    def create_loans(self, quantity):
+        for _ in range(quantity):
+            loan = Loan.objects.create(
+                user=self.test_user,
+                nominal_value=Decimal(1000.00),
+                ip_address="0.0.0.0",
+                interest_rate=Decimal(1.5),
+                bank="Bank Test",
+                maturity_date=self.MATURITY_DATE,
+            )
+            Payment.objects.create(loan=loan, date=self.TODAY, value=Decimal(100.00))
+
+    def test_get_loan_list_runs_constant_number_of_queries(self):
+        self.create_loans(quantity=8)
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/loans/list/?page_size=10")
+        self.assertEqual(len(response.data["results"]), 10)
+
+        self.create_loans(quantity=90)
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/loans/list/?page_size=100")
+        self.assertEqual(len(response.data["results"]), 100)
+
+    def test_loan_with_financials_matches_stored_total_paid(self):
+        self.create_loans(quantity=1)
+        for loan in Loan.objects.with_financials():
+            self.assertEqual(loan.paid_amount, loan.total_paid)
+
+    def test_loan_financials_are_computed_once_per_instance(self):
+        loan = Loan.objects.get(pk=self.test_loan.pk)
+        with self.assertNumQueries(0):
+            LoanSerializer(loan).data
+            loan.get_total_paid
+            loan.get_balance
+        self.assertIs(loan.financials, loan.financials)
+
+    def test_loan_financials_are_invalidated_on_save(self):
+        total_debt = self.test_loan.get_total_debt
+        self.test_loan.nominal_value = self.test_loan.nominal_value * 2
+        self.test_loan.save()
+        self.assertGreater(self.test_loan.get_total_debt, total_debt)
+
+    def test_loan_financials_are_invalidated_on_payment_change(self):
+        self.assertEqual(self.test_loan.get_total_paid, 0)
+        payment = Payment.objects.create(
+            loan=self.test_loan, date=self.TODAY, value=Decimal(100.00)
+        )
+        self.assertEqual(self.test_loan.get_total_paid, Decimal(100.00))
+        payment.delete()
+        self.assertEqual(self.test_loan.get_total_paid, 0)
+
+    def test_loan_stores_its_balances(self):
+        payment = Payment.objects.create(
+            loan=self.test_loan, date=self.TODAY, value=Decimal(100.00)
+        )
+        loan = Loan.objects.get(pk=self.test_loan.pk)
+        self.assertEqual(loan.total_debt, loan.get_total_debt)
+        self.assertEqual(loan.total_paid, Decimal(100.00))
+        self.assertEqual(loan.outstanding_balance, loan.get_balance)
+
+        payment.delete()
+        loan.refresh_from_db()
+        self.assertEqual(loan.total_paid, 0)
+        self.assertEqual(loan.outstanding_balance, loan.total_debt)
+
+    def test_patch_loan_updates_stored_balances(self):
+        response = self.client.patch(
+            reverse("loan_get_patch_delete", args=[self.test_loan.pk]),
+            self.LOAN_PATCH_REQ_BODY,
+        )
+        loan = Loan.objects.get(pk=self.test_loan.pk)
+        self.assertEqual(response.data["total_debt"], loan.total_debt)
+        self.assertEqual(response.data["outstanding_balance"], loan.outstanding_balance)
+
+    def test_reconcile_loan_balances_fixes_drift(self):
+        Payment.objects.create(
+            loan=self.test_loan, date=self.TODAY, value=Decimal(100.00)
+        )
+        Loan.objects.filter(pk=self.test_loan.pk).update(total_paid=0)
+        output = StringIO()
+        call_command("reconcile_loan_balances", chunk_size=1, stdout=output)
+        self.assertIn("2 loans checked, 1 with drift", output.getvalue())
+        self.assertEqual(
+            Loan.objects.get(pk=self.test_loan.pk).total_paid, Decimal(100.00)
+        )
+
+        output = StringIO()
+        call_command("reconcile_loan_balances", stdout=output)
+        self.assertIn("2 loans checked, 0 with drift", output.getvalue())
+
+    def test_stored_balances_migration_rounds_iof_half_cents_to_even(self):
+        migration = import_module("loans.migrations.0008_recompute_stored_balances")
+        loan = Loan.objects.create(
+            user=self.test_user,
+            nominal_value=Decimal(250.00),
+            ip_address="0.0.0.0",
+            interest_rate=Decimal(1.5),
+            bank="Bank Test",
+            maturity_date=self.TODAY + datetime.timedelta(days=30),
+        )
+        # The IOF of 1.565 that the float rates of 0004 rounded up
+        self.assertEqual(loan.calculate_iof(), Decimal("1.56"))
+        cent = Decimal("0.01")
+        Loan.objects.filter(pk=loan.pk).update(
+            total_debt=F("total_debt") + cent,
+            outstanding_balance=F("outstanding_balance") + cent,
+        )
+        bank, month, shard = rollup_key(loan)
+        LoanRollup.objects.filter(bank=bank, month=month, shard=shard).update(
+            total_debt=F("total_debt") + cent,
+            outstanding_balance=F("outstanding_balance") + cent,
+        )
+        version = Loan.objects.get(pk=loan.pk).version
+
+        migration.recompute_stored_balances(django_apps, None)
+        stored = Loan.objects.get(pk=loan.pk)
+        self.assertEqual(stored.total_debt, loan.get_total_debt)
+        self.assertEqual(stored.outstanding_balance, loan.get_balance)
+        self.assertNotEqual(stored.version, version)
+        self.assertEqual(LoanRollup.objects.drift(), [])
+
+    def test_engine_matches_per_instance_figures_to_the_cent(self):
+        random = Random(4)
+        loans = [
+            Loan(
+                nominal_value=Decimal(random.randint(1, 10**10)).scaleb(-2),
+                interest_rate=Decimal(random.randint(1, 500)).scaleb(-2),
+                request_date=self.TODAY,
+                maturity_date=self.TODAY + datetime.timedelta(random.randint(1, 10950)),
+            )
+            for _ in range(2000)
+        ]
+        batch = engine.evaluate(
+            [loan.nominal_value for loan in loans],
+            [loan.interest_rate for loan in loans],
+            [loan.request_date for loan in loans],
+            [loan.maturity_date for loan in loans],
+        )
+        self.assertEqual(
+            list(batch.installments), [loan.get_total_installments for loan in loans]
+        )
+        self.assertEqual(
+            batch.as_decimals("iof"), [loan.calculate_iof() for loan in loans]
+        )
+        self.assertEqual(
+            batch.as_decimals("total_interest"),
+            [loan.get_total_interest for loan in loans],
+        )
+        self.assertEqual(
+            batch.as_decimals("total_debt"), [loan.get_total_debt for loan in loans]
+        )
+
+    def test_loans_past_int64_cents_are_listed_and_exported(self):
+        body = {
+            **self.LOAN_POST_REQ_BODY,
+            "nominal_value": 1000000000.00,
+            "interest_rate": 10.00,
+            "maturity_date": add_months(self.TODAY, 200),
+        }
+        response = self.client.post(reverse("create_new_loan"), body)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        loan = Loan.objects.get(pk=response.data["id"])
+        self.assertGreater(loan.get_total_debt.scaleb(2), 2**63)
+
+        response = self.client.get("/api/loans/list/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        listed = {item["id"]: item for item in response.data["results"]}
+        self.assertEqual(listed[loan.pk]["total_debt"], loan.get_total_debt)
+        self.assertEqual(listed[loan.pk]["outstanding_balance"], loan.get_total_debt)
+        exported = [
+            json.loads(line) for line in self.export_loans("ndjson").splitlines()
+        ]
+        self.assertEqual(Decimal(exported[-1]["total_debt"]), loan.get_total_debt)
+
+        loans = list(Loan.objects.order_by("pk"))
+        batch = engine.evaluate(
+            [loan.nominal_value for loan in loans],
+            [loan.interest_rate for loan in loans],
+            [loan.request_date for loan in loans],
+            [loan.maturity_date for loan in loans],
+            [Decimal(10) ** 17 for _ in loans],
+        )
+        self.assertEqual(
+            batch.as_decimals("total_debt"), [loan.get_total_debt for loan in loans]
+        )
+        self.assertEqual(
+            batch.as_decimals("outstanding_balance"),
+            [loan.get_total_debt - Decimal(10) ** 17 for loan in loans],
+        )
+
+    def test_post_loans_around_the_largest_storable_debt(self):
+        long_loan = {
+            **self.LOAN_POST_REQ_BODY,
+            "nominal_value": 1000000.00,
+            "interest_rate": 10.00,
+            "maturity_date": add_months(self.TODAY, 360),
+        }
+        response = self.client.post(reverse("create_new_loan"), long_loan)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        loan = Loan.objects.get(pk=response.data["id"])
+        self.assertGreater(loan.get_total_debt, Decimal(10) ** 20)
+        # SQLite keeps the stored amounts as floats, read back to 15 digits
+        self.assertAlmostEqual(loan.total_debt / loan.get_total_debt, 1, places=12)
+
+        largest = {
+            **self.LOAN_POST_REQ_BODY,
+            "nominal_value": 80000000.00,
+            "interest_rate": 100.00,
+            "maturity_date": add_months(self.TODAY, 60),
+        }
+        response = self.client.post(reverse("create_new_loan"), largest)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        loan = Loan.objects.get(pk=response.data["id"])
+        self.assertGreater(loan.get_total_debt, Decimal(9) * Decimal(10) ** 25)
+        self.assertAlmostEqual(
+            loan.outstanding_balance / loan.get_total_debt, 1, places=12
+        )
+
+        response = self.client.post(
+            reverse("create_new_loan"), {**largest, "nominal_value": 90000000.00}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            str(response.data["detail"][0]), "Loan total debt is too large"
+        )
+        response = self.client.patch(
+            reverse("loan_get_patch_delete", args=[loan.pk]),
+            {"nominal_value": 90000000.00},
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Loan.objects.filter(nominal_value=90000000).count(), 0)
+
+    def assertSameRendering(self, expected, data):
+        renderer = JSONRenderer()
+        self.assertEqual(renderer.render(data), renderer.render(expected))
+
+    def test_compiled_serializer_matches_loan_serializer(self):
+        random = Random(7)
+        loans = [
+            Loan(
+                id=number,
+                user_id=self.test_user.pk,
+                bank=f"Bank {number}",
+                ip_address="10.0.0.1" if number % 2 else "::1",
+                nominal_value=Decimal(random.randint(1, 10**10)).scaleb(-2),
+                interest_rate=Decimal(random.randint(1, 500)).scaleb(-2),
+                request_date=self.TODAY,
+                maturity_date=self.TODAY + datetime.timedelta(random.randint(1, 10950)),
+                total_paid=Decimal(random.choice([0, random.randint(1, 10**6)])),
+            )
+            for number in range(500)
+        ]
+        # Values off the column precision are quantized like DecimalField does
+        loans[0].nominal_value = Decimal("1000.005")
+        loans[1].interest_rate = Decimal("1.255")
+        engine.prime_financials(loans[::2])
+        for fields in [
+            None,
+            {"id", "user", "outstanding_balance"},
+            {"id", "total_debt", "total_installments"},
+            {"bank", "request_date", "nominal_value", "total_paid"},
+        ]:
+            plan = get_read_plan(LoanSerializer, fields)
+            expected = LoanSerializer(loans, many=True, fields=fields).data
+            self.assertSameRendering(expected, plan.represent_many(loans))
+            self.assertSameRendering(
+                LoanSerializer(loans[1], fields=fields).data, plan.represent(loans[1])
+            )
+
+    def test_compiled_serializer_matches_stored_loans(self):
+        Payment.objects.create(
+            loan=self.test_loan, date=self.TODAY, value=Decimal(100.00)
+        )
+        plan = get_read_plan(LoanSerializer)
+        for loans in [Loan.objects.all(), Loan.objects.with_financials()]:
+            self.assertSameRendering(
+                LoanSerializer(loans, many=True).data, plan.represent_many(loans)
+            )
+
+    def test_read_plans_are_compiled_once_per_field_set(self):
+        plan = get_read_plan(LoanSerializer, ["id", "user"])
+        self.assertIs(get_read_plan(LoanSerializer, {"user", "id"}), plan)
+        self.assertIsNot(get_read_plan(LoanSerializer), plan)
+        # Rows of values() hold no financials for the computed fields
+        self.assertEqual(plan.value_fields, ("id", "user"))
+        self.assertIsNone(get_read_plan(LoanSerializer).value_fields)
+
+    def test_revalue_portfolio_reports_totals(self):
+        Payment.objects.create(
+            loan=self.test_loan, date=self.TODAY, value=Decimal(100.00)
+        )
+        Loan.objects.filter(pk=self.test_loan.pk).update(total_debt=0)
+        output = StringIO()
+        call_command("revalue_portfolio", chunk_size=1, save=True, stdout=output)
+        loans = Loan.objects.all()
+        self.assertIn("2 loans revalued", output.getvalue())
+        self.assertIn(
+            f"total_debt: {sum(loan.get_total_debt for loan in loans)}",
+            output.getvalue(),
+        )
+        for loan in loans:
+            self.assertEqual(loan.total_debt, loan.get_total_debt)
+            self.assertEqual(loan.outstanding_balance, loan.get_balance)
+
+    def test_revalue_portfolio_keeps_terms_changed_since_the_read(self):
+        def iter_portfolio_and_patch(queryset, chunk_size):
+            for ids, batch in engine.iter_portfolio(queryset, chunk_size):
+                # A loan changed after its batch was read
+                self.client.patch(
+                    reverse("loan_get_patch_delete", args=[self.test_loan.pk]),
+                    self.LOAN_PATCH_REQ_BODY,
+                )
+                yield ids, batch
+
+        with mock.patch(
+            "loans.management.commands.revalue_portfolio.iter_portfolio",
+            iter_portfolio_and_patch,
+        ):
+            call_command("revalue_portfolio", save=True, stdout=StringIO())
+        loan = Loan.objects.get(pk=self.test_loan.pk)
+        self.assertEqual(loan.nominal_value, Decimal(12000))
+        self.assertEqual(loan.total_debt, loan.get_total_debt)
+        self.assertEqual(loan.outstanding_balance, loan.get_balance)
+
+    # Tests for the stress test
+    def create_stress_portfolio(self):
+        random = Random(23)
+        for number in range(12):
+            Loan.objects.create(
+                user=self.test_user2,
+                nominal_value=Decimal(random.randint(1, 10**7)).scaleb(-2),
+                ip_address="0.0.0.0",
+                interest_rate=Decimal(random.randint(1, 500)).scaleb(-2),
+                bank=f"Bank {number % 3}",
+                maturity_date=self.TODAY + datetime.timedelta(random.randint(1, 3650)),
+                total_paid=Decimal(random.randint(0, 10**4)).scaleb(-2),
+            )
+        self.test_admin = User.objects.create(
+            username="test-admin",
+            email="test-admin@test.com",
+            password="test-password",
+            is_staff=True,
+        )
+
+    def stressed_exposure(self, rate_shock, term_adjustment):
+        """The exposure of each loan under a scenario, one loan at a time."""
+        exposure = []
+        for loan in Loan.objects.all():
+            maturity_date = max(
+                add_months(loan.maturity_date, term_adjustment), loan.request_date
+            )
+            stressed = Loan(
+                nominal_value=loan.nominal_value,
+                interest_rate=max(loan.interest_rate + rate_shock / Decimal(100), 0),
+                request_date=loan.request_date,
+                maturity_date=maturity_date,
+                total_paid=loan.total_paid,
+            )
+            months_left = (maturity_date.year - self.TODAY.year) * 12 + (
+                maturity_date.month - self.TODAY.month
+            )
+            if maturity_date <= self.TODAY:
+                maturity = "matured"
+            elif months_left <= 12:
+                maturity = "up to 12 months"
+            elif months_left <= 36:
+                maturity = "13 to 36 months"
+            elif months_left <= 60:
+                maturity = "37 to 60 months"
+            else:
+                maturity = "over 60 months"
+            exposure.append(
+                (
+                    loan.bank,
+                    maturity,
+                    stressed.get_total_interest,
+                    stressed.get_total_debt,
+                    stressed.get_balance,
+                )
+            )
+        return exposure
+
+    def assertExposure(self, data, loans):
+        self.assertEqual(data["loans"], len(loans))
+        for index, field in enumerate(
+            ("total_interest", "total_debt", "outstanding_balance"), 2
+        ):
+            self.assertEqual(Decimal(data[field]), sum(loan[index] for loan in loans))
+
+    @override_settings(
+        STRESS_TEST={"WORKERS": 2, "CHUNK_SIZE": 5, "MAX_REVALUATIONS": 1000}
+    )
+    def test_stress_test_matches_the_loans_revalued_one_by_one(self):
+        self.create_stress_portfolio()
+        self.client.force_authenticate(self.test_admin)
+        body = {"rate_shocks": [0, 150, -300], "term_adjustments": [0, 6, -24]}
+        response = self.client.post(reverse("loan_stress_test"), body)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["loans"], 14)
+        self.assertEqual(len(response.data["scenarios"]), 9)
+
+        for scenario in response.data["scenarios"]:
+            loans = self.stressed_exposure(
+                scenario["rate_shock"], scenario["term_adjustment"]
+            )
+            self.assertExposure(scenario, loans)
+            self.assertEqual(
+                sum(Decimal(bank["nominal_value"]) for bank in scenario["banks"]),
+                sum(loan.nominal_value for loan in Loan.objects.all()),
+            )
+            for bank in scenario["banks"]:
+                self.assertExposure(
+                    bank, [loan for loan in loans if loan[0] == bank["bank"]]
+                )
+            for maturity in scenario["maturities"]:
+                self.assertExposure(
+                    maturity,
+                    [loan for loan in loans if loan[1] == maturity["maturity"]],
+                )
+        self.assertEqual(response.data["scenarios"][3]["name"], "+150bps +0m")
+
+    def test_stress_test_of_a_portfolio_past_20_digits(self):
+        self.create_stress_portfolio()
+        Loan.objects.create(
+            user=self.test_user,
+            nominal_value=Decimal(1000000.00),
+            ip_address="0.0.0.0",
+            interest_rate=Decimal(10.00),
+            bank="Bank Test",
+            maturity_date=add_months(self.TODAY, 360),
+        )
+        self.client.force_authenticate(self.test_admin)
+        body = {"rate_shocks": [0, 100]}
+        response = self.client.post(reverse("loan_stress_test"), body)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for scenario in response.data["scenarios"]:
+            self.assertGreater(Decimal(scenario["total_debt"]), Decimal(10) ** 20)
+            self.assertExposure(
+                scenario, self.stressed_exposure(scenario["rate_shock"], 0)
+            )
+
+    def test_stress_test_of_an_empty_portfolio(self):
+        self.create_stress_portfolio()
+        Loan.objects.all().delete()
+        self.client.force_authenticate(self.test_admin)
+        response = self.client.post(reverse("loan_stress_test"), {})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["loans"], 0)
+        self.assertEqual(response.data["scenarios"][0]["name"], "+0bps +0m")
+        self.assertEqual(response.data["scenarios"][0]["total_debt"], "0.00")
+
+    @override_settings(
+        STRESS_TEST={"WORKERS": 2, "CHUNK_SIZE": 5, "MAX_REVALUATIONS": 28}
+    )
+    def test_stress_test_of_a_portfolio_past_the_endpoint_limit(self):
+        self.create_stress_portfolio()
+        self.client.force_authenticate(self.test_admin)
+        response = self.client.post(reverse("loan_stress_test"), {"rate_shocks": [0]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["loans"], 14)
+
+        body = {"rate_shocks": [0, 100, 200]}
+        response = self.client.post(reverse("loan_stress_test"), body)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            str(response.data["detail"]),
+            "At most 9 loans can be stress tested under 3 scenarios, run the "
+            "stress_test command for the whole portfolio",
+        )
+
+    def test_stress_test_is_restricted_to_staff(self):
+        response = self.client.post(reverse("loan_stress_test"), {})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_stress_test_with_invalid_scenarios(self):
+        self.create_stress_portfolio()
+        self.client.force_authenticate(self.test_admin)
+        for body in [
+            {"rate_shocks": list(range(11)), "term_adjustments": list(range(10))},
+            {"rate_shocks": [20000]},
+            {"term_adjustments": ["six"]},
+        ]:
+            response = self.client.post(reverse("loan_stress_test"), body)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stress_test_command_reports_each_scenario(self):
+        self.create_stress_portfolio()
+        output = StringIO()
+        call_command(
+            "stress_test",
+            rate_shock=[100],
+            term_adjustment=[0, 12],
+            chunk_size=3,
+            workers=2,
+            stdout=output,
+        )
+        self.assertIn("14 loans under 2 scenarios", output.getvalue())
+        for name, term_adjustment in (("+100bps +0m", 0), ("+100bps +12m", 12)):
+            loans = self.stressed_exposure(100, term_adjustment)
+            self.assertIn(name, output.getvalue())
+            self.assertIn(
+                f"total_debt {sum(loan[3] for loan in loans)}", output.getvalue()
+            )
+
+    # Tests for the loan rollups
+    def assertRollupsMatchLoans(self):
+        self.assertEqual(LoanRollup.objects.drift(), [])
+        banks = {}
+        for loan in Loan.objects.all():
+            totals = banks.setdefault(
+                loan.bank,
+                {"bank": loan.bank, "loans": 0, **dict.fromkeys(ROLLUP_FIELDS, 0)},
+            )
+            totals["loans"] += 1
+            for field in ROLLUP_FIELDS:
+                totals[field] += getattr(loan, field)
+        self.assertEqual(
+            list(LoanRollup.objects.summary("bank")),
+            [banks[bank] for bank in sorted(banks)],
+        )
+
+    def test_rollups_follow_every_loan_write(self):
+        self.assertRollupsMatchLoans()
+        self.client.post(reverse("create_new_loan"), self.LOAN_POST_REQ_BODY)
+        self.client.post(
+            reverse("create_new_loans_bulk"),
+            [self.LOAN_POST_REQ_BODY, {**self.LOAN_POST_REQ_BODY, "bank": "Bank 2"}],
+        )
+        self.assertEqual(Loan.objects.count(), 5)
+        self.assertRollupsMatchLoans()
+
+        self.client.patch(
+            reverse("loan_get_patch_delete", args=[self.test_loan.pk]),
+            {**self.LOAN_PATCH_REQ_BODY, "bank": "Bank 3"},
+        )
+        self.assertRollupsMatchLoans()
+
+        Payment.objects.create(
+            loan=self.test_loan2, date=self.TODAY, value=Decimal(100.00)
+        )
+        self.client.delete(reverse("loan_get_patch_delete", args=[self.test_loan2.pk]))
+        self.assertRollupsMatchLoans()
+
+        self.test_user.delete()
+        self.assertFalse(Loan.objects.exists())
+        self.assertRollupsMatchLoans()
+
+    def test_rollups_follow_the_deletion_of_a_user_with_paid_loans(self):
+        for loan in (self.test_loan, self.test_loan2):
+            for value in (Decimal(50.00), Decimal(100.00)):
+                Payment.objects.create(loan=loan, date=self.TODAY, value=value)
+        self.assertRollupsMatchLoans()
+
+        self.test_user.delete()
+        self.assertFalse(Loan.objects.exists())
+        self.assertRollupsMatchLoans()
+        self.assertFalse(LoanRollup.objects.summary("bank").exists())
+
+    def test_rollups_hold_totals_past_the_amounts_of_one_loan(self):
+        body = {
+            **self.LOAN_POST_REQ_BODY,
+            "nominal_value": 9000000000.00,
+            "interest_rate": 100.00,
+            "maturity_date": add_months(self.TODAY, 26),
+        }
+        response = self.client.post(reverse("create_new_loans_bulk"), [body, body])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        loans = Loan.objects.all()
+        month = LoanRollup.objects.summary("month").get()
+        self.assertGreater(month["total_debt"], Decimal(10) ** 18)
+        for field in ("nominal_value", "total_debt", "outstanding_balance"):
+            expected = sum(getattr(loan, field) for loan in loans)
+            # SQLite keeps the amounts as floats, read back to 15 digits
+            self.assertAlmostEqual(month[field] / expected, 1, places=12)
+        self.assertEqual(
+            Decimal(MonthSummarySerializer(month).data["total_debt"]),
+            month["total_debt"],
+        )
+
+    def test_save_keeps_payments_posted_since_the_loan_was_loaded(self):
+        loan = Loan.objects.get(pk=self.test_loan.pk)
+        Payment.objects.create(
+            loan=self.test_loan, date=self.TODAY, value=Decimal(100.00)
+        )
+        loan.nominal_value = Decimal(12000.00)
+        loan.save()
+        loan = Loan.objects.with_financials().get(pk=loan.pk)
+        self.assertEqual(loan.total_paid, loan.paid_amount)
+        self.assertEqual(
+            loan.outstanding_balance, loan.get_total_debt - loan.total_paid
+        )
+        self.assertRollupsMatchLoans()
+
+    def test_rollups_follow_every_payment_write(self):
+        body = {"loan": self.test_loan.pk, "date": self.TODAY, "value": "250.00"}
+        self.client.post(reverse("post_payment"), body)
+        self.client.post(reverse("post_payments_bulk"), [body, body], format="json")
+        self.assertEqual(Payment.objects.count(), 3)
+        self.assertRollupsMatchLoans()
+
+        payment = Payment.objects.first()
+        payment.value = Decimal(10.00)
+        payment.save()
+        self.assertRollupsMatchLoans()
+
+        self.client.delete(reverse("payment_methods", args=[payment.pk]))
+        self.assertRollupsMatchLoans()
+        self.assertEqual(
+            LoanRollup.objects.aggregate(Sum("total_paid"))["total_paid__sum"],
+            Decimal(500.00),
+        )
+
+    def test_get_rollup_summary(self):
+        self.create_stress_portfolio()
+        self.client.force_authenticate(self.test_admin)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("loan_rollups"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["loans"], 14)
+        self.assertEqual(
+            Decimal(response.data["total_paid"]),
+            sum(loan.total_paid for loan in Loan.objects.all()),
+        )
+        banks = {bank["bank"]: bank for bank in response.data["banks"]}
+        self.assertEqual(sorted(banks), ["Bank 0", "Bank 1", "Bank 2", "Bank Test"])
+        for bank, summary in banks.items():
+            loans = Loan.objects.filter(bank=bank)
+            self.assertEqual(summary["loans"], loans.count())
+            self.assertEqual(
+                Decimal(summary["outstanding_balance"]),
+                sum(loan.outstanding_balance for loan in loans),
+            )
+        self.assertEqual(
+            response.data["months"][0]["month"], str(self.TODAY.replace(day=1))
+        )
+        self.assertEqual(response.data["months"][0]["loans"], 14)
+
+    def test_rollup_summary_is_restricted_to_staff(self):
+        response = self.client.get(reverse("loan_rollups"))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_rebuild_loan_rollups_fixes_drift(self):
+        LoanRollup.objects.update(total_paid=Decimal(7.00))
+        output = StringIO()
+        call_command("rebuild_loan_rollups", check=True, stdout=output)
+        self.assertIn(
+            f"Bank Test {self.TODAY:%Y-%m}: total_paid stored as", output.getvalue()
+        )
+        self.assertIn("1 rollup totals with drift", output.getvalue())
+        self.assertNotEqual(LoanRollup.objects.drift(), [])
+
+        call_command("rebuild_loan_rollups", stdout=StringIO())
+        self.assertRollupsMatchLoans()
+        output = StringIO()
+        call_command("rebuild_loan_rollups", check=True, stdout=output)
+        self.assertIn("0 rollup totals with drift", output.getvalue())
+
+    # Tests for get loan summary
+    def test_get_loan_summary(self):
+        self.create_loans(quantity=3)
+        Loan.objects.create(
+            user=self.test_user2,
+            nominal_value=Decimal(1000.00),
+            ip_address="0.0.0.0",
+            interest_rate=Decimal(1.5),
+            bank="Another Bank",
+            maturity_date=self.MATURITY_DATE,
+        )
+        loans = LoanSerializer(Loan.objects.filter(user=self.test_user), many=True)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("loan_summary"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["loans"], 5)
+        for field in ("nominal_value", "total_debt", "total_paid"):
+            self.assertEqual(
+                Decimal(response.data[field]),
+                sum(Decimal(loan[field]) for loan in loans.data),
+            )
+        self.assertEqual(
+            Decimal(response.data["outstanding_balance"]),
+            sum(loan["outstanding_balance"] for loan in loans.data),
+        )
+        self.assertEqual(len(response.data["banks"]), 1)
+        self.assertEqual(response.data["banks"][0]["bank"], "Bank Test")
+        self.assertEqual(response.data["banks"][0]["loans"], 5)
+
+    def test_get_loan_summary_past_the_amounts_of_one_loan(self):
+        body = {
+            **self.LOAN_POST_REQ_BODY,
+            "nominal_value": 9000000000.00,
+            "interest_rate": 100.00,
+            "maturity_date": add_months(self.TODAY, 26),
+        }
+        self.client.post(reverse("create_new_loans_bulk"), [body, body])
+        total_debt = sum(loan.total_debt for loan in Loan.objects.all())
+        self.assertGreater(total_debt, Decimal(10) ** 18)
+
+        response = self.client.get(reverse("loan_summary"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # SQLite keeps the amounts as floats, read back to 15 digits
+        self.assertAlmostEqual(
+            Decimal(response.data["total_debt"]) / total_debt, 1, places=12
+        )
+        self.test_user.is_staff = True
+        self.test_user.save()
+        response = self.client.get(reverse("loan_rollups"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertAlmostEqual(
+            Decimal(response.data["total_debt"]) / total_debt, 1, places=12
+        )
+
+    def test_get_loan_summary_from_user_with_no_loans(self):
+        self.client.logout()
+        self.client.force_authenticate(self.test_user2)
+        response = self.client.get(reverse("loan_summary"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["loans"], 0)
+        self.assertEqual(response.data["outstanding_balance"], "0.00")
+        self.assertEqual(response.data["banks"], [])
+
+    def test_get_loan_summary_without_a_token(self):
+        self.client.logout()
+        response = self.client.get(reverse("loan_summary"))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    # Tests for get loan list with cursor pagination
+    def test_get_loan_list_with_cursor_pagination(self):
+        self.create_loans(quantity=3)
+        expected_ids = list(
+            Loan.objects.filter(user=self.test_user)
+            .order_by("-request_date", "id")
+            .values_list("id", flat=True)
+        )
+        response = self.client.get("/api/loans/list/?pagination=cursor&page_size=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("count", response.data)
+        self.assertIsNone(response.data["links"]["previous"])
+
+        ids, pages = [], [response]
+        while response.data["links"]["next"]:
+            ids += [loan["id"] for loan in response.data["results"]]
+            response = self.client.get(response.data["links"]["next"])
+            pages.append(response)
+        ids += [loan["id"] for loan in response.data["results"]]
+        self.assertEqual(ids, expected_ids)
+        self.assertEqual(len(pages), 3)
+
+        previous = self.client.get(response.data["links"]["previous"])
+        self.assertEqual(previous.data["results"], pages[1].data["results"])
+        first = self.client.get(previous.data["links"]["previous"])
+        self.assertEqual(first.data["results"], pages[0].data["results"])
+        self.assertIsNone(first.data["links"]["previous"])
+
+    def test_get_loan_list_with_cursor_pagination_and_count(self):
+        response = self.client.get("/api/loans/list/?pagination=cursor&count=exact")
+        self.assertEqual(response.data["count"], 2)
+        response = self.client.get(
+            "/api/loans/list/?pagination=cursor&count=approximate"
+        )
+        self.assertGreaterEqual(response.data["count"], 0)
+
+    def test_get_loan_list_with_invalid_cursor(self):
+        response = self.client.get("/api/loans/list/?cursor=invalid")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_loan_list_with_malformed_cursor_values(self):
+        self.assertMalformedCursorsNotFound("/api/loans/list/")
+
+    # Tests for loan export
+    def export_loans(self, export_format):
+        response = self.client.get(f"/api/loans/export/?format={export_format}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content).decode()
+
+    def test_export_loans_as_ndjson(self):
+        self.create_loans(quantity=3)
+        Loan.objects.create(
+            user=self.test_user2,
+            nominal_value=Decimal(1000.00),
+            ip_address="0.0.0.0",
+            interest_rate=Decimal(1.5),
+            bank="Bank Test",
+            maturity_date=self.MATURITY_DATE,
+        )
+        exported = [
+            json.loads(line) for line in self.export_loans("ndjson").splitlines()
+        ]
+        loans = Loan.objects.filter(user=self.test_user).order_by("pk")
+        self.assertEqual([loan["id"] for loan in exported], [loan.pk for loan in loans])
+        for record, loan in zip(exported, loans):
+            expected = LoanSerializer(loan).data
+            self.assertEqual(list(record), list(expected))
+            # Exported money is always a string, the serializer may hand out
+            # the derived figures as Decimal or int
+            for field, value in expected.items():
+                if isinstance(value, (Decimal, int)):
+                    self.assertEqual(Decimal(record[field]), value, field)
+                else:
+                    self.assertEqual(record[field], value, field)
+
+    def test_export_loans_as_csv(self):
+        self.create_loans(quantity=3)
+        rows = list(csv.reader(StringIO(self.export_loans("csv"))))
+        self.assertEqual(tuple(rows[0]), LoanSerializer.Meta.fields)
+        self.assertEqual(len(rows), 6)
+        loan = Loan.objects.get(pk=rows[-1][0])
+        self.assertEqual(Decimal(rows[-1][8]), loan.get_total_debt)
+        self.assertEqual(Decimal(rows[-1][12]), loan.get_balance)
+
+    def test_export_loans_from_user_with_no_loans(self):
+        self.client.force_authenticate(self.test_user2)
+        self.assertEqual(self.export_loans("ndjson"), "")
+
+    def test_export_loans_without_a_token(self):
+        self.client.logout()
+        response = self.client.get("/api/loans/export/")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_export_reads_rows_in_chunks(self):
+        self.create_loans(quantity=3)
+        chunks = iter_chunks(Loan.objects.order_by("pk"), chunk_size=2)
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+
+    # Tests for the installment schedule
+    def get_schedule(self, loan, **params):
+        response = self.client.get(
+            reverse("loan_schedule", args=[loan.pk]), {"page_size": 100, **params}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_get_loan_schedule(self):
+        loan = self.test_loan
+        schedule = self.get_schedule(loan)
+        installments = schedule["results"]
+        self.assertEqual(schedule["count"], loan.get_total_installments)
+        self.assertEqual(len(installments), loan.get_total_installments)
+
+        def total(field):
+            return sum(Decimal(installment[field]) for installment in installments)
+
+        self.assertEqual(total("principal"), loan.nominal_value)
+        self.assertEqual(total("interest") + total("iof"), loan.get_total_interest)
+        self.assertEqual(total("amount"), loan.get_total_debt)
+        self.assertEqual(Decimal(installments[0]["iof"]), loan.calculate_iof())
+        self.assertEqual(Decimal(installments[-1]["remaining_balance"]), 0)
+        self.assertEqual(installments[-1]["due_date"], str(loan.maturity_date))
+        # Compounded interest grows month after month
+        interests = [Decimal(installment["interest"]) for installment in installments]
+        self.assertEqual(interests, sorted(interests))
+        self.assertEqual(
+            {installment["status"] for installment in installments}, {"unpaid"}
+        )
+
+    def test_loan_schedule_shows_paid_installments(self):
+        first, second = self.get_schedule(self.test_loan)["results"][:2]
+        Payment.objects.create(
+            loan=self.test_loan,
+            date=self.TODAY,
+            value=Decimal(first["amount"]) + Decimal("10.00"),
+        )
+        installments = self.get_schedule(self.test_loan)["results"]
+        self.assertEqual(
+            [installment["status"] for installment in installments[:3]],
+            ["paid", "partially_paid", "unpaid"],
+        )
+        self.assertEqual(installments[0]["paid"], first["amount"])
+        self.assertEqual(Decimal(installments[1]["paid"]), Decimal("10.00"))
+        self.assertEqual(installments[1]["amount"], second["amount"])
+
+    def test_long_loan_schedule_is_paginated(self):
+        loan = Loan.objects.create(
+            user=self.test_user,
+            nominal_value=Decimal(300000.00),
+            ip_address="0.0.0.0",
+            interest_rate=Decimal(0.9),
+            bank="Bank Test",
+            maturity_date=datetime.date(self.TODAY.year + 30, self.TODAY.month, 1),
+        )
+        schedule = self.get_schedule(loan, page=36, page_size=10)
+        self.assertEqual(schedule["count"], 360)
+        self.assertIsNone(schedule["links"]["next"])
+        self.assertEqual(
+            [installment["number"] for installment in schedule["results"]],
+            list(range(351, 361)),
+        )
+        amounts = [
+            Decimal(installment["amount"])
+            for page in range(1, 5)
+            for installment in self.get_schedule(loan, page=page)["results"]
+        ]
+        self.assertEqual(sum(amounts), loan.get_total_debt)
+        self.assertEqual(Decimal(schedule["results"][-1]["remaining_balance"]), 0)
+
+    def test_schedule_of_a_loan_with_amounts_past_20_digits(self):
+        body = {
+            **self.LOAN_POST_REQ_BODY,
+            "nominal_value": 1000000.00,
+            "interest_rate": 10.00,
+            "maturity_date": add_months(self.TODAY, 360),
+        }
+        response = self.client.post(reverse("create_new_loan"), body)
+        loan = Loan.objects.get(pk=response.data["id"])
+        schedule = self.get_schedule(loan, page=4)
+        self.assertEqual(schedule["count"], 360)
+        self.assertEqual(
+            Decimal(schedule["results"][-1]["remaining_balance"]), Decimal(0)
+        )
+        self.assertGreater(
+            Decimal(schedule["results"][-1]["interest"]), Decimal(10) ** 19
+        )
+
+    def test_loan_schedule_is_cached_until_the_loan_changes(self):
+        url = reverse("loan_schedule", args=[self.test_loan.pk])
+        first = self.client.get(url).data
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.client.get(url).data, first)
+        # Only the loan itself is read
+        self.assertEqual(len(context.captured_queries), 1)
+
+        self.client.patch(
+            reverse("loan_get_patch_delete", args=[self.test_loan.pk]),
+            {"interest_rate": "2.50"},
+        )
+        patched = self.client.get(url).data
+        self.assertNotEqual(patched["results"][0], first["results"][0])
+
+        payment = Payment.objects.create(
+            loan=self.test_loan, date=self.TODAY, value=Decimal("1.00")
+        )
+        self.assertEqual(self.client.get(url).data["results"][0]["paid"], "1.00")
+        payment.delete()
+        self.assertEqual(self.client.get(url).data, patched)
+
+    def test_get_loan_schedule_from_another_user(self):
+        self.client.force_authenticate(self.test_user2)
+        response = self.client.get(reverse("loan_schedule", args=[self.test_loan.pk]))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_get_nonexistent_loan_schedule(self):
+        response = self.client.get(reverse("loan_schedule", args=[0]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class FinanceTests(SimpleTestCase):
+    TODAY = datetime.date(2024, 1, 31)
+
+    # The formulas LoanFinancials used before loans.finance, with float IOF
+    # rates and a compound factor worked out on every call
+    @staticmethod
+    def float_rate_iof(nominal_value, request_date, maturity_date):
+        total_days = (maturity_date - request_date).days
+        tax = nominal_value * Decimal(0.38 / 100)
+        amortization = nominal_value * total_days * Decimal(0.0082 / 100)
+        return round(tax + amortization, 2)
+
+    @staticmethod
+    def uncached_interest(nominal_value, interest_rate, installments, iof):
+        total_debt = nominal_value * ((1 + interest_rate / 100) ** installments)
+        return round(total_debt - nominal_value + iof, 2)
+
+    def random_loans(self, random, quantity):
+        # Drawn from a few dozen rates and terms, as the portfolio is
+        rates = [Decimal(random.randint(1, 500)).scaleb(-2) for _ in range(30)]
+        terms = [random.randint(1, 10950) for _ in range(30)]
+        for _ in range(quantity):
+            request_date = self.TODAY - datetime.timedelta(random.randint(0, 3650))
+            if random.random() < 0.2:
+                rate = Decimal(random.randint(1, 500)).scaleb(-2)
+                term = random.randint(0, 10950)
+            else:
+                rate, term = random.choice(rates), random.choice(terms)
+            yield (
+                Decimal(random.randint(1, 10**10)).scaleb(-2),
+                rate,
+                request_date,
+                request_date + datetime.timedelta(term),
+            )
+
+    def test_iof_matches_the_float_rate_formula_but_on_half_cents(self):
+        random = Random(22)
+        loans = list(self.random_loans(random, 5000))
+        # Amounts landing exactly on a half cent, which the float rates
+        # rounded one way or the other
+        loans += [
+            (Decimal("25.00"), Decimal(1), self.TODAY, self.TODAY),
+            (
+                Decimal("1250.00"),
+                Decimal(1),
+                self.TODAY,
+                self.TODAY + datetime.timedelta(14),
+            ),
+        ]
+        for nominal_value, _, request_date, maturity_date in loans:
+            iof = finance.iof(nominal_value, request_date, maturity_date)
+            total_days = (maturity_date - request_date).days
+            exact = nominal_value * (
+                Decimal("0.0038") + total_days * Decimal("0.000082")
+            )
+            if exact.scaleb(3) % 10 == 5:
+                self.assertEqual(iof, exact.quantize(Decimal("0.01")))
+            else:
+                self.assertEqual(
+                    iof, self.float_rate_iof(nominal_value, request_date, maturity_date)
+                )
+        self.assertEqual(
+            finance.iof(Decimal("25.00"), self.TODAY, self.TODAY), Decimal("0.10")
+        )
+        self.assertEqual(
+            finance.iof(
+                Decimal("1250.00"), self.TODAY, self.TODAY + datetime.timedelta(14)
+            ),
+            Decimal("6.18"),
+        )
+
+    def test_interest_matches_the_uncached_formula(self):
+        random = Random(23)
+        finance.compound_factor.cache_clear()
+        for nominal_value, rate, request_date, maturity_date in self.random_loans(
+            random, 5000
+        ):
+            installments = finance.installments(request_date, maturity_date)
+            self.assertEqual(
+                installments,
+                (maturity_date.year - request_date.year) * 12
+                + maturity_date.month
+                - request_date.month,
+            )
+            iof = finance.iof(nominal_value, request_date, maturity_date)
+            interest = finance.interest(nominal_value, rate, installments, iof)
+            self.assertEqual(
+                interest,
+                self.uncached_interest(nominal_value, rate, installments, iof),
+            )
+            # Equal rates written with other exponents share their factor
+            self.assertEqual(
+                finance.interest(nominal_value, rate.normalize(), installments, iof),
+                interest,
+            )
+            debt = finance.debt(nominal_value, interest)
+            paid = Decimal(random.randint(0, 10**6)).scaleb(-2)
+            self.assertEqual(debt - finance.balance(debt, paid), paid)
+        self.assertGreater(finance.compound_factor.cache_info().hits, 5000)
+
+    def test_compound_factors_are_cached_up_to_the_cache_size(self):
+        finance.compound_factor.cache_clear()
+        self.addCleanup(finance.compound_factor.cache_clear)
+        for _ in range(3):
+            self.assertEqual(finance.compound_factor(Decimal(0), 12), 1)
+            self.assertEqual(
+                finance.compound_factor(Decimal("2.50"), 12),
+                Decimal("1.025") ** 12,
+            )
+        info = finance.compound_factor.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (4, 2, 2))
+
+        for installments in range(finance.COMPOUND_FACTOR_CACHE_SIZE + 10):
+            finance.compound_factor(Decimal(1), installments)
+        info = finance.compound_factor.cache_info()
+        self.assertEqual(info.currsize, finance.COMPOUND_FACTOR_CACHE_SIZE)
+
+    def test_loans_share_the_kernel(self):
+        finance.compound_factor.cache_clear()
+        loans = [
+            Loan(
+                nominal_value=Decimal(nominal_value),
+                interest_rate=Decimal("1.50"),
+                request_date=self.TODAY,
+                maturity_date=self.TODAY + datetime.timedelta(days=365),
+            )
+            for nominal_value in (100, 1000, 10000)
+        ]
+        for loan in loans:
+            self.assertEqual(
+                loan.get_total_interest,
+                self.uncached_interest(
+                    loan.nominal_value,
+                    loan.interest_rate,
+                    loan.get_total_installments,
+                    loan.calculate_iof(),
+                ),
+            )
+        info = finance.compound_factor.cache_info()
+        self.assertEqual((info.hits, info.misses), (2, 1))
+
+
+class LoanQueryPlanTests(ReadsFromPrimary, QueryPlanAssertions, APITestCase):
+    TODAY = datetime.date.today()
+    LOANS_PER_USER = 30
+
+    def setUp(self):
+        self.test_user = User.objects.create(
+            username="test-user",
+            email="test-user@test.com",
+            password="test-password",
+        )
+        self.test_user2 = User.objects.create(
+            username="test-user2",
+            email="test-user2@test.com",
+            password="test-password2",
+        )
+        for user in (self.test_user, self.test_user2):
+            for months in range(1, self.LOANS_PER_USER + 1):
+                Loan.objects.create(
+                    user=user,
+                    nominal_value=Decimal(1000.00),
+                    ip_address="0.0.0.0",
+                    interest_rate=Decimal(1.5),
+                    bank=f"Bank {months % 3}",
+                    maturity_date=self.TODAY + datetime.timedelta(days=31 * months),
+                )
+        self.client.force_authenticate(self.test_user)
+
+    def test_loan_list_uses_indexes(self):
+        self.assertQueryPlansUseIndexes("/api/loans/list/?page=2", {"loans_loan"})
+
+    def test_loan_list_with_cursor_pagination_uses_indexes(self):
+        response = self.assertQueryPlansUseIndexes(
+            "/api/loans/list/?pagination=cursor", {"loans_loan"}
+        )
+        self.assertQueryPlansUseIndexes(response.data["links"]["next"], {"loans_loan"})
+
+    def test_loan_detail_uses_indexes(self):
+        loan = Loan.objects.filter(user=self.test_user).first()
+        self.assertQueryPlansUseIndexes(
+            reverse("loan_get_patch_delete", args=[loan.pk]), {"loans_loan"}
+        )
+        self.assertQueryPlansUseIndexes(
+            reverse("loan_get_outstanding_balance", args=[loan.pk]), {"loans_loan"}
+        )
+
+    def test_loan_summary_uses_indexes(self):
+        # Grouping by bank sorts the user's own rows, which is expected
+        self.assertQueryPlansUseIndexes(
+            reverse("loan_summary"), {"loans_loan"}, allow_sort=True
+        )
+
+
+class LoanQueryBudgetTests(ReadsFromPrimary, QueryBudgetAssertions, APITestCase):
+    TODAY = datetime.date.today()
+    MATURITY_DATE = datetime.date(TODAY.year + 1, TODAY.month, 1)
+    LOAN_POST_REQ_BODY = {
+        "nominal_value": "1000.00",
+        "interest_rate": "1.00",
+        "bank": "Bank Test",
+        "maturity_date": str(MATURITY_DATE),
+    }
+
+    def setUp(self):
+        self.test_user = User.objects.create(
+            username="test-user",
+            email="test-user@test.com",
+            password="test-password",
+        )
+        self.test_user2 = User.objects.create(
+            username="test-user2",
+            email="test-user2@test.com",
+            password="test-password2",
+        )
+        for user in (self.test_user, self.test_user2):
+            for _ in range(3):
+                loan = Loan.objects.create(
+                    user=user,
+                    nominal_value=Decimal(1000.00),
+                    ip_address="0.0.0.0",
+                    interest_rate=Decimal(1.5),
+                    bank="Bank Test",
+                    maturity_date=self.MATURITY_DATE,
+                )
+                for _ in range(3):
+                    Payment.objects.create(
+                        loan=loan, date=self.TODAY, value=Decimal(10.00)
+                    )
+        self.test_loan = Loan.objects.filter(user=self.test_user).first()
+        self.test_loan_user2 = Loan.objects.filter(user=self.test_user2).first()
+        self.client.force_authenticate(self.test_user)
+
+    def test_get_loan_query_budget(self):
+        url = reverse("loan_get_patch_delete", args=[self.test_loan.pk])
+        self.assertQueryBudget(1, "get", url)
+
+    def test_get_loan_from_another_user_query_budget(self):
+        url = reverse("loan_get_patch_delete", args=[self.test_loan_user2.pk])
+        self.assertQueryBudget(1, "get", url, status_code=status.HTTP_403_FORBIDDEN)
+
+    def test_get_nonexistent_loan_query_budget(self):
+        url = reverse("loan_get_patch_delete", args=[0])
+        self.assertQueryBudget(1, "get", url, status_code=status.HTTP_404_NOT_FOUND)
+
+    def test_patch_loan_query_budget(self):
+        url = reverse("loan_get_patch_delete", args=[self.test_loan.pk])
+        # Savepoint, locked read, locked read of the stored rollup columns,
+        # update, rollup upsert and release
+        self.assertQueryBudget(6, "patch", url, {"interest_rate": "2.00"})
+
+    def test_delete_loan_query_budget(self):
+        url = reverse("loan_get_patch_delete", args=[self.test_loan.pk])
+        # Savepoint, locked read, payments read, two deletes, rollup upsert and
+        # release
+        self.assertQueryBudget(7, "delete", url, status_code=status.HTTP_204_NO_CONTENT)
+
+    def test_get_loan_outstanding_balance_query_budget(self):
+        url = reverse("loan_get_outstanding_balance", args=[self.test_loan.pk])
+        self.assertQueryBudget(1, "get", url)
+
+    def test_post_loan_query_budget(self):
+        # Insert and rollup upsert
+        self.assertQueryBudget(
+            2,
+            "post",
+            reverse("create_new_loan"),
+            self.LOAN_POST_REQ_BODY,
+            status_code=status.HTTP_201_CREATED,
+        )
+
+    def test_post_bulk_loans_query_budget(self):
+        # Savepoint, insert, rollup upsert and release
+        self.assertQueryBudget(
+            4,
+            "post",
+            reverse("create_new_loans_bulk"),
+            [self.LOAN_POST_REQ_BODY] * 20,
+            status_code=status.HTTP_201_CREATED,
+        )
+
+    def test_get_loan_list_query_budget(self):
+        self.assertQueryBudget(2, "get", "/api/loans/list/")
+        self.assertQueryBudget(1, "get", "/api/loans/list/?pagination=cursor")
+
+    def test_get_loan_summary_query_budget(self):
+        self.assertQueryBudget(1, "get", reverse("loan_summary"))
+
+    def test_export_loans_query_budget(self):
+        self.assertQueryBudget(1, "get", reverse("export_loans"))
+
+    def test_not_modified_loan_query_budget(self):
+        for name in ("loan_get_patch_delete", "loan_get_outstanding_balance"):
+            url = reverse(name, args=[self.test_loan.pk])
+            etag = self.client.get(url)["ETag"]
+            self.assertQueryBudget(
+                1,
+                "get",
+                url,
+                status_code=status.HTTP_304_NOT_MODIFIED,
+                headers={"If-None-Match": etag},
+            )
+
+    def test_get_loan_schedule_query_budget(self):
+        url = reverse("loan_schedule", args=[self.test_loan.pk])
+        self.assertQueryBudget(1, "get", url)
+
+
+class QueryInstrumentationTests(ReadsFromPrimary, APITestCase):
+    TODAY = datetime.date.today()
+
+    def setUp(self):
+        self.test_user = User.objects.create(
+            username="test-user",
+            email="test-user@test.com",
+            password="test-password",
+        )
+        self.test_loan = Loan.objects.create(
+            user=self.test_user,
+            nominal_value=Decimal(1000.00),
+            ip_address="0.0.0.0",
+            interest_rate=Decimal(1.5),
+            bank="Bank Test",
+            maturity_date=self.TODAY + datetime.timedelta(days=365),
+        )
+        self.client.force_authenticate(self.test_user)
+
+    def test_response_carries_query_headers(self):
+        url = reverse("loan_get_patch_delete", args=[self.test_loan.pk])
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response["X-DB-Queries"], str(len(context.captured_queries)))
+        self.assertEqual(response["X-DB-Duplicates"], "0")
+        self.assertGreaterEqual(float(response["X-DB-Time"]), 0)
+        self.assertRegex(
+            response["Server-Timing"],
+            r'^db;dur=[0-9.]+;desc="1 queries", total;dur=[0-9.]+$',
+        )
+
+    def test_requests_are_logged_by_url_name(self):
+        url = reverse("loan_get_patch_delete", args=[self.test_loan.pk])
+        with self.assertLogs("loan_api.sql", "INFO") as logs:
+            self.client.get(url)
+            self.client.get("/api/loans/list/")
+        self.assertEqual(
+            [record.sql["url_name"] for record in logs.records],
+            ["loan_get_patch_delete", "loan_list-list"],
+        )
+        self.assertIn(
+            "url_name=loan_get_patch_delete method=GET status=200", logs.output[0]
+        )
+        self.assertEqual(logs.records[0].sql["queries"], 1)
+        self.assertIn('"loans_loan"', logs.records[0].sql["slowest_sql"])
+
+    def test_duplicated_queries_are_logged_as_a_warning(self):
+        def view(request):
+            for _ in range(6):
+                Loan.objects.filter(pk=self.test_loan.pk).exists()
+            return HttpResponse()
+
+        middleware = QueryInstrumentationMiddleware(view)
+        with self.assertLogs("loan_api.sql", "WARNING") as logs:
+            response = middleware(RequestFactory().get("/"))
+        self.assertEqual(response["X-DB-Queries"], "6")
+        self.assertEqual(response["X-DB-Duplicates"], "5")
+        [(sql, count)] = logs.records[0].sql["duplicated_statements"]
+        self.assertEqual(count, 6)
+
+    @override_settings(SQL_INSTRUMENTATION={"ENABLED": False})
+    def test_instrumentation_can_be_disabled(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            QueryInstrumentationMiddleware(HttpResponse)
+
+
+class MetricsTests(ReadsFromPrimary, APITestCase):
+    TODAY = datetime.date.today()
+    LOAN_POST_REQ_BODY = {
+        "nominal_value": "1000.00",
+        "interest_rate": "1.00",
+        "bank": "Bank Test",
+        "maturity_date": str(TODAY + datetime.timedelta(days=365)),
+    }
+
+    def setUp(self):
+        self.test_user = User.objects.create(
+            username="test-user",
+            email="test-user@test.com",
+            password="test-password",
+        )
+        self.test_admin = User.objects.create(
+            username="test-admin",
+            email="test-admin@test.com",
+            password="test-password",
+            is_staff=True,
+        )
+        self.client.force_authenticate(self.test_user)
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_requests_are_measured_by_url_name(self):
+        labels = {"url_name": "loan_summary", "method": "GET"}
+        before = self.sample("http_request_duration_seconds_count", **labels)
+        responses = self.sample("http_responses_total", status="200", **labels)
+        db_time = self.sample("http_request_db_duration_seconds_count", **labels)
+        self.client.get(reverse("loan_summary"))
+        self.assertEqual(
+            self.sample("http_request_duration_seconds_count", **labels), before + 1
+        )
+        self.assertEqual(
+            self.sample("http_responses_total", status="200", **labels), responses + 1
+        )
+        self.assertEqual(
+            self.sample("http_request_db_duration_seconds_count", **labels),
+            db_time + 1,
+        )
+        self.assertEqual(self.sample("http_requests_in_flight"), 0)
+
+    def test_created_loans_are_counted(self):
+        before = self.sample("loans_created_total")
+        self.client.post(reverse("create_new_loan"), self.LOAN_POST_REQ_BODY)
+        self.client.post(
+            reverse("create_new_loans_bulk"), [self.LOAN_POST_REQ_BODY] * 3
+        )
+        self.assertEqual(self.sample("loans_created_total"), before + 4)
+
+    def test_payments_and_rejections_are_counted(self):
+        loan = Loan.objects.create(
+            user=self.test_user,
+            nominal_value=Decimal(1000.00),
+            ip_address="0.0.0.0",
+            interest_rate=Decimal(1.5),
+            bank="Bank Test",
+            maturity_date=self.TODAY + datetime.timedelta(days=365),
+        )
+        posted = self.sample("payments_posted_total")
+        too_big = self.sample(
+            "payment_rejections_total", reason="bigger_than_total_debt"
+        )
+        not_positive = self.sample("payment_rejections_total", reason="not_positive")
+        for value in ("10.00", "999999.00", "0"):
+            self.client.post(
+                reverse("post_payment"),
+                {"loan": loan.pk, "value": value, "date": str(self.TODAY)},
+            )
+        self.assertEqual(self.sample("payments_posted_total"), posted + 1)
+        self.assertEqual(
+            self.sample("payment_rejections_total", reason="bigger_than_total_debt"),
+            too_big + 1,
+        )
+        self.assertEqual(
+            self.sample("payment_rejections_total", reason="not_positive"),
+            not_positive + 1,
+        )
+
+    def test_metrics_are_exposed_to_internal_addresses(self):
+        self.client.logout()
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        self.assertIn(
+            b"# TYPE http_request_duration_seconds histogram", response.content
+        )
+        self.assertIn(b"# TYPE payment_rejections_total counter", response.content)
+
+    def test_compound_factor_cache_is_measured(self):
+        hits = self.sample("compound_factor_cache_hits_total")
+        misses = self.sample("compound_factor_cache_misses_total")
+        for _ in range(3):
+            self.client.post(reverse("create_new_loan"), self.LOAN_POST_REQ_BODY)
+        self.assertGreaterEqual(
+            self.sample("compound_factor_cache_hits_total"), hits + 2
+        )
+        self.assertLessEqual(
+            self.sample("compound_factor_cache_misses_total"), misses + 1
+        )
+        self.assertEqual(
+            self.sample("compound_factor_cache_size"),
+            finance.compound_factor.cache_info().currsize,
+        )
+
+    def test_compound_factor_cache_is_summed_across_processes(self):
+        # Samples only go to files when the directory is set before
+        # prometheus_client is imported, so they are taken in a new process
+        script = "\n".join(
+            [
+                "import django",
+                "django.setup()",
+                "from decimal import Decimal",
+                "from loan_api.metrics import record_compound_factor_cache",
+                "from loans import finance",
+                "for _ in range(3):",
+                "    finance.compound_factor(Decimal('1.50'), 12)",
+                "record_compound_factor_cache()",
+            ]
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": directory}
+            for _ in range(2):
+                subprocess.run(
+                    [sys.executable, "-c", script],
+                    cwd=settings.BASE_DIR,
+                    env=env,
+                    check=True,
+                )
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry, path=directory)
+            self.assertEqual(
+                registry.get_sample_value("compound_factor_cache_hits_total"), 4
+            )
+            self.assertEqual(
+                registry.get_sample_value("compound_factor_cache_misses_total"), 2
+            )
+            self.assertEqual(registry.get_sample_value("compound_factor_cache_size"), 2)
+
+    @override_settings(METRICS_ALLOWED_IPS=[])
+    def test_metrics_are_restricted_to_staff(self):
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_authenticate(self.test_admin)
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.client.logout()
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(
+    RESPONSE_CACHE={"ENABLED": True, "BACKEND": "responses"},
+    CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "responses": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "responses",
+        },
+    },
+)
+class ResponseCacheTests(ReadsFromPrimary, APITestCase):
+    TODAY = datetime.date.today()
+    MATURITY_DATE = datetime.date(TODAY.year + 1, TODAY.month, 1)
+
+    def setUp(self):
+        self.test_user = User.objects.create(
+            username="test-user",
+            email="test-user@test.com",
+            password="test-password",
+        )
+        self.test_user2 = User.objects.create(
+            username="test-user2",
+            email="test-user2@test.com",
+            password="test-password2",
+        )
+        self.test_loan = self.create_loan(self.test_user)
+        Payment.objects.create(
+            loan=self.test_loan, date=self.TODAY, value=Decimal(10.00)
+        )
+        self.client.force_authenticate(self.test_user)
+
+    def create_loan(self, user):
+        return Loan.objects.create(
+            user=user,
+            nominal_value=Decimal(1000.00),
+            ip_address="0.0.0.0",
+            interest_rate=Decimal(1.5),
+            bank="Bank Test",
+            maturity_date=self.MATURITY_DATE,
+        )
+
+    def urls(self):
+        return [
+            reverse("loan_get_patch_delete", args=[self.test_loan.pk]),
+            "/api/loans/list/",
+            "/api/payments/list_all/",
+            f"/api/payments/list/{self.test_loan.pk}/",
+        ]
+
+    def get(self, url, headers=None):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, headers=headers)
+        return response, len(context.captured_queries)
+
+    def sample(self, url_name, result):
+        labels = {"url_name": url_name, "result": result}
+        return REGISTRY.get_sample_value("response_cache_requests_total", labels) or 0
+
+    def test_repeated_reads_are_served_from_the_cache(self):
+        for url in self.urls():
+            first, _ = self.get(url)
+            self.assertEqual(first.status_code, status.HTTP_200_OK)
+            response, queries = self.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(queries, 0, url)
+            self.assertEqual(response.content, first.content)
+            self.assertEqual(response["Content-Type"], first["Content-Type"])
+            if not first.has_header("ETag"):
+                continue
+
+            response, queries = self.get(url, {"If-None-Match": first["ETag"]})
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(queries, 0, url)
+
+    def test_hits_and_misses_are_counted(self):
+        url = reverse("loan_get_patch_delete", args=[self.test_loan.pk])
+        hits = self.sample("loan_get_patch_delete", "hit")
+        misses = self.sample("loan_get_patch_delete", "miss")
+        for _ in range(3):
+            self.client.get(url)
+        self.assertEqual(self.sample("loan_get_patch_delete", "hit"), hits + 2)
+        self.assertEqual(self.sample("loan_get_patch_delete", "miss"), misses + 1)
+
+    def assertAllFresh(self, urls=None):
+        for url in urls or self.urls():
+            response, queries = self.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertGreater(queries, 0, url)
+
+    def test_writes_invalidate_the_owner_responses(self):
+        writes = [
+            lambda: self.client.patch(
+                reverse("loan_get_patch_delete", args=[self.test_loan.pk]),
+                {"interest_rate": "2.00"},
+            ),
+            lambda: self.client.post(
+                reverse("post_payment"),
+                {"loan": self.test_loan.pk, "date": self.TODAY, "value": "1.00"},
+            ),
+            lambda: self.client.post(
+                reverse("post_payments_bulk"),
+                [{"loan": self.test_loan.pk, "date": str(self.TODAY), "value": "1.00"}],
+            ),
+            lambda: self.client.delete(
+                reverse("payment_methods", args=[Payment.objects.last().pk])
+            ),
+            lambda: self.client.post(
+                reverse("create_new_loans_bulk"),
+                [
+                    {
+                        "nominal_value": "1000.00",
+                        "interest_rate": "1.00",
+                        "bank": "Bank Test",
+                        "maturity_date": str(self.MATURITY_DATE),
+                    }
+                ],
+            ),
+            lambda: Payment.objects.filter(loan=self.test_loan).delete(),
+        ]
+        for write in writes:
+            for url in self.urls():
+                self.client.get(url)
+            write()
+            self.assertAllFresh()
+
+    def test_maintenance_commands_invalidate_every_user(self):
+        for url in self.urls():
+            self.client.get(url)
+        Loan.objects.filter(pk=self.test_loan.pk).update(total_paid=0)
+        call_command("reconcile_loan_balances", stdout=StringIO())
+        self.assertAllFresh()
+
+    def test_writes_of_other_users_keep_the_cache(self):
+        for url in self.urls():
+            self.client.get(url)
+        self.create_loan(self.test_user2)
+        for url in self.urls():
+            _, queries = self.get(url)
+            self.assertEqual(queries, 0, url)
+
+    def test_responses_are_not_shared_between_users(self):
+        url = reverse("loan_get_patch_delete", args=[self.test_loan.pk])
+        self.client.get(url)
+        self.client.force_authenticate(self.test_user2)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_cache_can_be_turned_off_per_view(self):
+        with self.settings(
+            RESPONSE_CACHE={
+                "ENABLED": True,
+                "BACKEND": "responses",
+                "DISABLED_VIEWS": ["loan_list-list"],
+            }
+        ):
+            self.client.get("/api/loans/list/")
+            self.assertAllFresh(["/api/loans/list/"])
+        url = reverse("loan_get_patch_delete", args=[self.test_loan.pk])
+        with mock.patch("loans.views.LoanView.cache_responses", False):
+            self.client.get(url)
+            self.assertAllFresh([url])
+
+    def test_file_based_backend(self):
+        with tempfile.TemporaryDirectory() as location:
+            with self.settings(
+                CACHES={
+                    "default": {
+                        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                        "LOCATION": location,
+                    }
+                },
+                RESPONSE_CACHE={"ENABLED": True},
+            ):
+                url = "/api/loans/list/"
+                first = self.client.get(url)
+                response, queries = self.get(url)
+                self.assertEqual((queries, response.content), (0, first.content))
+                self.client.patch(
+                    reverse("loan_get_patch_delete", args=[self.test_loan.pk]),
+                    {"interest_rate": "2.00"},
+                )
+                self.assertAllFresh([url])
+
+
+@override_settings(ROOT_URLCONF="loan_api.asgi_urls")
+class AsyncReadTests(ReadsFromPrimary, APITestCase):
+    TODAY = datetime.date.today()
+    MATURITY_DATE = datetime.date(TODAY.year + 1, TODAY.month, 1)
+
+    def setUp(self):
+        self.test_user = User.objects.create(
+            username="test-user",
+            email="test-user@test.com",
+            password="test-password",
+        )
+        self.test_user2 = User.objects.create(
+            username="test-user2",
+            email="test-user2@test.com",
+            password="test-password2",
+        )
+        self.test_loan = self.create_loan(self.test_user)
+        self.create_loan(self.test_user)
+        for value in (10, 20):
+            Payment.objects.create(
+                loan=self.test_loan, date=self.TODAY, value=Decimal(value)
+            )
+        self.token = Token.objects.get(user=self.test_user).key
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token}")
+
+    def create_loan(self, user):
+        return Loan.objects.create(
+            user=user,
+            nominal_value=Decimal(1000.00),
+            ip_address="0.0.0.0",
+            interest_rate=Decimal(1.5),
+            bank="Bank Test",
+            maturity_date=self.MATURITY_DATE,
+        )
+
+    def urls(self):
+        return [
+            f"/api/loans/{self.test_loan.pk}/",
+            f"/api/loans/{self.test_loan.pk}/outstanding_balance/",
+            "/api/loans/list/",
+            "/api/loans/list/?page_size=1&page=2",
+            "/api/loans/list/?pagination=cursor&page_size=1",
+            "/api/payments/list_all/",
+            f"/api/payments/list/{self.test_loan.pk}/",
+        ]
+
+    def aget(self, url, token=None, headers=None):
+        headers = dict(headers or {})
+        if token is not False:
+            headers["Authorization"] = f"Token {token or self.token}"
+        return async_to_sync(self.async_client.get)(url, headers=headers)
+
+    def test_async_views_answer_the_read_urls(self):
+        for url in self.urls():
+            match = resolve(url.split("?")[0])
+            self.assertTrue(iscoroutinefunction(match.func), url)
+
+    def test_responses_match_the_sync_views(self):
+        for url in self.urls():
+            with self.settings(ROOT_URLCONF="loan_api.urls"):
+                expected = self.client.get(url)
+            response = self.aget(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK, url)
+            self.assertEqual(response.json(), expected.json(), url)
+            self.assertEqual(response["Content-Type"], expected["Content-Type"])
+            self.assertEqual(response.get("ETag"), expected.get("ETag"), url)
+
+    def test_sparse_fieldsets_match_the_sync_views(self):
+        for url in [
+            f"/api/loans/{self.test_loan.pk}/?fields=id,total_paid",
+            "/api/loans/list/?fields=bank,outstanding_balance",
+            "/api/loans/list/?fields=id&pagination=cursor&page_size=1",
+            "/api/payments/list_all/?fields=value",
+            f"/api/payments/list/{self.test_loan.pk}/?fields=date,loan",
+            "/api/loans/list/?fields=unknown",
+        ]:
+            with self.settings(ROOT_URLCONF="loan_api.urls"):
+                expected = self.client.get(url)
+            response = self.aget(url)
+            self.assertEqual(response.status_code, expected.status_code, url)
+            self.assertEqual(response.json(), expected.json(), url)
+
+    def test_cursor_links_are_followed(self):
+        url = "/api/loans/list/?pagination=cursor&page_size=1"
+        first = self.aget(url).json()
+        second = self.aget(first["links"]["next"]).json()
+        self.assertEqual(second["links"]["next"], None)
+        ids = [first["results"][0]["id"], second["results"][0]["id"]]
+        self.assertCountEqual(
+            ids, Loan.objects.filter(user=self.test_user).values_list("pk", flat=True)
+        )
+
+    def test_conditional_get(self):
+        url = f"/api/loans/{self.test_loan.pk}/"
+        etag = self.aget(url)["ETag"]
+        response = self.aget(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        Payment.objects.create(loan=self.test_loan, date=self.TODAY, value=1)
+        response = self.aget(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_authentication_and_permissions(self):
+        for url in self.urls():
+            response = self.aget(url, token=False)
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+            self.assertEqual(response["WWW-Authenticate"], "Token")
+            response = self.aget(url, token="invalid")
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        other_token = Token.objects.get(user=self.test_user2).key
+        for url in self.urls()[:2] + self.urls()[-1:]:
+            response = self.aget(url, token=other_token)
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN, url)
+        for url in ["/api/loans/0/", "/api/payments/list/0/"]:
+            with self.settings(ROOT_URLCONF="loan_api.urls"):
+                expected = self.client.get(url)
+            response = self.aget(url)
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND, url)
+            self.assertEqual(response.json(), expected.json())
+
+    def test_other_methods_reach_the_sync_views(self):
+        url = f"/api/loans/{self.test_loan.pk}/"
+        response = async_to_sync(self.async_client.patch)(
+            url,
+            {"interest_rate": "2.00"},
+            content_type="application/json",
+            headers={"Authorization": f"Token {self.token}"},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.aget(url).json()["interest_rate"], "2.00")
+        response = async_to_sync(self.async_client.delete)(
+            url, headers={"Authorization": f"Token {self.token}"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Loan.objects.filter(pk=self.test_loan.pk).exists())
+
+    @override_settings(
+        RESPONSE_CACHE={"ENABLED": True},
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+        },
+    )
+    def test_response_cache(self):
+        for url in self.urls():
+            first = self.aget(url)
+            with CaptureQueriesContext(connection) as context:
+                response = self.aget(url)
+            self.assertEqual(response.content, first.content)
+            self.assertEqual(len(context.captured_queries), 0, url)
+        Payment.objects.create(loan=self.test_loan, date=self.TODAY, value=1)
+        response = self.aget(f"/api/loans/{self.test_loan.pk}/")
+        self.assertEqual(response.json()["total_paid"], 31.0)
+
+
+class ReplicaRouterTests(SimpleTestCase):
+    def test_reads_follow_the_request(self):
+        router = ReplicaRouter()
+        self.assertIsNone(router.db_for_read(Loan))
+        token = reading_from.set("replica")
+        try:
+            self.assertEqual(router.db_for_read(Loan), "replica")
+            self.assertEqual(read_database(), "replica")
+            self.assertEqual(router.db_for_write(Loan), "default")
+        finally:
+            reading_from.reset(token)
+        self.assertEqual(read_database(), "default")
+
+    # The default database plays the replica, the only alias there always is
+    @override_settings(READ_REPLICA={"ALIAS": "default"})
+    def test_migrate_leaves_the_replica_alone(self):
+        router = ReplicaRouter()
+        self.assertIs(router.allow_migrate("default", "loans"), False)
+        self.assertIsNone(router.allow_migrate("other", "loans"))
+        with self.settings(READ_REPLICA={"ALIAS": "default", "MIGRATE": True}):
+            self.assertIsNone(router.allow_migrate("default", "loans"))
+
+    @override_settings(
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "dummy": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"},
+            "shared": {
+                "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                "LOCATION": os.path.join(tempfile.gettempdir(), "replica-pins"),
+            },
+        }
+    )
+    def test_pins_must_be_kept_in_a_shared_cache(self):
+        for backend, errors in [
+            ("default", ["loan_api.E001"]),
+            ("dummy", ["loan_api.E001"]),
+            ("missing", ["loan_api.E001"]),
+            ("shared", []),
+        ]:
+            with self.settings(READ_REPLICA={"ALIAS": "default", "BACKEND": backend}):
+                self.assertEqual(
+                    [error.id for error in check_pin_backend(None)], errors
+                )
+        with self.settings(READ_REPLICA={"ALIAS": None, "BACKEND": "default"}):
+            self.assertEqual(check_pin_backend(None), [])
+
+
+@skipUnless("replica" in settings.DATABASES, "REPLICA_DB_ENV is not set")
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    READ_REPLICA={"ALIAS": "replica", "STICKY_SECONDS": 60},
+)
+class ReadReplicaTests(APITestCase):
+    """Reads and writes against a replica database that never catches up."""
+
+    databases = "__all__"
+    TODAY = datetime.date.today()
+    MATURITY_DATE = datetime.date(TODAY.year + 1, TODAY.month, 1)
+    LOAN_POST_REQ_BODY = {
+        "nominal_value": 1000.00,
+        "interest_rate": 1.50,
+        "bank": "Bank Test",
+        "maturity_date": MATURITY_DATE,
+    }
+
+    def setUp(self):
+        # Users get the ids of earlier tests' users, and with them their pins
+        forget_replica_reads()
+        self.addCleanup(forget_replica_reads)
+        self.test_user = User.objects.create(
+            username="test-user",
+            email="test-user@test.com",
+            password="test-password",
+        )
+        self.test_user2 = User.objects.create(
+            username="test-user2",
+            email="test-user2@test.com",
+            password="test-password2",
+        )
+        self.test_loan = Loan.objects.create(
+            user=self.test_user,
+            nominal_value=Decimal(1000.00),
+            ip_address="0.0.0.0",
+            interest_rate=Decimal(1.5),
+            bank="Bank Test",
+            maturity_date=self.MATURITY_DATE,
+        )
+        self.replicate(self.test_user, self.test_user2, self.test_loan)
+        self.test_payment = Payment.objects.create(
+            loan=self.test_loan, date=self.TODAY, value=Decimal(10.00)
+        )
+        self.client.force_authenticate(self.test_user)
+
+    def replicate(self, *instances):
+        """Copy instances as they are to the replica, as replication would."""
+        for instance in instances:
+            type(instance).objects.using("replica").bulk_create([copy.copy(instance)])
+
+    def test_reads_go_to_the_replica(self):
+        loan_url = reverse("loan_get_patch_delete", args=[self.test_loan.pk])
+        self.assertEqual(self.client.get(loan_url).data["total_paid"], 0)
+        self.assertEqual(self.client.get("/api/loans/list/").data["count"], 1)
+        self.assertEqual(self.client.get("/api/payments/list_all/").data["count"], 0)
+        url = reverse("payment_methods", args=[self.test_payment.pk])
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(reverse("export_payments"), HTTP_ACCEPT="text/csv")
+        self.assertEqual(b"".join(response.streaming_content).count(b"\n"), 1)
+
+    def test_writes_go_to_the_primary_and_pin_the_writer(self):
+        response = self.client.post(reverse("create_new_loan"), self.LOAN_POST_REQ_BODY)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        loan_id = response.data["id"]
+        self.assertTrue(Loan.objects.filter(pk=loan_id).exists())
+        self.assertFalse(Loan.objects.using("replica").filter(pk=loan_id).exists())
+
+        response = self.client.get(reverse("loan_get_patch_delete", args=[loan_id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get("/api/payments/list_all/").data["count"], 1)
+
+        self.client.force_authenticate(self.test_user2)
+        self.client.post(reverse("create_new_loan"), self.LOAN_POST_REQ_BODY)
+        self.client.force_authenticate(self.test_user)
+        self.assertEqual(self.client.get("/api/loans/list/").data["count"], 2)
+
+    def test_every_write_pins_the_writer(self):
+        loan_url = reverse("loan_get_patch_delete", args=[self.test_loan.pk])
+        payment_url = reverse("payment_methods", args=[self.test_payment.pk])
+        body = {"loan": self.test_loan.pk, "date": self.TODAY, "value": "5.00"}
+        for method, url, data in [
+            ("patch", loan_url, {"interest_rate": "2.00"}),
+            ("post", reverse("post_payment"), body),
+            ("delete", payment_url, None),
+            ("delete", loan_url, None),
+        ]:
+            cache.clear()
+            getattr(self.client, method)(url, data)
+            response = self.client.get(loan_url)
+            if method == "delete" and url == loan_url:
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            else:
+                self.assertEqual(
+                    Decimal(response.data["total_paid"]),
+                    Loan.objects.get(pk=self.test_loan.pk).total_paid,
+                )
+
+    def test_pins_expire(self):
+        with self.settings(READ_REPLICA={"ALIAS": "replica", "STICKY_SECONDS": 0}):
+            response = self.client.post(
+                reverse("create_new_loan"), self.LOAN_POST_REQ_BODY
+            )
+            url = reverse("loan_get_patch_delete", args=[response.data["id"]])
+            self.assertEqual(
+                self.client.get(url).status_code, status.HTTP_404_NOT_FOUND
+            )
+
+    @override_settings(
+        STRESS_TEST={"WORKERS": 1, "CHUNK_SIZE": 5, "MAX_REVALUATIONS": 1}
+    )
+    def test_stress_test_reads_from_the_replica(self):
+        Loan.objects.create(
+            user=self.test_user,
+            nominal_value=Decimal(2000.00),
+            ip_address="0.0.0.0",
+            interest_rate=Decimal(1.5),
+            bank="Bank Test",
+            maturity_date=self.MATURITY_DATE,
+        )
+        self.test_user.is_staff = True
+        response = self.client.post(reverse("loan_stress_test"), {})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["loans"], 1)
+        self.assertEqual(response.data["scenarios"][0]["nominal_value"], "1000.00")
+        # Only reads, so the admin is not pinned to the primary
+        self.assertEqual(replica_for(self.test_user), "replica")
+
+    @override_settings(ROOT_URLCONF="loan_api.asgi_urls")
+    def test_async_views_read_from_the_replica(self):
+        token = Token.objects.get(user=self.test_user).key
+        headers = {"Authorization": f"Token {token}"}
+        response = async_to_sync(self.async_client.get)(
+            "/api/payments/list_all/", headers=headers
+        )
+        self.assertEqual(response.json()["count"], 0)
+
+        response = async_to_sync(self.async_client.patch)(
+            f"/api/loans/{self.test_loan.pk}/",
+            {"interest_rate": "2.00"},
+            content_type="application/json",
+            headers=headers,
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = async_to_sync(self.async_client.get)(
+            "/api/payments/list_all/", headers=headers
+        )
+        self.assertEqual(response.json()["count"], 1)
@@ -9,11 +9,17 @@ router.register("list", LoanViewSet, basename="loan_list")
 
 urlpatterns = [
     path("", views.LoanPost.as_view(), name="create_new_loan"),
+    path("bulk/", views.LoanBulkPost.as_view(), name="create_new_loans_bulk"),
+    path("export/", views.LoanExport.as_view(), name="export_loans"),
+    path("summary/", views.LoanSummary.as_view(), name="loan_summary"),
+    path("rollups/", views.LoanRollupSummary.as_view(), name="loan_rollups"),
+    path("stress_test/", views.LoanStressTest.as_view(), name="loan_stress_test"),
     path("<int:id>/", views.LoanView.as_view(), name="loan_get_patch_delete"),
     path(
         "<int:id>/outstanding_balance/",
         views.GetOutstandingBalance.as_view(),
         name="loan_get_outstanding_balance",
     ),
+    path("<int:id>/schedule/", views.LoanSchedule.as_view(), name="loan_schedule"),
     path("", include(router.urls)),
 ]
@@ -1,67 +1,295 @@
-from django.shortcuts import get_object_or_404
+import hashlib
+from functools import partial
+from django.core.cache import cache
+from django.db import transaction
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.generics import GenericAPIView
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework.permissions import IsAuthenticated
-from rest_framework.exceptions import PermissionDenied
-from loans.api.serializers import LoanSerializer
-from loans.models import Loan
+from django.conf import settings
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from loan_api.compiled_serializer import get_read_plan, get_request_plan, project
+from loan_api.conditional import conditional_get, make_etag
+from loan_api.metrics import LOANS_CREATED
+from loan_api.ownership import get_owned_object_or_404
+from loan_api.paginations import CustomPagination
+from loan_api.replica import ReplicaReadMixin, read_database
+from loan_api.response_cache import ResponseCacheMixin, invalidate
+from loan_api.exports import (
+    CSVRenderer,
+    NDJSONRenderer,
+    export_response,
+    iter_chunks,
+)
+from loans import engine
+from loans.api.serializers import (
+    InstallmentSerializer,
+    LoanSerializer,
+    LoanSummarySerializer,
+    RollupSummarySerializer,
+    StressTestReportSerializer,
+    StressTestSerializer,
+)
+from loans.models import Loan, LoanRollup
+from loans.schedule import Schedule
+from loans.stress import StressTest
 
 
-class LoanView(APIView):
+class LoanView(ReplicaReadMixin, ResponseCacheMixin, APIView):
     permission_classes = [IsAuthenticated]
 
-    def retrieve_valid_loan(self, request, loan_id):
-        loan = get_object_or_404(Loan, pk=loan_id)
-        if request.user != loan.user:
-            raise PermissionDenied("Permission Denied")
-        return loan
+    def retrieve_valid_loan(self, request, loan_id, queryset=Loan.objects):
+        return get_owned_object_or_404(queryset, request.user, pk=loan_id)
 
     def get(self, request, id):
-        loan = self.retrieve_valid_loan(request=request, loan_id=id)
-        serializer = LoanSerializer(loan, context={"request": request})
-        return Response(serializer.data)
+        return self.cached_response(request, partial(self.retrieve, request, id))
+
+    def get_plan(self, request):
+        return get_request_plan(request, LoanSerializer)
+
+    def retrieve(self, request, id):
+        plan = self.get_plan(request)
+        loan = self.retrieve_valid_loan(
+            request=request,
+            loan_id=id,
+            queryset=project(Loan.objects, plan, "version"),
+        )
+        return conditional_get(
+            request,
+            make_etag(request, loan.pk, loan.version),
+            lambda: Response(plan.represent(loan)),
+        )
 
     def patch(self, request, id):
-        loan = self.retrieve_valid_loan(request=request, loan_id=id)
-        serializer = LoanSerializer(loan, data=request.data, partial=True)
-        if serializer.is_valid(raise_exception=True):
-            serializer.save()
-            return Response(serializer.data)
+        with transaction.atomic():
+            loan = self.retrieve_valid_loan(
+                request=request,
+                loan_id=id,
+                queryset=Loan.objects.select_for_update(),
+            )
+            serializer = LoanSerializer(loan, data=request.data, partial=True)
+            if serializer.is_valid(raise_exception=True):
+                serializer.save()
+                invalidate(request.user.pk)
+                return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def delete(self, request, id):
-        loan = self.retrieve_valid_loan(request=request, loan_id=id)
-        loan.delete()
+        # Locked so that the rollups lose the totals the loan has when deleted
+        with transaction.atomic():
+            loan = self.retrieve_valid_loan(
+                request=request,
+                loan_id=id,
+                queryset=Loan.objects.select_for_update(),
+            )
+            loan.delete()
+        invalidate(request.user.pk)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class LoanPost(APIView):
+class LoanPost(ReplicaReadMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
         serializer = LoanSerializer(data=request.data, context={"request": request})
         if serializer.is_valid(raise_exception=True):
             serializer.save()
+            LOANS_CREATED.inc()
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class GetOutstandingBalance(APIView):
+class LoanBulkPost(ReplicaReadMixin, APIView):
     permission_classes = [IsAuthenticated]
+    CREATED_FIELDS = {"id", "total_debt", "total_installments"}
+
+    def post(self, request):
+        serializer = LoanSerializer(
+            data=request.data, many=True, context={"request": request}
+        )
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            loans = serializer.save()
+            # bulk_create sends no signals
+            invalidate(request.user.pk)
+        LOANS_CREATED.inc(len(loans))
+        plan = get_read_plan(LoanSerializer, self.CREATED_FIELDS)
+        return Response(plan.represent_many(loans), status=status.HTTP_201_CREATED)
 
-    def retrieve_valid_loan(self, request, loan_id):
-        loan = get_object_or_404(Loan, pk=loan_id)
-        if request.user != loan.user:
-            raise PermissionDenied("Permission Denied")
-        return loan
+
+class GetOutstandingBalance(ReplicaReadMixin, APIView):
+    permission_classes = [IsAuthenticated]
+    FIELDS = {"id", "user", "outstanding_balance"}
+
+    def get_plan(self, request):
+        return get_read_plan(LoanSerializer, self.FIELDS)
 
     def get(self, request, id):
-        loan = self.retrieve_valid_loan(request=request, loan_id=id)
-        serializer = LoanSerializer(
-            loan,
-            context={"request": request},
-            fields={"id", "user", "outstanding_balance"},
+        plan = self.get_plan(request)
+        loan = get_owned_object_or_404(
+            project(Loan.objects, plan, "version"), request.user, pk=id
         )
+        return conditional_get(
+            request,
+            make_etag(request, loan.pk, loan.version),
+            lambda: Response(plan.represent(loan)),
+        )
+
+
+class LoanSchedule(ReplicaReadMixin, GenericAPIView):
+    """
+    Installments of a loan, a page at a time. Pages are cached under the
+    loan's version, which every change to the loan or to its payments
+    replaces, so stale pages are never read again and just expire.
+    """
+
+    permission_classes = [IsAuthenticated]
+    pagination_class = CustomPagination
+    serializer_class = InstallmentSerializer
+
+    def get(self, request, id):
+        loan = get_owned_object_or_404(Loan.objects, request.user, pk=id)
+        key = self.cache_key(request, loan)
+        data = cache.get(key)
+        if data is None:
+            page = self.paginate_queryset(Schedule(loan))
+            serializer = self.get_serializer(page, many=True)
+            data = self.get_paginated_response(serializer.data).data
+            cache.set(key, data)
+        return Response(data)
+
+    def cache_key(self, request, loan):
+        # The page links are absolute, so the whole URL is part of the key
+        url = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+        return f"loan-schedule:{loan.pk}:{loan.version}:{url}"
+
+
+class LoanSummary(ReplicaReadMixin, APIView):
+    permission_classes = [IsAuthenticated]
+    SUMMED_FIELDS = (
+        "loans",
+        "nominal_value",
+        "total_debt",
+        "total_paid",
+        "outstanding_balance",
+    )
+
+    def get(self, request):
+        banks = list(Loan.objects.filter(user=request.user).summary_by_bank())
+        summary = {
+            field: sum(bank[field] for bank in banks) for field in self.SUMMED_FIELDS
+        }
+        summary["banks"] = banks
+        serializer = LoanSummarySerializer(summary)
         return Response(serializer.data)
+
+
+class LoanRollupSummary(ReplicaReadMixin, APIView):
+    """Totals of every loan per bank and per request month, from the rollups."""
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        banks = list(LoanRollup.objects.summary("bank"))
+        summary = {
+            field: sum(bank[field] for bank in banks)
+            for field in LoanSummary.SUMMED_FIELDS
+        }
+        summary["banks"] = banks
+        summary["months"] = LoanRollup.objects.summary("month")
+        return Response(RollupSummarySerializer(summary).data)
+
+
+class LoanStressTest(ReplicaReadMixin, APIView):
+    """
+    Stress test of portfolios of up to STRESS_TEST["MAX_REVALUATIONS"] loans
+    times scenarios, read from the replica. Larger portfolios are left to the
+    stress_test command, as they would outlast the request.
+    """
+
+    permission_classes = [IsAdminUser]
+    replica_methods = ("POST",)
+
+    def post(self, request):
+        serializer = StressTestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        scenarios = serializer.validated_data["scenarios"]
+        max_loans = settings.STRESS_TEST["MAX_REVALUATIONS"] // len(scenarios)
+        if Loan.objects.order_by()[max_loans : max_loans + 1].exists():
+            raise ValidationError(
+                {
+                    "detail": f"At most {max_loans} loans can be stress tested "
+                    f"under {len(scenarios)} scenarios, run the stress_test "
+                    "command for the whole portfolio"
+                }
+            )
+        stress_test = StressTest(scenarios).run(
+            Loan.objects,
+            chunk_size=settings.STRESS_TEST["CHUNK_SIZE"],
+            workers=settings.STRESS_TEST["WORKERS"],
+        )
+        return Response(StressTestReportSerializer(stress_test.report()).data)
+
+
+class LoanExport(ReplicaReadMixin, APIView):
+    permission_classes = [IsAuthenticated]
+    renderer_classes = [NDJSONRenderer, CSVRenderer]
+    STORED_FIELDS = (
+        "id",
+        "user",
+        "bank",
+        "ip_address",
+        "request_date",
+        "maturity_date",
+        "nominal_value",
+        "interest_rate",
+        "total_paid",
+    )
+
+    def get(self, request):
+        loans = (
+            Loan.objects.using(read_database())
+            .filter(user=request.user)
+            .order_by("pk")
+            .values_list(*self.STORED_FIELDS)
+        )
+        return export_response(
+            request,
+            fields=LoanSerializer.Meta.fields,
+            chunks=map(self.evaluate, iter_chunks(loans)),
+            filename="loans",
+        )
+
+    def evaluate(self, rows):
+        """Lay a chunk of stored rows out as LoanSerializer fields."""
+        (
+            ids,
+            users,
+            banks,
+            ip_addresses,
+            request_dates,
+            maturity_dates,
+            nominal_values,
+            interest_rates,
+            total_paid,
+        ) = zip(*rows)
+        batch = engine.evaluate(
+            nominal_values, interest_rates, request_dates, maturity_dates, total_paid
+        )
+        return zip(
+            ids,
+            users,
+            banks,
+            ip_addresses,
+            request_dates,
+            maturity_dates,
+            nominal_values,
+            interest_rates,
+            batch.as_decimals("total_debt"),
+            batch.installments.tolist(),
+            batch.as_decimals("total_interest"),
+            batch.as_decimals("total_paid"),
+            batch.as_decimals("outstanding_balance"),
+        )
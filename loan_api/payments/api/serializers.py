@@ -1,8 +1,49 @@
 from rest_framework import serializers
+from loan_api.dynamic_serializer import DynamicFieldsModelSerializer
+from loans import finance
 from payments.models import Payment
 
 
-class PaymentSerializer(serializers.ModelSerializer):
+def validate_payment_for_loan(loan, date, value, total_paid):
+    if date < loan.request_date:
+        raise serializers.ValidationError(
+            {"detail": "Only payments past loan request date are acceptable"},
+            code="before_request_date",
+        )
+
+    if date > loan.maturity_date:
+        raise serializers.ValidationError(
+            {"detail": "Payments past loan maturity date are not acceptable"},
+            code="after_maturity_date",
+        )
+
+    total_debt = loan.get_total_debt
+    if value > total_debt:
+        raise serializers.ValidationError(
+            {"detail": "Payments can not be bigger than total debt"},
+            code="bigger_than_total_debt",
+        )
+
+    if value > finance.balance(total_debt, total_paid):
+        raise serializers.ValidationError(
+            {"detail": "Total payments exceed total debt value"},
+            code="exceeds_total_debt",
+        )
+
+
+class LoanField(serializers.PrimaryKeyRelatedField):
+    """Resolves to the loan given in the context, when it is the one sent."""
+
+    def to_internal_value(self, data):
+        loan = self.context.get("loan")
+        if loan is not None and str(data) == str(loan.pk):
+            return loan
+        return super().to_internal_value(data)
+
+
+class PaymentSerializer(DynamicFieldsModelSerializer):
+    serializer_related_field = LoanField
+
     class Meta:
         model = Payment
         fields = "__all__"
@@ -12,31 +53,27 @@ class PaymentSerializer(serializers.ModelSerializer):
             return Payment.objects.create(**validated_data)
 
     def validate(self, data):
-        if data["date"] < data["loan"].request_date:
-            raise serializers.ValidationError(
-                {"detail": "Only payments past loan request date are acceptable"}
-            )
-
-        if data["date"] > data["loan"].maturity_date:
-            raise serializers.ValidationError(
-                {"detail": "Payments past loan maturity date are not acceptable"}
-            )
-
-        if data["value"] > data["loan"].get_total_debt:
-            raise serializers.ValidationError(
-                {"detail": "Payments can not be bigger than total debt"}
-            )
-
-        if data["value"] + data["loan"].get_total_paid > data["loan"].get_total_debt:
-            raise serializers.ValidationError(
-                {"detail": "Total payments exceed total debt value"}
-            )
-
+        validate_payment_for_loan(
+            loan=data["loan"],
+            date=data["date"],
+            value=data["value"],
+            total_paid=data["loan"].get_total_paid,
+        )
         return data
 
     def validate_value(self, value):
         if value <= 0:
             raise serializers.ValidationError(
-                {"detail": "Payment value must be greater than zero"}
+                {"detail": "Payment value must be greater than zero"},
+                code="not_positive",
             )
         return value
+
+
+class BulkPaymentItemSerializer(PaymentSerializer):
+    """Field checks of one bulk item, the loan checks run per loan group."""
+
+    loan = serializers.IntegerField()
+
+    def validate(self, data):
+        return data
@@ -1,34 +1,81 @@
-from django.shortcuts import get_object_or_404
+from functools import partial
+from django.utils.functional import cached_property
 from rest_framework.viewsets import ReadOnlyModelViewSet
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.exceptions import PermissionDenied
 from payments.models import Payment
 from loans.models import Loan
 from payments.api.serializers import PaymentSerializer
+from loan_api.compiled_serializer import CompiledListMixin
+from loan_api.conditional import conditional_get, make_etag
+from loan_api.ownership import get_owned_object_or_404
 from loan_api.paginations import CustomPagination
+from loan_api.replica import ReplicaReadMixin
+from loan_api.response_cache import ResponseCacheMixin
 
 
-class ListAllPaymentsViewSet(ReadOnlyModelViewSet):
+class ListAllPaymentsViewSet(
+    ReplicaReadMixin, ResponseCacheMixin, CompiledListMixin, ReadOnlyModelViewSet
+):
     permission_classes = [IsAuthenticated]
     pagination_class = CustomPagination
     serializer_class = PaymentSerializer
+    keyset_ordering = ("-date", "id")
 
     def get_queryset(self):
         loans_id = Loan.objects.filter(user=self.request.user).values_list(
             "id", flat=True
         )
-        return Payment.objects.filter(loan__in=loans_id).order_by("-date")
+        return Payment.objects.filter(loan__in=loans_id).order_by(*self.keyset_ordering)
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(
+            request, partial(self.conditional_list, request, *args, **kwargs)
+        )
+
+    def conditional_list(self, request, *args, **kwargs):
+        # Every payment change replaces the version of its loan
+        versions = (
+            Loan.objects.filter(user=request.user)
+            .order_by("pk")
+            .values_list("pk", "version")
+        )
+        return conditional_get(
+            request,
+            make_etag(request, *versions),
+            partial(super().list, request, *args, **kwargs),
+        )
 
 
-class ListPaymentsByLoanViewSet(ReadOnlyModelViewSet):
+class ListPaymentsByLoanViewSet(
+    ReplicaReadMixin, ResponseCacheMixin, CompiledListMixin, ReadOnlyModelViewSet
+):
     permission_classes = [IsAuthenticated]
     pagination_class = CustomPagination
     serializer_class = PaymentSerializer
+    keyset_ordering = ("-date", "id")
+
+    @cached_property
+    def loan(self):
+        return get_owned_object_or_404(
+            Loan.objects.only("pk", "version"),
+            self.request.user,
+            pk=self.kwargs["loan_id"],
+        )
 
     def get_queryset(self):
         if "loan_id" in self.kwargs:
-            loan_id = self.kwargs["loan_id"]
-            loan = get_object_or_404(Loan, pk=loan_id)
-            if self.request.user != loan.user:
-                raise PermissionDenied("Permission Denied")
-            return Payment.objects.filter(loan=loan_id).order_by("-date")
+            return Payment.objects.filter(loan=self.loan.pk).order_by(
+                *self.keyset_ordering
+            )
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(
+            request, partial(self.conditional_list, request, *args, **kwargs)
+        )
+
+    def conditional_list(self, request, *args, **kwargs):
+        return conditional_get(
+            request,
+            make_etag(request, self.loan.pk, self.loan.version),
+            partial(super().list, request, *args, **kwargs),
+        )
@@ -0,0 +1,15 @@
+from django.urls import path, re_path
+from payments import async_views
+
+urlpatterns = [
+    path(
+        "list_all/",
+        async_views.AsyncAllPaymentsList.as_view(),
+        name="list_all_payments-list",
+    ),
+    re_path(
+        r"^list/(?P<loan_id>[^/.]+)/$",
+        async_views.AsyncPaymentsByLoanList.as_view(),
+        name="list_payments_by_loan_id-list",
+    ),
+]
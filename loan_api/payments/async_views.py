@@ -0,0 +1,56 @@
+from loan_api.async_views import AsyncReadView
+from loan_api.compiled_serializer import get_request_plan, project_values
+from loan_api.conditional import aconditional_get, make_etag
+from loan_api.ownership import aget_owned_object_or_404
+from loan_api.paginations import CustomPagination
+from loans.models import Loan
+from payments.api.serializers import PaymentSerializer
+from payments.api.viewsets import ListAllPaymentsViewSet, ListPaymentsByLoanViewSet
+from payments.models import Payment
+
+
+class AsyncPaymentList(AsyncReadView):
+    keyset_ordering = ("-date", "id")
+
+    async def respond(self, request, payments):
+        plan = get_request_plan(request, PaymentSerializer)
+        ordering = [field.lstrip("-") for field in self.keyset_ordering]
+        paginator = CustomPagination()
+        page = await paginator.apaginate_queryset(
+            project_values(payments, plan, *ordering).order_by(*self.keyset_ordering),
+            request,
+            view=self,
+        )
+        data = plan.represent_values(page)
+        return self.render(paginator.get_paginated_response(data).data)
+
+
+class AsyncAllPaymentsList(AsyncPaymentList):
+    sync_view = staticmethod(ListAllPaymentsViewSet.as_view({"get": "list"}))
+
+    async def get(self, request):
+        loans = Loan.objects.filter(user=request.user)
+        # Every payment change replaces the version of its loan
+        versions = [
+            row async for row in loans.order_by("pk").values_list("pk", "version")
+        ]
+        payments = Payment.objects.filter(loan__in=loans.values_list("id", flat=True))
+        return await aconditional_get(
+            request,
+            make_etag(request, *versions),
+            lambda: self.respond(request, payments),
+        )
+
+
+class AsyncPaymentsByLoanList(AsyncPaymentList):
+    sync_view = staticmethod(ListPaymentsByLoanViewSet.as_view({"get": "list"}))
+
+    async def get(self, request, loan_id):
+        loan = await aget_owned_object_or_404(
+            Loan.objects.only("pk", "version"), request.user, pk=loan_id
+        )
+        return await aconditional_get(
+            request,
+            make_etag(request, loan.pk, loan.version),
+            lambda: self.respond(request, Payment.objects.filter(loan=loan.pk)),
+        )
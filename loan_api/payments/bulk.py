@@ -0,0 +1,305 @@
+"""
+Bulk payment ingestion.
+
+Items are read from the request stream one at a time, either from a JSON
+array or from NDJSON lines, and handled in batches: the loans paid are
+locked once, in pk order, then each batch checks ownership and the debt
+limits against the running totals of those loans, inserts the accepted
+payments with bulk_create and moves the stored loan totals with a single
+update. The rollups of their banks and months are moved last, with one
+upsert in key order.
+
+When every item must commit, the items are validated as they are read and
+the loans of the whole request are locked before any payment is written,
+so that requests paying the same loans never wait on each other in a
+cycle across batches.
+"""
+
+import codecs
+import json
+import re
+from collections import defaultdict
+from decimal import Decimal
+from itertools import islice
+from operator import itemgetter
+from django.db import transaction
+from django.db.models import F
+from rest_framework import serializers, status
+from rest_framework.exceptions import ParseError
+from loan_api.metrics import record_payment_rejection
+from loans.models import Loan, LoanRollup, new_version
+from payments.api.serializers import (
+    BulkPaymentItemSerializer,
+    validate_payment_for_loan,
+)
+from payments.models import Payment
+
+BATCH_SIZE = 500
+READ_SIZE = 64 * 1024
+WHITESPACE = re.compile(r"\s*")
+
+
+def iter_ndjson(stream):
+    """Yield one decoded item per line, None for lines that are not JSON."""
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+def iter_json_array(stream, read_size=READ_SIZE):
+    """Yield the items of a JSON array without reading the whole body."""
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer, position, eof = "", 0, False
+
+    def read_more():
+        nonlocal buffer, position, eof
+        if eof:
+            return False
+        chunk = stream.read(read_size)
+        eof = not chunk
+        buffer = buffer[position:] + text.decode(chunk, final=eof)
+        position = 0
+        return True
+
+    def next_char():
+        nonlocal position
+        while True:
+            position = WHITESPACE.match(buffer, position).end()
+            if position < len(buffer) or not read_more():
+                return buffer[position : position + 1]
+
+    if next_char() != "[":
+        raise ParseError("Expected a JSON array")
+    position += 1
+    if next_char() == "]":
+        return
+
+    while True:
+        next_char()
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                item, end = None, None
+            # A value that touches the end of the buffer may continue
+            # in the next chunk, as a number would
+            if end is not None and (end < len(buffer) or eof):
+                break
+            if not read_more():
+                raise ParseError("Malformed JSON array")
+        position = end
+        yield item
+
+        separator = next_char()
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ParseError("Malformed JSON array")
+        position += 1
+
+
+def batched(items, size):
+    items = iter(items)
+    while batch := list(islice(items, size)):
+        yield batch
+
+
+class BulkPaymentIngestion:
+    NOT_COMMITTED = {"detail": "Not committed because other items failed"}
+
+    def __init__(self, user, atomic=True, batch_size=BATCH_SIZE):
+        self.user = user
+        self.atomic = atomic
+        self.batch_size = batch_size
+        self.results = []
+        self.failed = 0
+        self.read = 0
+        self.loans = {}
+        self.loan_errors = {}
+
+    @property
+    def status_code(self):
+        if not self.failed:
+            return status.HTTP_201_CREATED
+        if self.atomic:
+            return status.HTTP_400_BAD_REQUEST
+        return status.HTTP_207_MULTI_STATUS
+
+    def summary(self):
+        self.results.sort(key=itemgetter("index"))
+        return {
+            "committed": sum(
+                result["status"] == status.HTTP_201_CREATED for result in self.results
+            ),
+            "failed": self.failed,
+            "results": self.results,
+        }
+
+    def ingest(self, items):
+        items = self.read_items(items)
+        if not self.atomic:
+            for batch in batched(items, self.batch_size):
+                with transaction.atomic():
+                    self.post(self.validate_items(batch))
+                self.loans = {}
+            return self.results
+
+        items = [
+            item
+            for batch in batched(items, self.batch_size)
+            for item in self.validate_items(batch)
+        ]
+        with transaction.atomic():
+            self.post(items)
+            if self.failed:
+                transaction.set_rollback(True)
+                for result in self.results:
+                    if result["status"] == status.HTTP_201_CREATED:
+                        del result["id"]
+                        result["status"] = status.HTTP_424_FAILED_DEPENDENCY
+                        result["errors"] = self.NOT_COMMITTED
+        return self.results
+
+    def read_items(self, items):
+        # A body that stops parsing fails at the item it stopped on, the
+        # items read before it are still handled
+        try:
+            for item in items:
+                yield self.read, item
+                self.read += 1
+        except ParseError as error:
+            self.add_error(
+                self.read, status.HTTP_400_BAD_REQUEST, {"detail": error.detail}
+            )
+
+    def validate_items(self, batch):
+        items = []
+        for index, item in batch:
+            if not isinstance(item, dict):
+                self.add_error(
+                    index,
+                    status.HTTP_400_BAD_REQUEST,
+                    {"detail": "Each item must be a JSON object"},
+                )
+                continue
+            serializer = BulkPaymentItemSerializer(data=item)
+            if not serializer.is_valid():
+                self.add_error(index, status.HTTP_400_BAD_REQUEST, serializer.errors)
+                continue
+            items.append((index, serializer.validated_data))
+        return items
+
+    def post(self, items):
+        self.lock_loans({data["loan"] for _, data in items})
+        paid = defaultdict(Decimal)
+        for batch in batched(items, self.batch_size):
+            accepted = self.post_batch(batch)
+            for loan_id, value in accepted.items():
+                paid[loan_id] += value
+        if not (self.atomic and self.failed):
+            LoanRollup.objects.add_payments(
+                (self.loans[loan_id], value) for loan_id, value in paid.items()
+            )
+
+    def post_batch(self, items):
+        payments = []
+        accepted = defaultdict(Decimal)
+        for index, data in items:
+            loan_id = data["loan"]
+            if loan_id in self.loan_errors:
+                self.add_error(index, *self.loan_errors[loan_id])
+                continue
+            loan = self.loans[loan_id]
+            try:
+                validate_payment_for_loan(
+                    loan=loan,
+                    date=data["date"],
+                    value=data["value"],
+                    total_paid=loan.get_total_paid + accepted[loan_id],
+                )
+            except serializers.ValidationError as error:
+                self.add_error(index, status.HTTP_400_BAD_REQUEST, error.detail)
+                continue
+            accepted[loan_id] += data["value"]
+            payments.append(
+                (index, Payment(loan=loan, date=data["date"], value=data["value"]))
+            )
+
+        self.save(payments, accepted)
+        return accepted
+
+    def lock_loans(self, loan_ids):
+        # In pk order, as the other writers of loans lock them
+        loan_ids -= self.loans.keys() | self.loan_errors.keys()
+        for chunk in batched(sorted(loan_ids), self.batch_size):
+            for loan in (
+                Loan.objects.select_for_update().filter(pk__in=chunk).order_by("pk")
+            ):
+                if loan.user_id != self.user.pk:
+                    self.loan_errors[loan.pk] = (
+                        status.HTTP_403_FORBIDDEN,
+                        {"detail": "This loan is not bonded with you"},
+                    )
+                else:
+                    self.loans[loan.pk] = loan
+        for loan_id in loan_ids - self.loans.keys() - self.loan_errors.keys():
+            self.loan_errors[loan_id] = (
+                status.HTTP_404_NOT_FOUND,
+                {"detail": "Not found."},
+            )
+
+    def save(self, payments, accepted):
+        if self.atomic and self.failed:
+            # Nothing will be committed, so only the validation is carried on
+            for index, _ in payments:
+                self.results.append(
+                    {
+                        "index": index,
+                        "status": status.HTTP_424_FAILED_DEPENDENCY,
+                        "errors": self.NOT_COMMITTED,
+                    }
+                )
+            self.apply_to_loaded_loans(accepted)
+            return
+
+        created = Payment.objects.bulk_create(
+            [payment for _, payment in payments], batch_size=self.batch_size
+        )
+        for (index, _), payment in zip(payments, created):
+            self.results.append(
+                {"index": index, "status": status.HTTP_201_CREATED, "id": payment.pk}
+            )
+        for loan_id in accepted:
+            self.loans[loan_id].version = new_version()
+        Loan.objects.bulk_update(
+            [
+                Loan(
+                    pk=loan_id,
+                    total_paid=F("total_paid") + value,
+                    outstanding_balance=F("outstanding_balance") - value,
+                    version=self.loans[loan_id].version,
+                )
+                for loan_id, value in accepted.items()
+            ],
+            ["total_paid", "outstanding_balance", "version"],
+        )
+        self.apply_to_loaded_loans(accepted)
+
+    def apply_to_loaded_loans(self, accepted):
+        for loan_id, value in accepted.items():
+            loan = self.loans[loan_id]
+            loan.total_paid += value
+            loan.outstanding_balance -= value
+            loan.invalidate_financials(payments_changed=True)
+
+    def add_error(self, index, status_code, errors):
+        if status_code == status.HTTP_400_BAD_REQUEST:
+            record_payment_rejection(errors)
+        self.failed += 1
+        self.results.append({"index": index, "status": status_code, "errors": errors})
@@ -0,0 +1,136 @@
+import datetime
+import logging
+from decimal import ROUND_DOWN, Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import F
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from loan_api.testing import post_concurrently
+from loans.models import Loan
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        "Post concurrent payments to one loan and to many loans in a throwaway "
+        "test database, and report the throughput and any overpaid loan"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=8,
+            help="Number of clients posting at the same time",
+        )
+        parser.add_argument(
+            "--payments",
+            type=int,
+            default=400,
+            help="Number of payments posted in each scenario",
+        )
+        parser.add_argument(
+            "--loans",
+            type=int,
+            default=50,
+            help="Number of loans paid in the many loans scenario",
+        )
+
+    def handle(self, *args, **options):
+        if not connection.features.has_select_for_update:
+            raise CommandError(
+                f"{connection.vendor} has no row locks to benchmark, "
+                "use a PostgreSQL database"
+            )
+        if options["payments"] < 2 * options["loans"]:
+            raise CommandError("--payments must be at least twice --loans")
+
+        database_name = connection.settings_dict["NAME"]
+        setup_test_environment()
+        # The turned down payments would each log a Bad Request warning
+        logging.disable(logging.WARNING)
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        try:
+            user = User.objects.create(
+                username="benchmark",
+                email="benchmark@test.com",
+                password="benchmark",
+            )
+            inconsistent = self.run_scenario("one loan", user, 1, options)
+            inconsistent += self.run_scenario(
+                "many loans", user, options["loans"], options
+            )
+        finally:
+            connection.creation.destroy_test_db(database_name, verbosity=0)
+            logging.disable(logging.NOTSET)
+            teardown_test_environment()
+
+        if inconsistent:
+            raise CommandError(f"{inconsistent} loans were left inconsistent")
+
+    def run_scenario(self, label, user, loans, options):
+        loans = self.create_loans(user, loans)
+        # Every loan is offered twice the payments its debt can take, so
+        # half of them must be turned down
+        per_loan = options["payments"] // len(loans)
+        accepted_per_loan = per_loan // 2
+        bodies = [
+            {
+                "loan": loan.pk,
+                "value": str(
+                    (loan.total_debt / accepted_per_loan).quantize(
+                        Decimal("0.01"), rounding=ROUND_DOWN
+                    )
+                ),
+                "date": str(loan.request_date),
+            }
+            for _ in range(per_loan)
+            for loan in loans
+        ]
+
+        codes, elapsed = post_concurrently(
+            user, reverse("post_payment"), bodies, options["threads"]
+        )
+        accepted = codes.count(201)
+        rejected = codes.count(400)
+        self.stdout.write(
+            f"{label}: {len(bodies)} payments in {elapsed:.2f}s "
+            f"({len(bodies) / elapsed:.1f}/s), {accepted} accepted, "
+            f"{rejected} rejected"
+        )
+        if accepted + rejected != len(bodies):
+            raise CommandError(f"Unexpected status codes: {set(codes)}")
+
+        loans = Loan.objects.with_financials().filter(
+            pk__in=[loan.pk for loan in loans]
+        )
+        overpaid = loans.filter(total_paid__gt=F("total_debt")).count()
+        drifted = sum(loan.total_paid != loan.paid_amount for loan in loans)
+        expected = accepted_per_loan * len(loans)
+        if overpaid or drifted or accepted != expected:
+            self.stdout.write(
+                self.style.ERROR(
+                    f"{label}: {overpaid} overpaid, {drifted} with drift, "
+                    f"{accepted} accepted where {expected} fit"
+                )
+            )
+        else:
+            self.stdout.write(self.style.SUCCESS(f"{label}: no overpaid loan"))
+        return overpaid + drifted
+
+    def create_loans(self, user, quantity):
+        today = datetime.date.today()
+        return [
+            Loan.objects.create(
+                user=user,
+                nominal_value=Decimal(10000),
+                ip_address="0.0.0.0",
+                interest_rate=Decimal(2),
+                bank="Bank Benchmark",
+                maturity_date=datetime.date(today.year + 1, today.month, 1),
+            )
+            for _ in range(quantity)
+        ]
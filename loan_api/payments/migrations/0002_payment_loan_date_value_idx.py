@@ -0,0 +1,31 @@
+# Generated by Django 5.0.3 on 2026-10-18 13:18
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("loans", "0005_loan_user_request_date_idx"),
+        ("payments", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                fields=["loan", "-date", "id", "value"],
+                name="payment_loan_date_value_idx",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="payment",
+            name="loan",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="loans.loan",
+            ),
+        ),
+    ]
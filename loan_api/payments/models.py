@@ -2,6 +2,16 @@ from django.db import models
 
 
 class Payment(models.Model):
-    loan = models.ForeignKey("loans.Loan", on_delete=models.CASCADE)
+    # payment_loan_date_value_idx leads with the loan, and serves its lookups
+    loan = models.ForeignKey("loans.Loan", on_delete=models.CASCADE, db_index=False)
     date = models.DateField()
     value = models.DecimalField(decimal_places=2, max_digits=12)
+
+    class Meta:
+        indexes = [
+            # value closes the key so that payment sums are index-only scans
+            models.Index(
+                fields=["loan", "-date", "id", "value"],
+                name="payment_loan_date_value_idx",
+            ),
+        ]
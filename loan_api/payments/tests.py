@@ -1,16 +1,40 @@
+import csv
 import datetime
-from decimal import Decimal
+import functools
+import io
+import json
+import threading
+from decimal import ROUND_DOWN, Decimal
+from unittest import mock
+from django.core.management import call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.db.models import F, Sum
+from django.test import TransactionTestCase, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import status
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APITestCase
 from users.models import User
-from loans.models import Loan
+from loans.management.commands import reconcile_loan_balances
+from loans.models import Loan, LoanRollup
 from loans.api.serializers import LoanSerializer
 from payments.models import Payment
 from payments.api.serializers import PaymentSerializer
+from payments.bulk import BulkPaymentIngestion, iter_json_array
+from loan_api.compiled_serializer import get_read_plan
+from loan_api.testing import (
+    CursorAssertions,
+    QueryBudgetAssertions,
+    QueryPlanAssertions,
+    ReadsFromPrimary,
+    post_concurrently,
+)
 
 
-class PaymentTests(APITestCase):
+class PaymentTests(ReadsFromPrimary, CursorAssertions, APITestCase):
     TODAY = datetime.date.today()
     MATURITY_DATE = datetime.date(TODAY.year + 1, TODAY.month, TODAY.day)
     PERMISSION_DENIED_ERROR_MSG = "Permission Denied"
@@ -304,6 +328,24 @@ class PaymentTests(APITestCase):
         )
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
+    def test_post_payment_reads_and_locks_the_loan_once(self):
+        request_body = {
+            "loan": self.test_loan.id,
+            "value": self.test_loan.nominal_value / 10,
+            "date": self.generate_date(months_to_add=1),
+        }
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(reverse("post_payment"), request_body)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        loan_reads = [
+            query["sql"]
+            for query in context.captured_queries
+            if query["sql"].startswith("SELECT") and '"loans_loan"' in query["sql"]
+        ]
+        self.assertEqual(len(loan_reads), 1)
+        if connection.features.has_select_for_update:
+            self.assertIn("FOR UPDATE", loan_reads[0])
+
     # Tests for get payments list
     def test_get_all_user_payments_list(self):
         response = self.client.get("/api/payments/list_all/")
@@ -349,3 +391,610 @@ class PaymentTests(APITestCase):
         self.assertEqual(len(response.data["results"]), 0)
         self.assertEqual(response.data["count"], 0)
         self.assertTrue("links" in response.data.keys())
+
+    def test_get_all_user_payments_list_with_cursor_pagination(self):
+        response = self.client.get(
+            "/api/payments/list_all/?pagination=cursor&page_size=2"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["results"]), 2)
+        self.assertNotIn("count", response.data)
+        next_page = self.client.get(response.data["links"]["next"])
+        self.assertEqual(len(next_page.data["results"]), 1)
+        self.assertIsNone(next_page.data["links"]["next"])
+        ids = [
+            payment["id"]
+            for payment in response.data["results"] + next_page.data["results"]
+        ]
+        self.assertEqual(
+            ids,
+            list(
+                Payment.objects.filter(loan__user=self.test_user)
+                .order_by("-date", "id")
+                .values_list("id", flat=True)
+            ),
+        )
+
+    def test_get_all_user_payments_list_with_malformed_cursor_values(self):
+        self.assertMalformedCursorsNotFound("/api/payments/list_all/")
+
+    def test_get_all_payments_from_a_loan_with_cursor_pagination(self):
+        response = self.client.get(
+            f"/api/payments/list/{self.test_loan.pk}/?pagination=cursor&count=exact"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["results"]), 2)
+        self.assertEqual(response.data["count"], 2)
+        self.assertIsNone(response.data["links"]["next"])
+
+    def test_payment_lists_with_sparse_fieldsets(self):
+        for url in [
+            "/api/payments/list_all/",
+            f"/api/payments/list/{self.test_loan.pk}/",
+        ]:
+            full = self.client.get(url).data["results"]
+            response = self.client.get(url, {"fields": "value,loan"})
+            self.assertEqual(
+                response.data["results"],
+                [
+                    {"value": payment["value"], "loan": payment["loan"]}
+                    for payment in full
+                ],
+            )
+
+            response = self.client.get(
+                url, {"fields": "value", "pagination": "cursor", "page_size": 1}
+            )
+            values = [payment["value"] for payment in response.data["results"]]
+            while response.data["links"]["next"]:
+                response = self.client.get(response.data["links"]["next"])
+                values += [payment["value"] for payment in response.data["results"]]
+            self.assertEqual(values, [payment["value"] for payment in full])
+
+            response = self.client.get(url, {"fields": "value,amount"})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_payment_lists_are_not_modified_until_a_payment_changes(self):
+        urls = ("/api/payments/list_all/", f"/api/payments/list/{self.test_loan.pk}/")
+        etags = [self.client.get(url)["ETag"] for url in urls]
+        for url, etag in zip(urls, etags):
+            response = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(response["ETag"], etag)
+
+        self.test_payment.delete()
+        for url, etag in zip(urls, etags):
+            response = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(response["ETag"], etag)
+
+    def test_payments_of_other_loans_keep_the_loan_list_etag(self):
+        url = f"/api/payments/list/{self.test_loan.pk}/"
+        etag = self.client.get(url)["ETag"]
+        self.test_payment_loan2.delete()
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        # Another page is another representation
+        response = self.client.get(
+            f"{url}?page_size=1", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    # Tests for bulk payments
+    def post_bulk_payments(self, items, commit="all", ndjson=False):
+        if ndjson:
+            body = "\n".join(
+                (
+                    item
+                    if isinstance(item, str)
+                    else json.dumps(item, cls=DjangoJSONEncoder)
+                )
+                for item in items
+            )
+            content_type = "application/x-ndjson"
+        else:
+            body = json.dumps(items, cls=DjangoJSONEncoder)
+            content_type = "application/json"
+        return self.client.post(
+            f"{reverse('post_payments_bulk')}?commit={commit}",
+            body,
+            content_type=content_type,
+        )
+
+    def bulk_payment(self, loan, value=Decimal(100.00), months_to_add=1):
+        return {
+            "loan": loan.id,
+            "value": value,
+            "date": self.generate_date(months_to_add=months_to_add),
+        }
+
+    def test_compiled_serializer_matches_payment_serializer(self):
+        for value in ["0.01", "12.50", "999.99"]:
+            Payment.objects.create(
+                loan=self.test_loan, date=self.TODAY, value=Decimal(value)
+            )
+        unsaved = Payment(loan_id=self.test_loan2.pk, date=self.TODAY, value=2.675)
+        plan = get_read_plan(PaymentSerializer)
+        payments = [*Payment.objects.order_by("id"), unsaved]
+        renderer = JSONRenderer()
+        expected = renderer.render(PaymentSerializer(payments, many=True).data)
+        self.assertEqual(renderer.render(plan.represent_many(payments)), expected)
+
+        rows = Payment.objects.order_by("id").values(*plan.value_fields)
+        expected = renderer.render(PaymentSerializer(payments[:-1], many=True).data)
+        self.assertEqual(renderer.render(plan.represent_values(rows)), expected)
+
+    def test_post_bulk_payments(self):
+        items = [self.bulk_payment(self.test_loan), self.bulk_payment(self.test_loan2)]
+        response = self.post_bulk_payments(items * 3)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["committed"], 6)
+        self.assertEqual(response.data["failed"], 0)
+        self.assertEqual(
+            [result["index"] for result in response.data["results"]], list(range(6))
+        )
+        created = Payment.objects.filter(
+            id__in=[result["id"] for result in response.data["results"]]
+        )
+        self.assertEqual(created.count(), 6)
+        loan = Loan.objects.get(pk=self.test_loan.pk)
+        self.assertEqual(loan.total_paid, Decimal(3300.00))
+        self.assertEqual(loan.outstanding_balance, loan.total_debt - Decimal(3300.00))
+
+    def test_post_bulk_payments_with_query_count_independent_of_items(self):
+        queries = []
+        for quantity in (5, 50):
+            items = [self.bulk_payment(self.test_loan, value=Decimal(1.00))] * quantity
+            with CaptureQueriesContext(connection) as context:
+                response = self.post_bulk_payments(items)
+            self.assertEqual(response.data["committed"], quantity)
+            queries.append(len(context.captured_queries))
+        self.assertEqual(queries[0], queries[1])
+
+    def test_post_bulk_payments_committing_each_item(self):
+        items = [
+            self.bulk_payment(self.test_loan),
+            {**self.bulk_payment(self.test_loan), "value": 0},
+            self.bulk_payment(self.test_loan_user2),
+            {**self.bulk_payment(self.test_loan), "loan": self.test_loan.pk + 9999},
+            "not json",
+            self.bulk_payment(self.test_loan2),
+        ]
+        response = self.post_bulk_payments(items, commit="item", ndjson=True)
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(response.data["committed"], 2)
+        self.assertEqual(
+            [result["status"] for result in response.data["results"]],
+            [201, 400, 403, 404, 400, 201],
+        )
+        self.assertEqual(
+            str(response.data["results"][1]["errors"]["value"]["detail"]),
+            self.INVALID_PAYMENT_VALUE_ERROR_MSG,
+        )
+        self.assertEqual(Payment.objects.count(), 5)
+
+    def test_post_bulk_payments_all_or_nothing(self):
+        remaining_debt = self.test_loan.get_total_debt - self.test_loan.get_total_paid
+        items = [
+            self.bulk_payment(self.test_loan2),
+            self.bulk_payment(self.test_loan, value=remaining_debt - 1),
+            self.bulk_payment(self.test_loan, value=Decimal(2.00)),
+        ]
+        response = self.post_bulk_payments(items)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["committed"], 0)
+        self.assertEqual(
+            [result["status"] for result in response.data["results"]],
+            [424, 424, 400],
+        )
+        self.assertEqual(
+            str(response.data["results"][2]["errors"]["detail"]),
+            self.TOTAL_PAYMENTS_EXCEEDS_TOTAL_DEBT_ERROR_MSG,
+        )
+        self.assertEqual(Payment.objects.count(), 3)
+        self.assertEqual(
+            Loan.objects.get(pk=self.test_loan2.pk).total_paid, Decimal(2000.00)
+        )
+
+    def test_post_bulk_payments_with_malformed_array(self):
+        response = self.client.post(
+            reverse("post_payments_bulk"),
+            json.dumps([self.bulk_payment(self.test_loan)], cls=DjangoJSONEncoder)[:-1],
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Payment.objects.count(), 3)
+
+    def test_post_bulk_payments_without_a_token(self):
+        self.client.logout()
+        response = self.post_bulk_payments([self.bulk_payment(self.test_loan)])
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_json_array_is_read_in_chunks(self):
+        items = [{"value": 12345, "text": "ção"}, 678, [1, 2], None, "x"]
+        body = json.dumps(items, ensure_ascii=False).encode()
+        for read_size in (1, 2, 7, 1024):
+            self.assertEqual(
+                list(iter_json_array(io.BytesIO(body), read_size=read_size)), items
+            )
+        self.assertEqual(list(iter_json_array(io.BytesIO(b" [ ] "))), [])
+        for body in (b"", b"{}", b"[1 2]", b"[1,", b'[{"a": }]'):
+            with self.assertRaises(ParseError):
+                list(iter_json_array(io.BytesIO(body), read_size=2))
+
+    # Tests for payment export
+    def export_payments(self, export_format):
+        response = self.client.get(f"/api/payments/export/?format={export_format}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content).decode()
+
+    def test_export_payments_as_ndjson(self):
+        Payment.objects.create(
+            loan=self.test_loan_user2,
+            date=self.generate_date(months_to_add=1),
+            value=Decimal(500.00),
+        )
+        exported = [
+            json.loads(line) for line in self.export_payments("ndjson").splitlines()
+        ]
+        payments = Payment.objects.filter(loan__user=self.test_user).order_by("pk")
+        self.assertEqual(
+            exported,
+            json.loads(
+                json.dumps(
+                    PaymentSerializer(payments, many=True).data, cls=DjangoJSONEncoder
+                )
+            ),
+        )
+
+    def test_export_payments_as_csv(self):
+        rows = list(csv.reader(io.StringIO(self.export_payments("csv"))))
+        self.assertEqual(rows[0], ["id", "date", "value", "loan"])
+        self.assertEqual(
+            rows[1],
+            [
+                str(self.test_payment.pk),
+                str(self.test_payment.date),
+                "1000.00",
+                str(self.test_loan.pk),
+            ],
+        )
+        self.assertEqual(len(rows), 4)
+
+    def test_export_payments_without_a_token(self):
+        self.client.logout()
+        response = self.client.get("/api/payments/export/?format=csv")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class PaymentQueryPlanTests(ReadsFromPrimary, QueryPlanAssertions, APITestCase):
+    TODAY = datetime.date.today()
+    TABLES = {"loans_loan", "payments_payment"}
+
+    def setUp(self):
+        self.test_user = User.objects.create(
+            username="test-user",
+            email="test-user@test.com",
+            password="test-password",
+        )
+        self.test_user2 = User.objects.create(
+            username="test-user2",
+            email="test-user2@test.com",
+            password="test-password2",
+        )
+        self.loans = []
+        for user in (self.test_user, self.test_user2):
+            for _ in range(5):
+                loan = Loan.objects.create(
+                    user=user,
+                    nominal_value=Decimal(100000.00),
+                    ip_address="0.0.0.0",
+                    interest_rate=Decimal(1.5),
+                    bank="Bank Test",
+                    maturity_date=self.TODAY + datetime.timedelta(days=365),
+                )
+                self.loans.append(loan)
+                for days in range(20):
+                    Payment.objects.create(
+                        loan=loan,
+                        date=self.TODAY + datetime.timedelta(days=days),
+                        value=Decimal(10.00),
+                    )
+        self.client.force_authenticate(self.test_user)
+
+    def test_payments_by_loan_list_uses_indexes(self):
+        url = f"/api/payments/list/{self.loans[0].pk}/"
+        self.assertQueryPlansUseIndexes(f"{url}?page=2", self.TABLES)
+        response = self.assertQueryPlansUseIndexes(
+            f"{url}?pagination=cursor", self.TABLES
+        )
+        self.assertQueryPlansUseIndexes(response.data["links"]["next"], self.TABLES)
+
+    def test_foreign_keys_are_served_by_the_composite_indexes(self):
+        # The composite indexes lead with the foreign keys, so a single
+        # column index of their own would only slow the inserts down
+        with connection.cursor() as cursor:
+            for table, column in (
+                ("loans_loan", "user_id"),
+                ("payments_payment", "loan_id"),
+            ):
+                constraints = connection.introspection.get_constraints(cursor, table)
+                indexes = [
+                    constraint["columns"]
+                    for constraint in constraints.values()
+                    if constraint["index"]
+                ]
+                self.assertNotIn([column], indexes)
+                self.assertIn(column, [columns[0] for columns in indexes])
+
+    def test_all_payments_list_uses_indexes(self):
+        # Payments of several loans are merged by date, so a sort is expected.
+        # It only covers the payments of one user, which the loan index finds
+        self.assertQueryPlansUseIndexes(
+            "/api/payments/list_all/?page=2", self.TABLES, allow_sort=True
+        )
+
+    def test_payment_detail_uses_indexes(self):
+        payment = Payment.objects.filter(loan=self.loans[0]).first()
+        self.assertQueryPlansUseIndexes(
+            reverse("payment_methods", args=[payment.pk]), self.TABLES
+        )
+
+    def test_loan_payments_sum_uses_indexes(self):
+        with CaptureQueriesContext(connection) as context:
+            list(Loan.objects.filter(user=self.test_user).with_financials())
+        for line in self.explain(context.captured_queries[0]["sql"]):
+            self.assertNotRegex(line, r"^SCAN payments_payment|Seq Scan on payments")
+
+
+class PaymentQueryBudgetTests(ReadsFromPrimary, QueryBudgetAssertions, APITestCase):
+    TODAY = datetime.date.today()
+
+    def setUp(self):
+        self.test_user = User.objects.create(
+            username="test-user",
+            email="test-user@test.com",
+            password="test-password",
+        )
+        self.test_user2 = User.objects.create(
+            username="test-user2",
+            email="test-user2@test.com",
+            password="test-password2",
+        )
+        for user in (self.test_user, self.test_user2):
+            for _ in range(3):
+                loan = Loan.objects.create(
+                    user=user,
+                    nominal_value=Decimal(1000.00),
+                    ip_address="0.0.0.0",
+                    interest_rate=Decimal(1.5),
+                    bank="Bank Test",
+                    maturity_date=self.TODAY + datetime.timedelta(days=365),
+                )
+                for _ in range(3):
+                    Payment.objects.create(
+                        loan=loan, date=self.TODAY, value=Decimal(10.00)
+                    )
+        self.test_loan = Loan.objects.filter(user=self.test_user).first()
+        self.test_loan_user2 = Loan.objects.filter(user=self.test_user2).first()
+        self.test_payment = Payment.objects.filter(loan=self.test_loan).first()
+        self.test_payment_user2 = Payment.objects.filter(
+            loan=self.test_loan_user2
+        ).first()
+        self.client.force_authenticate(self.test_user)
+
+    def payment_body(self, loan):
+        return {"loan": loan.pk, "value": "10.00", "date": str(self.TODAY)}
+
+    def test_get_payment_query_budget(self):
+        url = reverse("payment_methods", args=[self.test_payment.pk])
+        self.assertQueryBudget(1, "get", url)
+
+    def test_get_payment_from_another_user_query_budget(self):
+        url = reverse("payment_methods", args=[self.test_payment_user2.pk])
+        self.assertQueryBudget(1, "get", url, status_code=status.HTTP_403_FORBIDDEN)
+
+    def test_get_nonexistent_payment_query_budget(self):
+        url = reverse("payment_methods", args=[0])
+        self.assertQueryBudget(1, "get", url, status_code=status.HTTP_404_NOT_FOUND)
+
+    def test_delete_payment_query_budget(self):
+        url = reverse("payment_methods", args=[self.test_payment.pk])
+        # Read, then savepoint, delete, loan update, rollup key read, rollup
+        # upsert and release
+        self.assertQueryBudget(7, "delete", url, status_code=status.HTTP_204_NO_CONTENT)
+
+    def test_post_payment_query_budget(self):
+        # Savepoint, locked loan read, insert, loan update, rollup upsert and
+        # release
+        self.assertQueryBudget(
+            6,
+            "post",
+            reverse("post_payment"),
+            self.payment_body(self.test_loan),
+            status_code=status.HTTP_201_CREATED,
+        )
+
+    def test_post_payment_in_another_user_loan_query_budget(self):
+        self.assertQueryBudget(
+            4,
+            "post",
+            reverse("post_payment"),
+            self.payment_body(self.test_loan_user2),
+            status_code=status.HTTP_403_FORBIDDEN,
+        )
+
+    def test_post_bulk_payments_query_budget(self):
+        # Savepoint, locked loans read, insert, loans update, rollup upsert and
+        # release
+        self.assertQueryBudget(
+            6,
+            "post",
+            reverse("post_payments_bulk"),
+            [self.payment_body(self.test_loan)] * 20,
+            status_code=status.HTTP_201_CREATED,
+        )
+
+    def test_get_all_payments_list_query_budget(self):
+        # Loan versions for the ETag, then count and page
+        self.assertQueryBudget(3, "get", "/api/payments/list_all/")
+        self.assertQueryBudget(2, "get", "/api/payments/list_all/?pagination=cursor")
+
+    def test_get_all_payments_from_a_loan_query_budget(self):
+        url = f"/api/payments/list/{self.test_loan.pk}/"
+        self.assertQueryBudget(3, "get", url)
+        self.assertQueryBudget(2, "get", f"{url}?pagination=cursor")
+
+    def test_not_modified_payment_lists_query_budget(self):
+        for url in (
+            "/api/payments/list_all/",
+            f"/api/payments/list/{self.test_loan.pk}/",
+        ):
+            etag = self.client.get(url)["ETag"]
+            self.assertQueryBudget(
+                1,
+                "get",
+                url,
+                status_code=status.HTTP_304_NOT_MODIFIED,
+                headers={"If-None-Match": etag},
+            )
+
+    def test_get_all_payments_from_another_user_loan_query_budget(self):
+        url = f"/api/payments/list/{self.test_loan_user2.pk}/"
+        self.assertQueryBudget(1, "get", url, status_code=status.HTTP_403_FORBIDDEN)
+
+    def test_export_payments_query_budget(self):
+        self.assertQueryBudget(1, "get", reverse("export_payments"))
+
+
+@skipUnlessDBFeature("has_select_for_update")
+class PaymentConcurrencyTests(ReadsFromPrimary, TransactionTestCase):
+    TODAY = datetime.date.today()
+    THREADS = 8
+
+    def setUp(self):
+        self.test_user = User.objects.create(
+            username="test-user",
+            email="test-user@test.com",
+            password="test-password",
+        )
+
+    def create_loans(self, quantity):
+        return [
+            Loan.objects.create(
+                user=self.test_user,
+                nominal_value=Decimal(1000.00),
+                ip_address="0.0.0.0",
+                interest_rate=Decimal(2),
+                bank="Bank Test",
+                maturity_date=self.TODAY + datetime.timedelta(days=365),
+            )
+            for _ in range(quantity)
+        ]
+
+    def post_concurrent_payments(self, loans, payments_per_loan):
+        # Each payment is a third of the debt, so only three fit per loan
+        bodies = [
+            {
+                "loan": loan.pk,
+                "value": str(
+                    (loan.total_debt / 3).quantize(Decimal("0.01"), ROUND_DOWN)
+                ),
+                "date": str(self.TODAY),
+            }
+            for _ in range(payments_per_loan)
+            for loan in loans
+        ]
+        codes, _ = post_concurrently(
+            self.test_user, reverse("post_payment"), bodies, self.THREADS
+        )
+        self.assertEqual(codes.count(status.HTTP_201_CREATED), 3 * len(loans))
+        self.assertEqual(
+            codes.count(status.HTTP_400_BAD_REQUEST), len(bodies) - 3 * len(loans)
+        )
+
+        loans = Loan.objects.with_financials().filter(
+            pk__in=[loan.pk for loan in loans]
+        )
+        self.assertFalse(loans.filter(total_paid__gt=F("total_debt")).exists())
+        for loan in loans:
+            self.assertEqual(loan.total_paid, loan.paid_amount)
+            self.assertEqual(
+                loan.outstanding_balance, loan.total_debt - loan.total_paid
+            )
+
+    def test_concurrent_payments_to_one_loan(self):
+        self.post_concurrent_payments(self.create_loans(1), payments_per_loan=16)
+
+    def test_concurrent_payments_to_many_loans(self):
+        self.post_concurrent_payments(self.create_loans(4), payments_per_loan=6)
+
+    def post_concurrent_bulk_payments(self, url):
+        # Each request pays the same loans in another order, two per batch,
+        # so that the later batches lock loans the earlier ones of other
+        # requests hold
+        loans = self.create_loans(8)
+        bodies = [
+            [
+                {"loan": loan.pk, "value": "10.00", "date": str(self.TODAY)}
+                for loan in loans[offset:] + loans[:offset]
+            ][:: -1 if offset % 2 else 1]
+            for offset in range(self.THREADS)
+        ]
+        with mock.patch(
+            "payments.views.BulkPaymentIngestion",
+            functools.partial(BulkPaymentIngestion, batch_size=2),
+        ):
+            codes, _ = post_concurrently(self.test_user, url, bodies, self.THREADS)
+        self.assertEqual(codes, [status.HTTP_201_CREATED] * self.THREADS)
+
+        for loan in Loan.objects.with_financials().filter(
+            pk__in=[loan.pk for loan in loans]
+        ):
+            self.assertEqual(loan.paid_amount, Decimal(10.00) * self.THREADS)
+            self.assertEqual(loan.total_paid, loan.paid_amount)
+        self.assertEqual(
+            LoanRollup.objects.aggregate(total=Sum("total_paid"))["total"],
+            Decimal(10.00) * self.THREADS * len(loans),
+        )
+
+    def test_concurrent_bulk_payments_to_the_same_loans(self):
+        self.post_concurrent_bulk_payments(reverse("post_payments_bulk"))
+
+    def test_concurrent_bulk_payments_committing_each_item(self):
+        self.post_concurrent_bulk_payments(
+            reverse("post_payments_bulk") + "?commit=item"
+        )
+
+    def test_payment_posted_while_balances_are_reconciled(self):
+        (loan,) = self.create_loans(1)
+        Payment.objects.create(loan=loan, date=self.TODAY, value=Decimal(100.00))
+        Loan.objects.filter(pk=loan.pk).update(total_paid=0)
+        body = {"loan": loan.pk, "value": "50.00", "date": str(self.TODAY)}
+        results = []
+        poster = threading.Thread(
+            target=lambda: results.append(
+                post_concurrently(self.test_user, reverse("post_payment"), [body], 1)
+            )
+        )
+        reconcile = reconcile_loan_balances.Command.reconcile
+
+        def reconcile_while_posting(command, loan):
+            # The payment is posted once the chunk is read, and given time to
+            # land before the fix is written
+            poster.start()
+            poster.join(timeout=1)
+            return reconcile(command, loan)
+
+        with mock.patch.object(
+            reconcile_loan_balances.Command, "reconcile", reconcile_while_posting
+        ):
+            call_command("reconcile_loan_balances", stdout=io.StringIO())
+        poster.join()
+        codes, _ = results[0]
+        self.assertEqual(codes, [status.HTTP_201_CREATED])
+        loan = Loan.objects.with_financials().get(pk=loan.pk)
+        self.assertEqual(loan.paid_amount, Decimal(150.00))
+        self.assertEqual(loan.total_paid, Decimal(150.00))
+        self.assertEqual(loan.outstanding_balance, loan.total_debt - loan.total_paid)
@@ -14,6 +14,8 @@ router.register(
 
 urlpatterns = [
     path("", views.PaymentPost.as_view(), name="post_payment"),
+    path("bulk/", views.PaymentBulkPost.as_view(), name="post_payments_bulk"),
+    path("export/", views.PaymentExport.as_view(), name="export_payments"),
     path("<int:id>/", views.PaymentView.as_view(), name="payment_methods"),
     path("", include(router.urls)),
 ]
@@ -1,23 +1,34 @@
+import io
+from django.db import transaction
 from django.http import Http404
-from django.shortcuts import get_object_or_404
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import UnsupportedMediaType, ValidationError
+from loan_api.metrics import PAYMENTS_POSTED, record_payment_rejection
+from loan_api.ownership import get_owned_object_or_404
+from loan_api.replica import ReplicaReadMixin, read_database
+from loan_api.response_cache import invalidate
+from loan_api.exports import (
+    CSVRenderer,
+    NDJSONRenderer,
+    export_response,
+    iter_chunks,
+)
 from loans.models import Loan
 from payments.api.serializers import PaymentSerializer
+from payments.bulk import BulkPaymentIngestion, iter_json_array, iter_ndjson
 from payments.models import Payment
 
 
-class PaymentView(APIView):
+class PaymentView(ReplicaReadMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def retrieve_valid_payment(self, request, payment_id):
-        payment = get_object_or_404(Payment, pk=payment_id)
-        if request.user != payment.loan.user:
-            raise PermissionDenied("Permission Denied")
-        return payment
+        return get_owned_object_or_404(
+            Payment.objects, request.user, owner="loan__user", pk=payment_id
+        )
 
     def get(self, request, id):
         payment = self.retrieve_valid_payment(request=request, payment_id=id)
@@ -26,22 +37,77 @@ class PaymentView(APIView):
 
     def delete(self, request, id):
         payment = self.retrieve_valid_payment(request=request, payment_id=id)
-        payment.delete()
+        with transaction.atomic():
+            payment.delete()
+            invalidate(request.user.pk)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class PaymentPost(APIView):
+class PaymentPost(ReplicaReadMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        loan = get_object_or_404(Loan, pk=request.data["loan"])
+        # Only the loan being paid is locked, so payments to the same loan
+        # are checked one after the other and other loans are not held up
+        with transaction.atomic():
+            loan = get_owned_object_or_404(
+                Loan.objects.select_for_update(),
+                request.user,
+                message="This loan is not bonded with you",
+                pk=request.data["loan"],
+            )
 
-        if loan.user != request.user:
-            raise PermissionDenied("This loan is not bonded with you")
-
-        serializer = PaymentSerializer(data=request.data)
-        if serializer.is_valid(raise_exception=True):
+            serializer = PaymentSerializer(data=request.data, context={"loan": loan})
+            if not serializer.is_valid():
+                record_payment_rejection(serializer.errors)
+                raise ValidationError(serializer.errors)
             serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        PAYMENTS_POSTED.inc()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class PaymentBulkPost(ReplicaReadMixin, APIView):
+    permission_classes = [IsAuthenticated]
+    NDJSON_MEDIA_TYPES = ("application/x-ndjson", "application/jsonl")
+
+    def post(self, request):
+        # The body is read straight from the stream, never through request.data
+        stream = request.stream or io.BytesIO()
+        media_type = request.content_type.split(";")[0].strip()
+        if media_type in self.NDJSON_MEDIA_TYPES:
+            items = iter_ndjson(stream)
+        elif media_type == "application/json":
+            items = iter_json_array(stream)
+        else:
+            raise UnsupportedMediaType(media_type)
+
+        ingestion = BulkPaymentIngestion(
+            user=request.user,
+            atomic=request.query_params.get("commit", "all") != "item",
+        )
+        ingestion.ingest(items)
+        # bulk_create sends no signals
+        invalidate(request.user.pk)
+        summary = ingestion.summary()
+        PAYMENTS_POSTED.inc(summary["committed"])
+        return Response(summary, status=ingestion.status_code)
+
+
+class PaymentExport(ReplicaReadMixin, APIView):
+    permission_classes = [IsAuthenticated]
+    renderer_classes = [NDJSONRenderer, CSVRenderer]
+    FIELDS = ("id", "date", "value", "loan")
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    def get(self, request):
+        payments = (
+            Payment.objects.using(read_database())
+            .filter(loan__user=request.user)
+            .order_by("pk")
+            .values_list(*self.FIELDS)
+        )
+        return export_response(
+            request,
+            fields=self.FIELDS,
+            chunks=iter_chunks(payments),
+            filename="payments",
+        )
@@ -0,0 +1,232 @@
+"""
+Token authentication with the token lookup cached in process.
+
+TokenAuthentication joins Token and User on every request. Here the pair it
+resolves is kept per token key in an LRU cache whose entries expire after
+TOKEN_CACHE["TTL"] seconds. When TOKEN_CACHE["BACKEND"] names one of the
+CACHES, a local miss is looked up there before reaching the database, so
+the processes of a deployment share their lookups.
+
+The async read views authenticate through aauthenticate, which goes through
+the same cache and reads the token with the async ORM on a miss.
+
+Entries are dropped when their token is saved or deleted and when its user
+is saved, which covers rotating a token and deactivating a user.
+
+Hits, misses and evictions are counted by info() and published on /metrics. Other
+processes only learn of it through the shared cache or once their local
+entry expires, as do changes that skip signals, like QuerySet.update.
+"""
+
+import copy
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.authtoken.models import Token
+
+DEFAULT_SETTINGS = {"MAX_SIZE": 10000, "TTL": 60, "BACKEND": None}
+KEY_PREFIX = "auth-token:"
+
+
+class TokenCache:
+    def __init__(self, max_size, ttl, backend=None, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = caches[backend] if backend else None
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # loan_api.metrics imports the REST framework views, which import
+        # this module for DEFAULT_AUTHENTICATION_CLASSES
+        from loan_api.metrics import (
+            TOKEN_CACHE_EVICTIONS,
+            TOKEN_CACHE_HITS,
+            TOKEN_CACHE_MISSES,
+        )
+
+        self.hit_counter = TOKEN_CACHE_HITS
+        self.miss_counter = TOKEN_CACHE_MISSES
+        self.eviction_counter = TOKEN_CACHE_EVICTIONS
+
+    def get(self, key):
+        found, value = self.lookup(key)
+        if not found:
+            value = self.backend.get(KEY_PREFIX + key) if self.backend else None
+            value = self.remember(key, value)
+        return value
+
+    async def aget(self, key):
+        found, value = self.lookup(key)
+        if not found:
+            value = await self.backend.aget(KEY_PREFIX + key) if self.backend else None
+            value = self.remember(key, value)
+        return value
+
+    def lookup(self, key):
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.hit_counter.inc()
+                return True, entry[0]
+            self.entries.pop(key, None)
+        return False, None
+
+    def remember(self, key, value):
+        """Count a local miss and keep what the backend had for it, if any."""
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                self.miss_counter.inc()
+                return None
+            self.hits += 1
+            self.hit_counter.inc()
+        self.store(key, value)
+        return value
+
+    def set(self, key, value):
+        if self.backend:
+            self.backend.set(KEY_PREFIX + key, value, timeout=self.ttl)
+        self.store(key, value)
+
+    async def aset(self, key, value):
+        if self.backend:
+            await self.backend.aset(KEY_PREFIX + key, value, timeout=self.ttl)
+        self.store(key, value)
+
+    def store(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, self.clock() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+                self.eviction_counter.inc()
+
+    def delete(self, key):
+        if self.backend:
+            self.backend.delete(KEY_PREFIX + key)
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self.entries),
+                "max_size": self.max_size,
+            }
+
+
+@lru_cache(maxsize=None)
+def get_token_cache():
+    options = {**DEFAULT_SETTINGS, **getattr(settings, "TOKEN_CACHE", {})}
+    return TokenCache(
+        max_size=options["MAX_SIZE"],
+        ttl=options["TTL"],
+        backend=options["BACKEND"],
+    )
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate(self, request):
+        key = self.get_key(request)
+        if key is None:
+            return None
+        return self.authenticate_credentials(key)
+
+    def authenticate_credentials(self, key):
+        cache = get_token_cache()
+        cached = cache.get(key)
+        if cached is None:
+            cached = super().authenticate_credentials(key)
+            cache.set(key, cached)
+        return self.own_copies(cached)
+
+    async def aauthenticate(self, request):
+        """authenticate() for the async views, reading through the async ORM."""
+        key = self.get_key(request)
+        if key is None:
+            return None
+        cache = get_token_cache()
+        cached = await cache.aget(key)
+        if cached is None:
+            try:
+                token = await Token.objects.select_related("user").aget(key=key)
+            except Token.DoesNotExist:
+                raise AuthenticationFailed(_("Invalid token."))
+            if not token.user.is_active:
+                raise AuthenticationFailed(_("User inactive or deleted."))
+            cached = (token.user, token)
+            await cache.aset(key, cached)
+        return self.own_copies(cached)
+
+    def get_key(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) == 1:
+            raise AuthenticationFailed(
+                _("Invalid token header. No credentials provided.")
+            )
+        if len(auth) > 2:
+            raise AuthenticationFailed(
+                _("Invalid token header. Token string should not contain spaces.")
+            )
+        try:
+            return auth[1].decode()
+        except UnicodeError:
+            raise AuthenticationFailed(
+                _(
+                    "Invalid token header. "
+                    "Token string should not contain invalid characters."
+                )
+            )
+
+    @staticmethod
+    def own_copies(cached):
+        # Each request gets its own copies, the cached ones stay untouched
+        user, token = map(copy.copy, cached)
+        token.user = user
+        return user, token
+
+
+@receiver(setting_changed)
+def reset_token_cache(setting, **kwargs):
+    if setting == "TOKEN_CACHE":
+        get_token_cache.cache_clear()
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance=None, **kwargs):
+    get_token_cache().delete(instance.key)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_user_tokens(sender, instance=None, created=False, **kwargs):
+    if created:
+        return
+    for key in Token.objects.filter(user=instance).values_list("key", flat=True):
+        get_token_cache().delete(key)
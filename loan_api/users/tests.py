@@ -1,3 +1,129 @@
-from django.test import TestCase
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from prometheus_client import REGISTRY
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase
+from users.authentication import TokenCache, get_token_cache
+from loan_api.testing import ReadsFromPrimary
+from users.models import User
 
-# Create your tests here.
+
+class TokenAuthenticationTests(ReadsFromPrimary, APITestCase):
+    URL = "/api/loans/summary/"
+
+    def setUp(self):
+        self.test_user = User.objects.create(
+            username="test-user",
+            email="test-user@test.com",
+            password="test-password",
+        )
+        self.token = Token.objects.get(user=self.test_user)
+        get_token_cache().clear()
+
+    def get(self, token=None):
+        token = token or self.token
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.URL)
+        auth_queries = [
+            query
+            for query in context.captured_queries
+            if "authtoken_token" in query["sql"]
+        ]
+        return response, len(auth_queries)
+
+    def test_repeated_requests_do_no_auth_queries(self):
+        response, auth_queries = self.get()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(auth_queries, 1)
+        for _ in range(3):
+            response, auth_queries = self.get()
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(auth_queries, 0)
+        info = get_token_cache().info()
+        self.assertEqual((info["hits"], info["misses"]), (3, 1))
+
+    def test_token_cache_counts_are_published(self):
+        def sample(name):
+            return REGISTRY.get_sample_value(f"token_cache_{name}_total") or 0
+
+        before = {name: sample(name) for name in ("hits", "misses", "evictions")}
+        for _ in range(3):
+            self.get()
+        self.assertEqual(sample("hits"), before["hits"] + 2)
+        self.assertEqual(sample("misses"), before["misses"] + 1)
+
+        cache = TokenCache(max_size=1, ttl=10)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.info()["evictions"], 1)
+        self.assertEqual(sample("evictions"), before["evictions"] + 1)
+
+    def test_invalid_token_is_rejected(self):
+        response, _ = self.get(Token(key="invalid"))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deleted_token_is_rejected(self):
+        self.get()
+        self.token.delete()
+        response, _ = self.get()
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_rotated_token_replaces_the_old_one(self):
+        self.get()
+        self.token.delete()
+        new_token = Token.objects.create(user=self.test_user)
+        response, _ = self.get()
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response, _ = self.get(new_token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_deactivated_user_is_rejected(self):
+        self.get()
+        self.test_user.is_active = False
+        self.test_user.save()
+        response, _ = self.get()
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_saved_user_is_read_again(self):
+        self.get()
+        self.test_user.first_name = "Renamed"
+        self.test_user.save()
+        response, auth_queries = self.get()
+        self.assertEqual(auth_queries, 1)
+        self.assertEqual(response.wsgi_request.user.first_name, "Renamed")
+
+    @override_settings(
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "tokens": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        },
+        TOKEN_CACHE={"BACKEND": "tokens"},
+    )
+    def test_tokens_are_shared_through_the_cache_backend(self):
+        self.get()
+        # Another process starts with an empty local cache
+        get_token_cache().entries.clear()
+        response, auth_queries = self.get()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(auth_queries, 0)
+
+        self.token.delete()
+        get_token_cache().entries.clear()
+        response, _ = self.get()
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_token_cache_expires_and_evicts_entries(self):
+        now = [0]
+        cache = TokenCache(max_size=2, ttl=10, clock=lambda: now[0])
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        now[0] = 10
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.info()["size"], 1)